@@ -10,8 +10,9 @@ class RequiredAttachmentForm(forms.ModelForm):
         self.prefix = 'attachment'
 
     def clean(self):
-        if self._uploaded_file and not self.instance.get_mime_type(self._uploaded_file.name):
-            raise ValidationError("{} has an unsupported file type".format(self._uploaded_file.name))
+        uploaded_file = self._uploaded_file
+        if uploaded_file and not self.instance.get_mime_type(uploaded_file.name, uploaded_file):
+            raise ValidationError("{} has an unsupported file type".format(uploaded_file.name))
 
         return self.cleaned_data
 
@@ -41,3 +42,49 @@ class TaggedAttachmentForm(RequiredAttachmentForm):
 
     class Meta(RequiredAttachmentForm.Meta):
         fields = RequiredAttachmentForm.Meta.fields + ('tag', )
+
+class MultipleFileInput(forms.FileInput):
+
+    def __init__(self, attrs=None):
+        super(MultipleFileInput, self).__init__(dict(attrs or {}, multiple='multiple'))
+
+    def value_from_datadict(self, data, files, name):
+        if hasattr(files, 'getlist'):
+            return files.getlist(name)
+        return [files[name]] if files.get(name) else []
+
+class MultipleFileField(forms.FileField):
+    widget = MultipleFileInput
+
+    def clean(self, data, initial=None):
+        if not data:
+            # raises when the field is required
+            super(MultipleFileField, self).clean(None, initial)
+            return []
+        return [super(MultipleFileField, self).clean(upload) for upload in data]
+
+class MultipleAttachmentForm(forms.Form):
+    """
+    Uploads any number of files in one submission; save() attaches them all
+    with Attachment.objects.bulk_attach().
+    """
+    attachments = MultipleFileField()
+    description = forms.CharField(max_length=256, required=False)
+    tag = forms.CharField(max_length=50, required=False)
+
+    def __init__(self, *args, **kwargs):
+        super(MultipleAttachmentForm, self).__init__(*args, **kwargs)
+        self.prefix = 'attachment'
+
+    def clean_attachments(self):
+        uploads = self.cleaned_data['attachments']
+        probe = models.Attachment()
+        unsupported = [upload.name for upload in uploads if not probe.get_mime_type(upload.name, upload)]
+        if unsupported:
+            raise ValidationError(["{} has an unsupported file type".format(name) for name in unsupported])
+        return uploads
+
+    def save(self, attach_to):
+        return models.Attachment.objects.bulk_attach(
+            attach_to, self.cleaned_data['attachments'], tag=self.cleaned_data['tag'],
+            description=self.cleaned_data['description'] or None)
@@ -0,0 +1,66 @@
+import hashlib
+
+from django.conf import settings
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def get_chunk_size():
+    return getattr(settings, 'ATTACHMENTS_INGEST_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+class Digest(object):
+    """
+    Accumulates the size and content hash of a payload as it streams past.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def update(self, chunk):
+        self.size += len(chunk)
+        self._hash.update(chunk)
+
+    @property
+    def content_hash(self):
+        return self._hash.hexdigest()
+
+    @classmethod
+    def of(cls, data):
+        digest = cls()
+        digest.update(data)
+        return digest
+
+
+def read_chunks(source, chunk_size):
+    """
+    Yields chunks of a django File (through its chunks()) or of any other
+    readable file-like object.
+    """
+    if hasattr(source, 'chunks'):
+        source.open()
+        for chunk in source.chunks(chunk_size):
+            yield chunk
+    else:
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def ingest(source, destination, chunk_size=None):
+    """
+    Copies source into the writable destination one chunk at a time, so no
+    more than chunk_size bytes of it are held in memory at once. Returns the
+    Digest of everything that was written.
+    """
+    digest = Digest()
+    try:
+        for chunk in read_chunks(source, chunk_size or get_chunk_size()):
+            digest.update(chunk)
+            destination.write(chunk)
+    finally:
+        source.close()
+    return digest
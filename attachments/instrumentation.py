@@ -0,0 +1,192 @@
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+from attachments.utils import get_class
+
+DEFAULT_SINKS = {
+    'logging': 'attachments.instrumentation.LoggingSink',
+    'statsd': 'attachments.instrumentation.StatsdSink',
+    'memory': 'attachments.instrumentation.MemorySink',
+}
+
+DEFAULT_STATSD_ADDRESS = ('127.0.0.1', 8125)
+
+logger = logging.getLogger('attachments')
+
+
+class Trace(object):
+    """
+    What one request spent its time on: each stage's duration in
+    milliseconds, in the order the stages ran, plus values such as payload
+    and rendition sizes and whether the rendition came from the store.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.duration = None
+        self.stages = []
+        self.values = {}
+
+    def add_stage(self, stage, duration):
+        self.stages.append((stage, duration))
+
+    def finish(self):
+        self.duration = (time.time() - self.started) * 1000
+        return self
+
+    def server_timing(self):
+        timings = ['%s;dur=%.1f' % (stage, duration) for stage, duration in self.stages]
+        return ', '.join(timings + ['total;dur=%.1f' % self.duration])
+
+
+class BaseSink(object):
+    """
+    Receives every finished trace.
+    """
+
+    def emit(self, trace):
+        raise NotImplementedError
+
+
+class LoggingSink(BaseSink):
+    """
+    Logs one line per request to the attachments logger at INFO.
+    """
+
+    def emit(self, trace):
+        stages = ' '.join('%s=%.1fms' % (stage, duration) for stage, duration in trace.stages)
+        values = ' '.join('%s=%s' % item for item in sorted(trace.values.items()))
+        logger.info("%s %.1fms %s %s", trace.name, trace.duration, stages, values)
+
+
+class StatsdSink(BaseSink):
+    """
+    Sends timers for each stage, gauges for sizes and counters for other
+    values as statsd UDP packets to ATTACHMENTS_STATSD_ADDRESS, prefixed
+    with ATTACHMENTS_STATSD_PREFIX.
+    """
+
+    def __init__(self):
+        self.address = getattr(settings, 'ATTACHMENTS_STATSD_ADDRESS', DEFAULT_STATSD_ADDRESS)
+        self.prefix = getattr(settings, 'ATTACHMENTS_STATSD_PREFIX', 'attachments.')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def metrics(self, trace):
+        prefix = self.prefix + trace.name
+        yield '%s.total:%d|ms' % (prefix, trace.duration)
+        for stage, duration in trace.stages:
+            yield '%s.%s:%d|ms' % (prefix, stage, duration)
+        for name, value in sorted(trace.values.items()):
+            if value is None:
+                # e.g. the size of a payload that wasn't loaded
+                continue
+            if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                yield '%s.%s:%s|g' % (prefix, name, value)
+            else:
+                yield '%s.%s.%s:1|c' % (prefix, name, value)
+
+    def emit(self, trace):
+        try:
+            self.socket.sendto('\n'.join(self.metrics(trace)), self.address)
+        except socket.error:
+            # metrics are never worth failing a request over
+            pass
+
+
+class MemorySink(BaseSink):
+    """
+    Keeps every trace in memory, for tests.
+    """
+
+    def __init__(self):
+        self.traces = []
+
+    def emit(self, trace):
+        self.traces.append(trace)
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+def get_sinks():
+    """
+    The sinks named in ATTACHMENTS_INSTRUMENTATION_SINKS ('logging', 'statsd',
+    'memory' or dotted paths to BaseSink subclasses).
+    """
+    names = getattr(settings, 'ATTACHMENTS_INSTRUMENTATION_SINKS', ())
+    with _sinks_lock:
+        for name in names:
+            if name not in _sinks:
+                _sinks[name] = get_class(DEFAULT_SINKS.get(name, name))()
+        return [_sinks[name] for name in names]
+
+
+def server_timing_enabled():
+    return getattr(settings, 'ATTACHMENTS_SERVER_TIMING', False)
+
+_local = threading.local()
+
+
+def current():
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def stage(name):
+    """
+    Times the block as a stage of the current request's trace, if any.
+    """
+    trace = current()
+    if trace is None:
+        yield
+        return
+
+    started = time.time()
+    try:
+        yield
+    finally:
+        trace.add_stage(name, (time.time() - started) * 1000)
+
+
+def record(name, value):
+    trace = current()
+    if trace is not None:
+        trace.values[name] = value
+
+
+def instrumented(name):
+    """
+    Traces every request to the decorated view when there are sinks to send
+    the trace to or ATTACHMENTS_SERVER_TIMING is on; otherwise stage() and
+    record() do nothing.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            sinks = get_sinks()
+            timing = server_timing_enabled()
+            if current() is not None or (not sinks and not timing):
+                # untraced, or already part of an outer view's trace
+                return view(request, *args, **kwargs)
+
+            _local.trace = Trace(name)
+            try:
+                response = view(request, *args, **kwargs)
+                trace = _local.trace.finish()
+            finally:
+                _local.trace = None
+
+            if timing:
+                response['Server-Timing'] = trace.server_timing()
+            for sink in sinks:
+                sink.emit(trace)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,20 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from attachments.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = "Deletes resumable uploads that were abandoned, along with their staged chunks."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--max-age', type='int', default=None,
+                    help='Seconds an upload may sit idle (default ATTACHMENTS_UPLOAD_SESSION_TIMEOUT).'),
+    )
+
+    def handle(self, *args, **options):
+        max_age = datetime.timedelta(seconds=options['max_age']) if options['max_age'] is not None else None
+        deleted = UploadSession.objects.collect_garbage(max_age)
+        self.stdout.write("Deleted %s stale upload sessions\n" % deleted)
@@ -0,0 +1,42 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+
+from attachments.models import Attachment, Blob
+from attachments.storage import get_storage, move_payload
+
+
+class Command(BaseCommand):
+    help = ("Moves attachment payloads into the shared, content addressed blob table in batches, "
+            "so identical payloads are stored once. Safe to interrupt and rerun.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+                    help='Number of attachments read per query.'),
+    )
+
+    def stored_bytes(self):
+        return Blob.objects.aggregate(total=Sum('size'))['total'] or 0
+
+    def handle(self, *args, **options):
+        shared = get_storage('shared')
+        stored_before = self.stored_bytes()
+
+        queryset = Attachment.objects.exclude(storage=shared.name).order_by('pk').defer('attachment')
+        last_pk, moved, moved_bytes = 0, 0, 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+
+            for attachment in batch:
+                if move_payload(attachment, shared):
+                    moved += 1
+                    moved_bytes += attachment.size
+            last_pk = batch[-1].pk
+            self.stdout.write("Deduplicated %s attachments so far\n" % moved)
+
+        reclaimed = moved_bytes - (self.stored_bytes() - stored_before)
+        self.stdout.write("Deduplicated %s attachments (%s bytes) and reclaimed %s bytes\n" % (
+            moved, moved_bytes, reclaimed))
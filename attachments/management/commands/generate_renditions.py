@@ -0,0 +1,38 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from attachments import workers
+from attachments.models import Attachment
+
+
+class Command(BaseCommand):
+    help = "Generates thumbnail and preview renditions for existing image attachments."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=workers.DEFAULT_WORKERS,
+                    help='Number of threads or processes generating renditions.'),
+        make_option('--processes', action='store_true', default=False,
+                    help='Use a process pool instead of threads.'),
+        make_option('--batch-size', type='int', default=1000,
+                    help='Number of attachment ids read per query.'),
+    )
+
+    def handle(self, *args, **options):
+        backend_class = workers.ProcessPoolBackend if options['processes'] else workers.LocalQueueBackend
+        backend = backend_class(workers=options['workers'])
+
+        queryset = Attachment.objects.filter(attachment_type=Attachment.IMAGE).order_by('pk')
+        last_pk, total = 0, 0
+        while True:
+            pks = list(queryset.filter(pk__gt=last_pk).values_list('pk', flat=True)[:options['batch_size']])
+            if not pks:
+                break
+
+            for pk in pks:
+                backend.submit(pk)
+            last_pk = pks[-1]
+            total += len(pks)
+
+        backend.join()
+        self.stdout.write("Generated renditions for %s attachments\n" % total)
@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from attachments.models import Attachment
+from attachments.storage import get_storage, move_payload
+
+
+class Command(BaseCommand):
+    args = '<storage>'
+    help = ("Moves attachment payloads into another storage backend in batches. "
+            "Rows are moved one at a time, so the command can be interrupted and rerun at any point.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+                    help='Number of attachments read per query.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: migrate_attachment_storage %s" % self.args)
+
+        try:
+            target = get_storage(args[0])
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+
+        queryset = Attachment.objects.exclude(storage=target.name).order_by('pk').defer('attachment')
+        last_pk, moved, skipped = 0, 0, 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+
+            for attachment in batch:
+                if move_payload(attachment, target):
+                    moved += 1
+                else:
+                    skipped += 1
+            last_pk = batch[-1].pk
+            self.stdout.write("Moved %s attachments to %s so far\n" % (moved, target.name))
+
+        self.stdout.write("Moved %s attachments to %s (%s changed while moving and were left alone)\n" % (
+            moved, target.name, skipped))
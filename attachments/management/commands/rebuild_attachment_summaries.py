@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+
+from attachments.models import Attachment, AttachmentSummary
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the per-object attachment summaries from the attachments table."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+                    help='Number of summaries inserted per query.'),
+    )
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        AttachmentSummary.objects.all().delete()
+
+        # by the id column: ordering by content_type sorts by ContentType's name, which isn't unique
+        totals = Attachment.objects.order_by('content_type__id', 'object_id').values(
+            'content_type', 'object_id', 'attachment_type'
+        ).annotate(count=Count('pk'), bytes=Sum('size'), latest=Max('attached_at'))
+
+        summaries, summary, written = [], None, 0
+        for total in totals.iterator():
+            key = (total['content_type'], total['object_id'])
+            if summary is None or (summary.content_type_id, summary.object_id) != key:
+                summary = AttachmentSummary(content_type_id=key[0], object_id=key[1])
+                summaries.append(summary)
+            summary.add(total['attachment_type'], total['count'], total['bytes'], total['latest'])
+
+            # the last summary may still be collecting totals, so keep it back
+            if len(summaries) > options['batch_size']:
+                AttachmentSummary.objects.bulk_create(summaries[:-1])
+                written += len(summaries) - 1
+                summaries = summaries[-1:]
+
+        AttachmentSummary.objects.bulk_create(summaries)
+        written += len(summaries)
+        self.stdout.write("Rebuilt %s attachment summaries\n" % written)
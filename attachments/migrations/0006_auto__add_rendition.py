@@ -0,0 +1,65 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'Rendition'
+        db.create_table('attachments_rendition', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('attachment_id', self.gf('django.db.models.fields.PositiveIntegerField')(db_index=True)),
+            ('size', self.gf('django.db.models.fields.CharField')(max_length=20)),
+            ('format', self.gf('django.db.models.fields.CharField')(max_length=20)),
+            ('data', self.gf('attachments.models.LongBlob')()),
+        ))
+        db.send_create_signal('attachments', ['Rendition'])
+
+        # Adding unique constraint on 'Rendition', fields ['attachment_id', 'size', 'format']
+        db.create_unique('attachments_rendition', ['attachment_id', 'size', 'format'])
+
+
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'Rendition', fields ['attachment_id', 'size', 'format']
+        db.delete_unique('attachments_rendition', ['attachment_id', 'size', 'format'])
+
+        # Deleting model 'Rendition'
+        db.delete_table('attachments_rendition')
+
+
+    models = {
+        'attachments.attachment': {
+            'Meta': {'object_name': 'Attachment'},
+            'attached_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'attachment': ('attachments.models.LongBlob', [], {}),
+            'attachment_type': ('django.db.models.fields.IntegerField', [], {}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            'file_name': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'mimetype': ('django.db.models.fields.CharField', [], {'max_length': '120'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'tag': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '50', 'db_index': 'True', 'blank': 'True'})
+        },
+        'attachments.rendition': {
+            'Meta': {'unique_together': "(('attachment_id', 'size', 'format'),)", 'object_name': 'Rendition'},
+            'attachment_id': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'data': ('attachments.models.LongBlob', [], {}),
+            'format': ('django.db.models.fields.CharField', [], {'max_length': '20'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'size': ('django.db.models.fields.CharField', [], {'max_length': '20'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['attachments']
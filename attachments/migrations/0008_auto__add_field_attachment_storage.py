@@ -0,0 +1,68 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding field 'Attachment.storage' (existing payloads all live in the database)
+        db.add_column('attachments_attachment', 'storage', self.gf('django.db.models.fields.CharField')(default='database', max_length=20, blank=True), keep_default=False)
+
+        # Adding field 'Attachment.storage_key'
+        db.add_column('attachments_attachment', 'storage_key', self.gf('django.db.models.fields.CharField')(default='', max_length=255, blank=True), keep_default=False)
+
+        # Changing field 'Attachment.attachment'
+        db.alter_column('attachments_attachment', 'attachment', self.gf('attachments.models.LongBlob')(null=True))
+
+
+    def backwards(self, orm):
+        
+        # Deleting field 'Attachment.storage'
+        db.delete_column('attachments_attachment', 'storage')
+
+        # Deleting field 'Attachment.storage_key'
+        db.delete_column('attachments_attachment', 'storage_key')
+
+        # Changing field 'Attachment.attachment'
+        db.alter_column('attachments_attachment', 'attachment', self.gf('attachments.models.LongBlob')(default=''))
+
+
+    models = {
+        'attachments.attachment': {
+            'Meta': {'object_name': 'Attachment'},
+            'attached_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'attachment': ('attachments.models.LongBlob', [], {'null': 'True', 'blank': 'True'}),
+            'attachment_type': ('django.db.models.fields.IntegerField', [], {}),
+            'content_hash': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '64', 'blank': 'True'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '256', 'null': 'True', 'blank': 'True'}),
+            'file_name': ('django.db.models.fields.CharField', [], {'max_length': '256'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'mimetype': ('django.db.models.fields.CharField', [], {'max_length': '120'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'size': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'storage': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '20', 'blank': 'True'}),
+            'storage_key': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'tag': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '50', 'db_index': 'True', 'blank': 'True'})
+        },
+        'attachments.rendition': {
+            'Meta': {'unique_together': "(('attachment_id', 'size', 'format'),)", 'object_name': 'Rendition'},
+            'attachment_id': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'}),
+            'data': ('attachments.models.LongBlob', [], {}),
+            'format': ('django.db.models.fields.CharField', [], {'max_length': '20'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'size': ('django.db.models.fields.CharField', [], {'max_length': '20'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['attachments']
@@ -0,0 +1,117 @@
+import os
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# these mirror Attachment.DOCUMENT and Attachment.IMAGE
+DOCUMENT = 1
+IMAGE = 2
+ATTACHMENT_TYPES = {'document': DOCUMENT, 'image': IMAGE}
+
+OLE = '\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+ZIP = 'PK\x03\x04'
+
+#(mimetype, extensions, attachment type, leading bytes any real file of the type starts with)
+DEFAULT_MIME_TYPES = (
+    ('image/jpeg', ('jpg', 'jpeg'), IMAGE, ('\xff\xd8\xff',)),
+    ('image/png', ('png',), IMAGE, ('\x89PNG\r\n\x1a\n',)),
+    ('image/gif', ('gif',), IMAGE, ('GIF87a', 'GIF89a')),
+    ('image/x-ms-bmp', ('bmp',), IMAGE, ('BM',)),
+    ('application/pdf', ('pdf',), DOCUMENT, ('%PDF-',)),
+    ('application/msword', ('doc',), DOCUMENT, (OLE,)),
+    ('application/vnd.openxmlformats-officedocument.wordprocessingml.document', ('docx',), DOCUMENT, (ZIP,)),
+    ('application/vnd.ms-excel', ('xls',), DOCUMENT, (OLE,)),
+    ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', ('xlsx',), DOCUMENT, (ZIP,)),
+    ('text/richtext', ('rtf',), DOCUMENT, ('{\\rtf',)),
+)
+
+HEAD_SIZE = 16
+
+
+class MimeRegistry(object):
+    """
+    Maps file extensions to mimetypes and mimetypes to attachment types with
+    plain dict lookups, and optionally confirms a mimetype from the first
+    bytes of the file.
+    """
+
+    def __init__(self, mime_types=()):
+        self.mimetypes_by_extension = {}
+        self.attachment_types = {}
+        self.signatures = {}
+        for entry in mime_types:
+            self.register(*entry)
+
+    def register(self, mimetype, extensions, attachment_type, signatures=()):
+        if attachment_type in ATTACHMENT_TYPES:
+            attachment_type = ATTACHMENT_TYPES[attachment_type]
+        elif attachment_type not in ATTACHMENT_TYPES.values():
+            raise ImproperlyConfigured("Unknown attachment type %r for %s" % (attachment_type, mimetype))
+
+        for extension in extensions:
+            self.mimetypes_by_extension[extension.lower().lstrip('.')] = mimetype
+        self.attachment_types[mimetype] = attachment_type
+        if signatures:
+            self.signatures[mimetype] = tuple(signatures)
+
+    def for_file_name(self, file_name):
+        extension = os.path.splitext(file_name or '')[1]
+        return self.mimetypes_by_extension.get(extension[1:].lower())
+
+    def attachment_type(self, mimetype):
+        return self.attachment_types.get(mimetype)
+
+    def matches(self, mimetype, head):
+        """
+        False only when the type has known signatures and head starts with none of them.
+        """
+        signatures = self.signatures.get(mimetype)
+        return not signatures or head.startswith(signatures)
+
+    def confirm(self, mimetype, source=None):
+        """
+        False only when ATTACHMENTS_SNIFF_MIME_TYPES is on and the first bytes
+        of source don't look like mimetype.
+        """
+        if source is None or not getattr(settings, 'ATTACHMENTS_SNIFF_MIME_TYPES', False):
+            return True
+        return self.matches(mimetype, read_head(source))
+
+    def detect(self, file_name, source=None):
+        """
+        Returns the mimetype for file_name, or None when it isn't supported
+        (or, with sniffing on, source doesn't look like it).
+        """
+        mimetype = self.for_file_name(file_name)
+        if mimetype and not self.confirm(mimetype, source):
+            return None
+        return mimetype
+
+
+def read_head(source):
+    if isinstance(source, basestring):
+        return source[:HEAD_SIZE]
+
+    source.open()
+    head = source.read(HEAD_SIZE)
+    source.seek(0)
+    return head
+
+_registry = None
+_registry_source = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    The registry of DEFAULT_MIME_TYPES plus any ATTACHMENTS_MIME_TYPES entries,
+    built once and rebuilt only when that setting changes.
+    """
+    global _registry, _registry_source
+    extra = getattr(settings, 'ATTACHMENTS_MIME_TYPES', ())
+    with _registry_lock:
+        if _registry is None or _registry_source is not extra:
+            _registry = MimeRegistry(DEFAULT_MIME_TYPES + tuple(extra))
+            _registry_source = extra
+        return _registry
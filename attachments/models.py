@@ -1,21 +1,251 @@
-from StringIO import StringIO
-import re
-
-from PIL import Image
+import os
+import uuid
+from collections import defaultdict
 
 from django.conf import settings
-from django.db import models
+from django.core.files.base import ContentFile, File
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import Count, Max, Q, Sum, signals
+from django.db.models.sql import DeleteQuery
 from django.core.urlresolvers import reverse
+from django.utils import timezone
+from django.utils.http import urlencode
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from south.modelsinspector import add_introspection_rules
+from attachments import ingest
+from attachments import instrumentation
+from attachments import mime
+from attachments import renditions
+from attachments import responses
+from attachments import uploads
+from attachments import workers
+from attachments.storage import DATABASE, get_default_storage_name, get_storage
 
 class LongBlob(models.Field):
+    __metaclass__ = models.SubfieldBase
+
     def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'bytea'
+        elif connection.vendor in ('sqlite', 'oracle'):
+            return 'blob'
         return 'longblob'
 
+    def to_python(self, value):
+        # binary columns come back as buffers (or memoryviews) on some backends
+        if isinstance(value, memoryview):
+            return value.tobytes()
+        if isinstance(value, (buffer, bytearray)):
+            return str(value)
+        return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if isinstance(value, str) and connection.vendor in ('sqlite', 'postgresql'):
+            # both drivers only bind a buffer as binary; a str is taken for (and decoded as) text
+            return buffer(value)
+        return value
+
 add_introspection_rules([], ["^attachments\.models\.LongBlob"])
 
+DEFAULT_BULK_BATCH_SIZE = 100
+DEFAULT_PAGE_SIZE = 20
+
+class AttachResult(object):
+    """
+    The outcome of attaching one file with bulk_attach(): the saved attachment,
+    or the reason the file was turned away.
+    """
+
+    def __init__(self, file_name, attachment=None, error=None):
+        self.file_name = file_name
+        self.attachment = attachment
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+class AttachmentManager(models.Manager):
+
+    def get_query_set(self):
+        # payloads can be megabytes; leave them unloaded until they are read. As the
+        # default manager this also covers GenericRelation managers and prefetch_related.
+        return super(AttachmentManager, self).get_query_set().defer('attachment')
+
+    def with_payload(self):
+        """
+        For the rare caller that wants payloads read along with the rows.
+        """
+        return self.get_query_set().defer(None)
+
+    # for_object() and latest_for() filter and sort in the column order of the
+    # (content_type, object_id, tag, attached_at) index added in migration 0010
+
+    def for_object(self, model, tag=None):
+        content_type = ContentType.objects.get_for_model(model)
+        queryset = self.filter(content_type__pk=content_type.pk, object_id=model.pk)
+        if tag is not None:
+            queryset = queryset.filter(tag=tag)
+        return queryset
+
+    def latest_for(self, model, tag, count=None):
+        """
+        The object's attachments with the given tag, newest first. The index
+        returns these already sorted, so no sort step is needed.
+        """
+        queryset = self.for_object(model, tag).order_by('-attached_at', '-pk')
+        return queryset[:count] if count else queryset
+
+    def page_for(self, content_type_id, object_id, tag=None, after=None, count=None):
+        """
+        One page of an object's attachments, oldest first. after is the
+        (attached_at, pk) of the last attachment on the previous page, so every
+        page is a range read of an index instead of an ever longer OFFSET: the
+        (content_type, object_id, attached_at) one, or with a tag the
+        (content_type, object_id, tag, attached_at) one.
+        """
+        queryset = self.filter(content_type__pk=content_type_id, object_id=object_id)
+        if tag is not None:
+            queryset = queryset.filter(tag=tag)
+        if after is not None:
+            attached_at, pk = after
+            queryset = queryset.filter(Q(attached_at__gt=attached_at) | Q(attached_at=attached_at, pk__gt=pk))
+        count = count or getattr(settings, 'ATTACHMENTS_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+        return queryset.order_by('attached_at', 'pk')[:count]
+
+    def bulk_attach(self, model, files, tag="", description=None, batch_size=None):
+        """
+        Attaches many uploaded files to model at once. Every file is checked
+        before anything is stored; supported ones are then streamed into storage
+        and inserted ATTACHMENTS_BULK_BATCH_SIZE rows per INSERT, all in one
+        transaction. Returns an AttachResult per file, in the order given.
+        """
+        batch_size = batch_size or getattr(settings, 'ATTACHMENTS_BULK_BATCH_SIZE', DEFAULT_BULK_BATCH_SIZE)
+        content_type = ContentType.objects.get_for_model(model)
+        probe = self.model()
+
+        results, pending = [], []
+        for upload in files:
+            result = AttachResult(upload.name)
+            mimetype = probe.get_mime_type(upload.name, upload)
+            if mimetype:
+                result.attachment = self.model(
+                    content_type=content_type, object_id=model.pk, tag=tag, description=description,
+                    file_name=upload.name, mimetype=mimetype, attachment_type=probe.get_attachment_type(mimetype))
+                pending.append((result, upload))
+            else:
+                result.error = "%s has an unsupported file type" % upload.name
+            results.append(result)
+
+        stored, last_pk = [], 0
+        # some databases drop the microseconds of attached_at
+        inserted_after = timezone.now().replace(microsecond=0)
+        try:
+            with transaction.commit_on_success(using=self.db):
+                for start in range(0, len(pending), batch_size):
+                    batch = pending[start:start + batch_size]
+                    for result, upload in batch:
+                        result.attachment.store_payload(upload)
+                        storage = result.attachment.get_storage()
+                        # keep only what the cleanup needs, not the instances and their payloads
+                        if result.attachment.storage_key and not storage.transactional:
+                            stored.append((storage, result.attachment.storage_key))
+                    self.bulk_create([result.attachment for result, upload in batch])
+                    last_pk = self._reload_inserted([result for result, upload in batch], content_type,
+                                                    model.pk, inserted_after, last_pk)
+        except Exception:
+            for storage, storage_key in stored:
+                storage.delete(storage_key)
+            raise
+
+        AttachmentSummary.objects.refresh(content_type.pk, model.pk)
+        for result, upload in pending:
+            workers.enqueue_renditions(result.attachment)
+        return results
+
+    def _reload_inserted(self, batch, content_type, object_id, inserted_after, after_pk):
+        # bulk_create doesn't report the new primary keys, so read the batch back
+        # (without payloads, which also frees the ones held by the database storage)
+        inserted = {}
+        rows = self.filter(content_type__pk=content_type.pk, object_id=object_id,
+                           attached_at__gte=inserted_after, pk__gt=after_pk)
+        for attachment in rows.order_by('pk'):
+            inserted.setdefault((attachment.file_name, attachment.content_hash), []).append(attachment)
+
+        for result in batch:
+            result.attachment = inserted[(result.file_name, result.attachment.content_hash)].pop(0)
+        return max(result.attachment.pk for result in batch)
+
+    def bulk_delete(self, pks=None, **filters):
+        """
+        Deletes the attachments with the given pks and/or matching filters with
+        set-based DELETEs of ATTACHMENTS_BULK_BATCH_SIZE rows, each in its own
+        short transaction, then releases their payloads and renditions and
+        recounts the affected summaries. No payload is read and no delete
+        signals are sent. Returns the number of attachments deleted.
+        """
+        deleted, objects = 0, set()
+        for batch in self._batches(pks, filters, 'storage', 'storage_key', 'content_type', 'object_id'):
+            with transaction.commit_on_success(using=self.db):
+                DeleteQuery(self.model).delete_batch([row[0] for row in batch], self.db)
+
+            for pk, storage, storage_key, content_type_id, object_id in batch:
+                if storage_key:
+                    get_storage(storage or DATABASE).delete(storage_key)
+                renditions.invalidate(pk)
+                objects.add((content_type_id, object_id))
+            deleted += len(batch)
+
+        for content_type_id, object_id in objects:
+            AttachmentSummary.objects.refresh(content_type_id, object_id)
+        return deleted
+
+    def delete_for_object(self, model, tag=None):
+        filters = dict(content_type__pk=ContentType.objects.get_for_model(model).pk, object_id=model.pk)
+        if tag is not None:
+            filters['tag'] = tag
+        return self.bulk_delete(**filters)
+
+    def retag(self, new_tag, pks=None, **filters):
+        """
+        Sets the tag of the attachments with the given pks and/or matching
+        filters, ATTACHMENTS_BULK_BATCH_SIZE rows per UPDATE. Returns the
+        number of attachments retagged.
+        """
+        retagged = 0
+        for batch in self._batches(pks, filters):
+            with transaction.commit_on_success(using=self.db):
+                retagged += self.filter(pk__in=[row[0] for row in batch]).update(tag=new_tag)
+        return retagged
+
+    def _batches(self, pks, filters, *fields):
+        """
+        Yields lists of (pk,) + fields value tuples for the matching rows, at
+        most ATTACHMENTS_BULK_BATCH_SIZE at a time. Rows may be changed between
+        batches, so batches are read one after another by ascending pk.
+        """
+        if pks is None and not filters:
+            raise ValueError("Refusing to select every attachment; pass pks or filters")
+
+        batch_size = getattr(settings, 'ATTACHMENTS_BULK_BATCH_SIZE', DEFAULT_BULK_BATCH_SIZE)
+        queryset = self.filter(**filters).order_by('pk')
+        if pks is not None:
+            pks = sorted(set(int(pk) for pk in pks))
+            for start in range(0, len(pks), batch_size):
+                batch = list(queryset.filter(pk__in=pks[start:start + batch_size]).values_list('pk', *fields))
+                if batch:
+                    yield batch
+            return
+
+        last_pk = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk).values_list('pk', *fields)[:batch_size])
+            if not batch:
+                break
+            yield batch
+            last_pk = batch[-1][0]
+
 class Attachment(models.Model):
     DOCUMENT = 1
     IMAGE = 2
@@ -48,34 +278,13 @@ class Attachment(models.Model):
         (BMP, 'Bitmap Image')
     )
 
-    #This will control how the mime type is set based on file extension
-    MIME_TYPE_EXTENSIONS = (
-        (re.compile(r'.+?\.(?i)jpg$'), JPG),
-        (re.compile(r'.+?\.(?i)jpeg$'), JPG),
-        (re.compile(r'.+?\.(?i)gif$'), GIF),
-        (re.compile(r'.+?\.(?i)png$'), PNG),
-        (re.compile(r'.+?\.(?i)pdf$'), PDF),
-        (re.compile(r'.+?\.(?i)doc$'), WORD),
-        (re.compile(r'.+?\.(?i)xls$'), EXCEL),
-        (re.compile(r'.+?\.(?i)docx$'), WORDX),
-        (re.compile(r'.+?\.(?i)xlsx$'), EXCELX),
-        (re.compile(r'.+?\.(?i)rtf'), RTF),
-        (re.compile(r'.+?\.(?i)bmp'), BMP),
-    )
+    #how mime types and attachment types are derived from file names lives in
+    #attachments.mime, which ATTACHMENTS_MIME_TYPES can extend
 
-    #This is a cross reference list to map from mimetype to attachment type
-    MIME_TYPE_ATTACHMENT_TYPES = {
-        JPG:IMAGE,
-        PNG:IMAGE,
-        GIF:IMAGE,
-        PDF:DOCUMENT,
-        WORD:DOCUMENT,
-        EXCEL:DOCUMENT,
-        WORDX:DOCUMENT,
-        EXCELX:DOCUMENT,
-        RTF:DOCUMENT,
-        BMP:IMAGE,
-    }
+    #deprecated: subclasses may still add (regex, mimetype) pairs and mimetype to
+    #attachment type entries here; they are consulted before attachments.mime
+    MIME_TYPE_EXTENSIONS = ()
+    MIME_TYPE_ATTACHMENT_TYPES = {}
 
     #Define which model instance to attach to
     content_type = models.ForeignKey(ContentType)
@@ -86,22 +295,61 @@ class Attachment(models.Model):
     mimetype = models.CharField(max_length=120, choices=MIME_TYPES)
     attachment_type = models.IntegerField(choices=TYPES)
     description = models.CharField(max_length=256, null=True, blank=True)
-    attachment = LongBlob()
+    attachment = LongBlob(null=True, blank=True)
     file_name = models.CharField(max_length=256)
     tag = models.CharField(max_length=50, blank=True, default="", db_index=True)
+    size = models.PositiveIntegerField(null=True, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True, default="")
+
+    #define where the attachment's payload is kept
+    storage = models.CharField(max_length=20, blank=True, default="")
+    storage_key = models.CharField(max_length=255, blank=True, default="")
 
     #define when it was attached
     attached_at = models.DateTimeField(auto_now_add=True)
 
+    objects = AttachmentManager()
+
     def thumb(self):
         return self.get_attachment_url('thumbnail')
 
     def preview(self):
         return self.get_attachment_url('preview')
 
+    def rendition_url(self, name):
+        if self.attachment_type == self.IMAGE:
+            url = reverse("attachments:rendition", kwargs={'name': name, 'identifier': self.pk})
+            return self.versioned(url, renditions.get_named_rendition(name))
+        return self.get_attachment_url(name)
+
+    def download_url(self):
+        return self.versioned(reverse("attachments:download", kwargs={'identifier': self.pk}))
+
+    def versioned(self, url, named=None):
+        # a new payload (or rendition setting) means a new URL, so responses to this one can be cached for good
+        version = responses.get_rendition_version(self, named) if named else responses.get_version(self)
+        return "%s?v=%s" % (url, version)
+
+    def srcset(self, names=None):
+        """
+        An img srcset of the named renditions that fit the image in a square
+        (all of them by default), using each one's size as its width so
+        browsers fetch the smallest adequate one. Names that aren't configured
+        in ATTACHMENTS_RENDITIONS are left out.
+        """
+        if self.attachment_type != self.IMAGE:
+            return ''
+
+        named, widths = renditions.get_named_renditions(), {}
+        for name in sorted(names or named):
+            if name in named and not named[name].crop:
+                widths.setdefault(named[name].size, name)
+        return ', '.join('%s %sw' % (self.rendition_url(name), size) for size, name in sorted(widths.items()))
+
     def get_attachment_url(self, image_url):
         if self.attachment_type == self.IMAGE:
-            return reverse("attachments:%s" % image_url, kwargs={'identifier':self.pk})
+            return self.versioned(reverse("attachments:%s" % image_url, kwargs={'identifier':self.pk}),
+                                  renditions.get_named_rendition(image_url))
         elif self.mimetype == self.PDF:
             return "%simages/icons/pdf_icon.gif" % settings.MEDIA_URL
         elif self.mimetype in (self.WORD, self.WORDX):
@@ -111,45 +359,361 @@ class Attachment(models.Model):
         elif self.mimetype == self.RTF:
             return "%simages/icons/rtf_icon.png" % settings.MEDIA_URL
 
-    def create_thumbnail(self, max_size):
-        stream = StringIO(self.attachment)
-        new_image = Image.open(stream)
-        new_image.thumbnail((max_size, max_size), Image.ANTIALIAS)
-        thumbnail = StringIO()
-        new_image.save(thumbnail, self.mimetype.split('/')[1])
-        return thumbnail.getvalue()
+    def create_thumbnail(self, max_size, profile=None, crop=False):
+        profile = profile or renditions.Profile(renditions.ORIGINAL)
+        instrumentation.record('payload_bytes', self.size)
+        with instrumentation.stage('fetch'):
+            stream = self.open_payload()
+        try:
+            return profile.encode(renditions.downscale(stream, max_size, crop), self.mimetype)
+        finally:
+            stream.close()
 
-    def get_mime_type(self, file_name):
-        for regex, mime_type in self.MIME_TYPE_EXTENSIONS:
-            if regex.match(file_name):
-                return mime_type
+    def get_mime_type(self, file_name, source=None):
+        registry = mime.get_registry()
+        for regex, mimetype in self.MIME_TYPE_EXTENSIONS:
+            if regex.match(file_name or ''):
+                return mimetype if registry.confirm(mimetype, source) else None
+        return registry.detect(file_name, source)
+
+    def get_attachment_type(self, mimetype):
+        if mimetype in self.MIME_TYPE_ATTACHMENT_TYPES:
+            return self.MIME_TYPE_ATTACHMENT_TYPES[mimetype]
+        return mime.get_registry().attachment_type(mimetype)
 
     def save(self, force_insert=False, force_update=False, using=None):
-        if hasattr(self.attachment, 'name'):
-            self.file_name = self.attachment.name
+        source = None
+        if self.payload_loaded and hasattr(self.attachment, 'open'):
+            self.file_name = getattr(self.attachment, 'name', None) or self.file_name
+            source = self.attachment
+        elif self.payload_loaded and isinstance(self.attachment, basestring) and \
+                ingest.Digest.of(self.attachment).content_hash != self.content_hash:
+            # a new payload, one assigned to a saved attachment, or a row stored before content hashes
+            source = ContentFile(self.attachment)
 
-        for regex, mime_type in self.MIME_TYPE_EXTENSIONS:
-            if regex.match(self.file_name):
-                self.mimetype = mime_type
-                self.attachment_type = self.MIME_TYPE_ATTACHMENT_TYPES[mime_type]
-                break
+        mimetype = self.get_mime_type(self.file_name, source)
+        if mimetype:
+            self.mimetype = mimetype
+            self.attachment_type = self.get_attachment_type(mimetype)
+
+        previous_key, replaced = self.storage_key, source is not None
+        if replaced:
+            self.store_payload(source)
+
+        if self.payload_loaded or force_insert:
+            super(Attachment, self).save(force_insert, force_update, using)
+        else:
+            self.save_metadata(using)
+        AttachmentSummary.objects.refresh(self.content_type_id, self.object_id)
+        if replaced and previous_key:
+            # release the old payload (for shared payloads this drops a reference, even to the same one)
+            self.get_storage().delete(previous_key)
+        if replaced:
+            # saves that leave the payload alone (e.g. a new description) keep their renditions
+            renditions.invalidate(self.pk)
+            workers.enqueue_renditions(self)
+
+    def delete(self, using=None):
+        pk, storage_key = self.pk, self.storage_key
+        super(Attachment, self).delete(using)
+        AttachmentSummary.objects.refresh(self.content_type_id, self.object_id)
+        if storage_key:
+            self.get_storage().delete(storage_key)
+        renditions.invalidate(pk)
+
+    @property
+    def payload_loaded(self):
+        # rows come back with the payload deferred, and a deferred field is missing from __dict__
+        return self.pk is None or 'attachment' in self.__dict__
+
+    def save_metadata(self, using=None):
+        """
+        Writes every column but the payload, so saving a row loaded without its
+        payload doesn't read the payload back first (Model.save would).
+        """
+        using = using or router.db_for_write(Attachment, instance=self)
+        signals.pre_save.send(sender=Attachment, instance=self, raw=False, using=using)
+        values = dict((field.name, getattr(self, field.attname)) for field in Attachment._meta.local_fields
+                      if not field.primary_key and field.attname != 'attachment')
+        Attachment.objects.db_manager(using).filter(pk=self.pk).update(**values)
+        self._state.db, self._state.adding = using, False
+        signals.post_save.send(sender=Attachment, instance=self, created=False, raw=False, using=using)
+
+    def get_storage(self):
+        return get_storage(self.storage or DATABASE)
 
-        if hasattr(self.attachment, 'open'):
-            self.attachment.open()
-            data = ''.join([chunk for chunk in self.attachment.chunks()])
-            self.attachment.close()
-            self.attachment = data
+    def store_payload(self, source):
+        """
+        Streams source into this attachment's storage backend (ATTACHMENTS_STORAGE
+        for new attachments) and records its size and content hash.
+        """
+        if not self.storage:
+            self.storage = get_default_storage_name()
+        digest = self.get_storage().save(self, source)
+        self.size, self.content_hash = digest.size, digest.content_hash
 
-        super(Attachment, self).save(force_insert, force_update, using)
+    def open_payload(self):
+        return self.get_storage().open(self)
+
+    def payload_path(self):
+        return self.get_storage().path(self)
 
     @staticmethod
     def get_attachments_for(model):
         if model:
+            return Attachment.objects.for_object(model)
+
+    @staticmethod
+    def get_page_url(model, tag=None):
+        """
+        The URL of the first page of model's attachments, for the lazy slider.
+        """
+        content_type = ContentType.objects.get_for_model(model)
+        query = {'content_type': content_type.pk, 'object_id': model.pk}
+        if tag is not None:
+            query['tag'] = tag
+        return "%s?%s" % (reverse("attachments:page"), urlencode(query))
+
+    @staticmethod
+    def get_attachments_map(list_of_models):
+        """
+        Returns a dict of each model to the list of its attachments, using one
+        query per content type rather than one per model.
+        """
+        attachments = dict((model, []) for model in list_of_models if model)
+        models_by_content_type = defaultdict(dict)
+        for model in attachments:
             content_type = ContentType.objects.get_for_model(model)
-            return Attachment.objects.filter(content_type__pk=content_type.pk, object_id=model.pk).defer('attachment')
+            models_by_content_type[content_type.pk][model.pk] = model
+
+        for content_type_pk, models_by_pk in models_by_content_type.items():
+            queryset = Attachment.objects.filter(content_type__pk=content_type_pk, object_id__in=models_by_pk.keys())
+            for attachment in queryset:
+                attachments[models_by_pk[attachment.object_id]].append(attachment)
+        return attachments
 
     @staticmethod
     def get_attachments_for_list(list_of_models):
+        attachments = Attachment.get_attachments_map(list_of_models)
+        for model in list_of_models:
+            for attachment in attachments.get(model, []):
+                yield attachment
+
+class Rendition(models.Model):
+    attachment_id = models.PositiveIntegerField(db_index=True)
+    size = models.CharField(max_length=20)
+    format = models.CharField(max_length=20)
+    data = LongBlob()
+
+    class Meta:
+        unique_together = ('attachment_id', 'size', 'format')
+
+
+class Blob(models.Model):
+    content_hash = models.CharField(max_length=64, unique=True)
+    size = models.PositiveIntegerField()
+    data = LongBlob()
+    reference_count = models.PositiveIntegerField(default=0)
+
+
+class AttachmentSummaryManager(models.Manager):
+
+    def refresh(self, content_type_id, object_id):
+        """
+        Recounts one object's attachments into its summary row.
+        """
+        if content_type_id is None or object_id is None:
+            return
+
+        totals = Attachment.objects.filter(content_type__pk=content_type_id, object_id=object_id).order_by()
+        totals = totals.values('attachment_type').annotate(count=Count('pk'), bytes=Sum('size'), latest=Max('attached_at'))
+
+        summary = AttachmentSummary(content_type_id=content_type_id, object_id=object_id)
+        for total in totals:
+            summary.add(total['attachment_type'], total['count'], total['bytes'], total['latest'])
+
+        existing = self.filter(content_type__pk=content_type_id, object_id=object_id)
+        if not summary.count:
+            existing.delete()
+            return
+
+        values = dict(count=summary.count, image_count=summary.image_count, document_count=summary.document_count,
+                      total_bytes=summary.total_bytes, latest_attached_at=summary.latest_attached_at)
+        if not existing.update(**values):
+            savepoint = transaction.savepoint(using=self.db)
+            try:
+                summary.save(using=self.db)
+                transaction.savepoint_commit(savepoint, using=self.db)
+            except IntegrityError:
+                # a concurrent save inserted the summary first
+                transaction.savepoint_rollback(savepoint, using=self.db)
+                existing.update(**values)
+
+    def for_object(self, model):
+        return self.for_objects([model])[model]
+
+    def for_objects(self, list_of_models):
+        """
+        Returns a dict of each model to its summary, in a single query. Models
+        without attachments get an empty, unsaved summary.
+        """
+        summaries, models_by_key, query = {}, {}, Q()
         for model in list_of_models:
-            for attachment in Attachment.get_attachments_for(model):
-                yield attachment
\ No newline at end of file
+            content_type = ContentType.objects.get_for_model(model)
+            summaries[model] = AttachmentSummary(content_type=content_type, object_id=model.pk)
+            models_by_key[(content_type.pk, model.pk)] = model
+            query |= Q(content_type__pk=content_type.pk, object_id=model.pk)
+
+        if models_by_key:
+            for summary in self.filter(query):
+                summaries[models_by_key[(summary.content_type_id, summary.object_id)]] = summary
+        return summaries
+
+class AttachmentSummary(models.Model):
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+
+    count = models.PositiveIntegerField(default=0)
+    image_count = models.PositiveIntegerField(default=0)
+    document_count = models.PositiveIntegerField(default=0)
+    total_bytes = models.BigIntegerField(default=0)
+    latest_attached_at = models.DateTimeField(null=True, blank=True)
+
+    objects = AttachmentSummaryManager()
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+
+    def add(self, attachment_type, count, total_bytes, latest_attached_at):
+        self.count += count
+        if attachment_type == Attachment.IMAGE:
+            self.image_count += count
+        elif attachment_type == Attachment.DOCUMENT:
+            self.document_count += count
+        self.total_bytes += total_bytes or 0
+        if latest_attached_at and (not self.latest_attached_at or latest_attached_at > self.latest_attached_at):
+            self.latest_attached_at = latest_attached_at
+
+class UploadSessionManager(models.Manager):
+
+    def start(self, model, file_name, size, content_hash='', tag='', description=None):
+        """
+        Opens a resumable upload of a size byte file to be attached to model.
+        content_hash, the SHA-256 of the whole file, is checked on finish().
+        """
+        if size < 0:
+            raise uploads.UploadError("An upload can't be %d bytes" % size)
+        if not Attachment().get_mime_type(file_name):
+            raise uploads.UploadError("%s has an unsupported file type" % file_name)
+        session = self.create(token=uuid.uuid4().hex, content_type=ContentType.objects.get_for_model(model),
+                              object_id=model.pk, file_name=file_name, size=size,
+                              content_hash=(content_hash or '').lower(), tag=tag or '', description=description)
+        uploads.create_staging_file(session.token)
+        return session
+
+    def collect_garbage(self, max_age=None):
+        """
+        Deletes the sessions idle for longer than max_age (a timedelta, by default
+        ATTACHMENTS_UPLOAD_SESSION_TIMEOUT seconds) along with their staged
+        chunks. Returns the number of sessions deleted.
+        """
+        max_age = max_age or uploads.get_session_timeout()
+        stale = list(self.filter(updated_at__lt=timezone.now() - max_age).values_list('pk', 'token'))
+        for pk, token in stale:
+            self.filter(pk=pk).delete()
+            uploads.delete_staging_file(token)
+
+        for path in uploads.orphaned_files(set(self.values_list('token', flat=True)), max_age):
+            os.remove(path)
+        return len(stale)
+
+class UploadSession(models.Model):
+    """
+    A file uploaded in chunks, each PUT at the offset where the last one
+    ended into a staging file under ATTACHMENTS_UPLOAD_ROOT, so an interrupted
+    upload resumes rather than restarting. finish() attaches the whole file.
+    """
+    token = models.CharField(max_length=32, unique=True)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    tag = models.CharField(max_length=50, blank=True, default='')
+    description = models.CharField(max_length=256, blank=True, null=True)
+    file_name = models.CharField(max_length=256)
+    size = models.PositiveIntegerField()
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    received = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = UploadSessionManager()
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+    def write_chunk(self, offset, source, length):
+        """
+        Appends length bytes read from source, which must start at offset.
+        Raises OffsetMismatch when it doesn't, which tells the client where
+        to resume.
+        """
+        if offset != self.received:
+            raise uploads.OffsetMismatch(self.received)
+        if offset + length > self.size:
+            raise uploads.UploadError("Chunk ends past the %d bytes of the upload" % self.size)
+        if length > uploads.get_max_chunk_size():
+            raise uploads.UploadError("Chunks can't be larger than %d bytes" % uploads.get_max_chunk_size())
+
+        uploads.write_chunk(self.token, offset, source, length)
+        # a retried chunk may have raced this one; only one of them moves the offset on
+        if not UploadSession.objects.filter(pk=self.pk, received=offset).update(
+                received=offset + length, updated_at=timezone.now()):
+            raise uploads.OffsetMismatch(UploadSession.objects.get(pk=self.pk).received)
+        self.received = offset + length
+
+    def finish(self):
+        """
+        Verifies the staged file against the size and content hash the upload
+        was started with and attaches it. The session is gone afterwards,
+        whether the file was attached or was turned away as corrupt.
+        """
+        if not self.complete:
+            raise uploads.UploadError("Only %d of %d bytes have been uploaded" % (self.received, self.size))
+
+        # claim the staged file, so finishing twice can't attach it twice
+        path = uploads.finishing_path(self.token)
+        try:
+            os.rename(uploads.staging_path(self.token), path)
+        except OSError:
+            raise uploads.UploadError("The upload is already being finished")
+
+        try:
+            with open(path, 'rb') as staged:
+                digest = ingest.Digest()
+                for chunk in ingest.read_chunks(staged, ingest.get_chunk_size()):
+                    digest.update(chunk)
+                if digest.size != self.size or (self.content_hash and digest.content_hash != self.content_hash):
+                    raise uploads.UploadError("%s was corrupted in transit" % self.file_name)
+
+                # sniffing and storage expect a django File
+                payload = File(staged, name=self.file_name)
+                payload.seek(0)
+                if not Attachment().get_mime_type(self.file_name, payload):
+                    raise uploads.UploadError("%s has an unsupported file type" % self.file_name)
+
+                attachment = Attachment(content_type_id=self.content_type_id, object_id=self.object_id,
+                                        tag=self.tag, description=self.description, attachment=payload)
+                attachment.save()
+        except uploads.UploadError:
+            self.delete()
+            raise
+        except Exception:
+            # e.g. storage trouble; the file is fine, so it can be finished again
+            os.rename(path, uploads.staging_path(self.token))
+            raise
+        self.delete()
+        return attachment
+
+    def delete(self, using=None):
+        super(UploadSession, self).delete(using)
+        uploads.delete_staging_file(self.token)
@@ -0,0 +1,101 @@
+import os
+import threading
+import urllib
+
+from django import http
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from attachments.utils import get_class
+
+DEFAULT_OFFLOADERS = {
+    'x-sendfile': 'attachments.offload.XSendfile',
+    'x-accel-redirect': 'attachments.offload.XAccelRedirect',
+}
+
+
+class BaseOffloader(object):
+    """
+    Hands local files to the front-end web server: the response only carries a
+    header naming the file, and the server sends the bytes (and answers Range
+    requests) without tying up a Django worker.
+    """
+    header = None
+
+    def location(self, path):
+        """
+        What to put in the header for path, or None when the front-end server
+        can't reach it and the file has to be streamed by Django.
+        """
+        raise NotImplementedError
+
+    def response(self, path, mimetype):
+        location = self.location(path)
+        if location is None:
+            return None
+        response = http.HttpResponse('', mimetype=mimetype)
+        response[self.header] = location
+        return response
+
+
+class XSendfile(BaseOffloader):
+    """
+    For Apache's mod_xsendfile and lighttpd, which take the file's own path.
+    """
+    header = 'X-Sendfile'
+
+    def location(self, path):
+        return os.path.abspath(path)
+
+
+class XAccelRedirect(BaseOffloader):
+    """
+    For nginx, which takes the URI of an internal location.
+    ATTACHMENTS_OFFLOAD_LOCATIONS maps directories to those URIs, e.g.
+    {'/var/attachments/files': '/protected/files/'}.
+    """
+    header = 'X-Accel-Redirect'
+
+    def __init__(self):
+        locations = getattr(settings, 'ATTACHMENTS_OFFLOAD_LOCATIONS', {})
+        if not locations:
+            raise ImproperlyConfigured("X-Accel-Redirect offloading requires ATTACHMENTS_OFFLOAD_LOCATIONS.")
+        self.locations = [(os.path.join(os.path.abspath(directory), ''), uri.rstrip('/') + '/')
+                          for directory, uri in locations.items()]
+
+    def location(self, path):
+        path = os.path.abspath(path)
+        for directory, uri in self.locations:
+            if path.startswith(directory):
+                return uri + urllib.quote(path[len(directory):].replace(os.sep, '/'))
+        return None
+
+_offloaders = {}
+_offloaders_lock = threading.Lock()
+
+
+def get_offloader():
+    """
+    The offloader named by ATTACHMENTS_OFFLOAD ('x-sendfile',
+    'x-accel-redirect' or a dotted path), or None when Django streams files
+    itself.
+    """
+    name = getattr(settings, 'ATTACHMENTS_OFFLOAD', None)
+    if not name:
+        return None
+
+    with _offloaders_lock:
+        if name not in _offloaders:
+            _offloaders[name] = get_class(DEFAULT_OFFLOADERS.get(name, name))()
+        return _offloaders[name]
+
+
+def offload(path, mimetype):
+    """
+    A response handing path to the front-end server, or None when the file
+    has to be streamed by Django instead.
+    """
+    offloader = get_offloader()
+    if offloader is None or not path:
+        return None
+    return offloader.response(path, mimetype)
@@ -0,0 +1,670 @@
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from StringIO import StringIO
+from contextlib import contextmanager
+
+from PIL import Image, ImageOps
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError
+
+from attachments import instrumentation
+from attachments.utils import ensure_directory, get_class
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_STORE = 'attachments.renditions.CacheStore'
+THUMBNAIL_SIZE = 100
+PREVIEW_SIZE = 550
+
+DEFAULT_RENDITIONS = {
+    'thumbnail': {'size': THUMBNAIL_SIZE},
+    'preview': {'size': PREVIEW_SIZE},
+}
+
+# seconds a process waits for another to generate a rendition (ATTACHMENTS_RENDITION_LOCK_TIMEOUT)
+DEFAULT_LOCK_TIMEOUT = 30
+LOCK_POLL_INTERVAL = 0.05
+
+# seconds a request waits for a rendering slot before it is turned away (ATTACHMENTS_RENDER_TIMEOUT)
+DEFAULT_RENDER_TIMEOUT = 5
+
+# renditions generated at once by each process (ATTACHMENTS_RENDER_CONCURRENCY); the bound is per
+# process, so a server with N worker processes may still generate N at a time, and it only leaves
+# threads free to serve other requests when it is below the threads per process
+DEFAULT_RENDER_CONCURRENCY = 1
+
+# reduce() (Pillow 7+) refuses palette and bilevel images; thumbnail() copes with them
+UNREDUCIBLE_MODES = ('P', '1')
+
+# decoding more pixels than this raises ImageTooLarge (ATTACHMENTS_MAX_IMAGE_PIXELS)
+DEFAULT_MAX_PIXELS = 50 * 1000 * 1000
+
+# in order of preference; clients that accept neither get the original format
+DEFAULT_PROFILES = (
+    {'format': 'webp', 'quality': 80},
+    {'format': 'jpeg', 'quality': 85, 'progressive': True, 'optimize': True},
+)
+
+ORIGINAL = 'original'
+
+FORMAT_MIMETYPES = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+}
+
+PIL_FORMATS = {
+    'image/jpeg': 'JPEG',
+    'image/png': 'PNG',
+    'image/gif': 'GIF',
+    'image/webp': 'WEBP',
+    'image/x-ms-bmp': 'BMP',
+}
+
+# only these are served to clients whose Accept header merely has image/* or */*;
+# browsers without webp support send those too
+WILDCARD_MIMETYPES = ('image/jpeg', 'image/png', 'image/gif')
+
+
+class RenditionStats(object):
+    """
+    Per-process hit/miss counters for the rendition cache, plus how many
+    requests reused a rendition another request was generating (coalesced)
+    and how many were refused because every rendering slot stayed busy.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.coalesced = 0
+            self.rejected = 0
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def coalesce(self):
+        with self._lock:
+            self.coalesced += 1
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'rejected': self.rejected}
+
+stats = RenditionStats()
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+class RenderingBusy(Exception):
+    """
+    Every rendering slot stayed taken for ATTACHMENTS_RENDER_TIMEOUT seconds.
+    """
+
+
+class RenderSlots(object):
+    """
+    Bounds how many renditions one process (not the whole server) generates
+    at once. Resizing is CPU bound, so more of it at a time only makes each
+    request slower; a caller that can't get a slot in time gives up instead
+    of holding its worker.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.busy = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout):
+        deadline = time.time() + timeout
+        with self._condition:
+            while self.busy >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self.busy += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.busy -= 1
+            self._condition.notify()
+
+_slots = None
+_slots_lock = threading.Lock()
+
+
+def get_render_slots():
+    global _slots
+    with _slots_lock:
+        size = getattr(settings, 'ATTACHMENTS_RENDER_CONCURRENCY', None) or DEFAULT_RENDER_CONCURRENCY
+        if _slots is None or _slots.size != size:
+            _slots = RenderSlots(size)
+        return _slots
+
+
+class Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs a function once per key at a time: callers arriving while it runs for
+    their key wait for it and share its result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, function):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            with instrumentation.stage('coalesce'):
+                flight.done.wait()
+            stats.coalesce()
+            instrumentation.record('cache', 'coalesced')
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+flights = SingleFlight()
+
+
+def render(attachment, max_size, profile=None, crop=False):
+    """
+    attachment.create_thumbnail() in one of the process's rendering slots,
+    raising RenderingBusy when none frees up in time.
+    """
+    slots = get_render_slots()
+    with instrumentation.stage('queue'):
+        acquired = slots.acquire(getattr(settings, 'ATTACHMENTS_RENDER_TIMEOUT', DEFAULT_RENDER_TIMEOUT))
+    if not acquired:
+        stats.reject()
+        raise RenderingBusy("No rendering slot for attachment %s" % attachment.pk)
+    try:
+        return attachment.create_thumbnail(max_size, profile, crop)
+    finally:
+        slots.release()
+
+
+def fit(size, max_size, crop=False):
+    """
+    The size an image is scaled to, to fit within max_size square or, when
+    cropping, to cover it. Images are never scaled up.
+    """
+    width, height = size
+    scale = (max if crop else min)(float(max_size) / width, float(max_size) / height)
+    scale = min(scale, 1.0)
+    return max(int(width * scale), 1), max(int(height * scale), 1)
+
+
+def downscale(stream, max_size, crop=False):
+    """
+    Decodes the image in stream to fit within max_size square (or, with crop,
+    to fill it, cutting off the overflow from the center), decoding as few
+    pixels as possible: JPEGs are decoded at 1/2, 1/4 or 1/8 scale straight
+    from their DCT coefficients, and where PIL has reduce() other formats are
+    shrunk by a whole factor before the final ANTIALIAS resample. Raises
+    ImageTooLarge rather than decode more than ATTACHMENTS_MAX_IMAGE_PIXELS,
+    and applies the EXIF orientation.
+    """
+    with instrumentation.stage('decode'):
+        image = Image.open(stream)
+        target = fit(image.size, max_size, crop)
+        side = min((max_size,) + image.size)
+        image.draft(image.mode, target)
+
+        max_pixels = getattr(settings, 'ATTACHMENTS_MAX_IMAGE_PIXELS', DEFAULT_MAX_PIXELS)
+        width, height = image.size
+        if max_pixels and width * height > max_pixels:
+            raise ImageTooLarge("A %sx%s image is over the %s pixel limit" % (width, height, max_pixels))
+        image.load()
+
+    with instrumentation.stage('resize'):
+        # leave at least twice the target size for the resample to work from
+        factor = min(width // (target[0] * 2), height // (target[1] * 2))
+        if factor > 1 and hasattr(image, 'reduce') and image.mode not in UNREDUCIBLE_MODES:
+            image = image.reduce(factor)
+
+        if crop:
+            image = ImageOps.fit(image, (side, side), Image.ANTIALIAS)
+        else:
+            image.thumbnail((max_size, max_size), Image.ANTIALIAS)
+        if hasattr(ImageOps, 'exif_transpose'):
+            image = ImageOps.exif_transpose(image)
+    return image
+
+
+class Profile(object):
+    """
+    How renditions are encoded: an output format ('original' keeps the source
+    format) plus PIL save options such as quality, optimize and progressive.
+    """
+
+    def __init__(self, format=ORIGINAL, **options):
+        self.format = format.lower()
+        self.options = options
+
+    @property
+    def is_original(self):
+        return self.format == ORIGINAL
+
+    def mimetype(self, source_mimetype):
+        return source_mimetype if self.is_original else FORMAT_MIMETYPES[self.format]
+
+    def key(self, source_mimetype):
+        """
+        The format part of the rendition's store key, which changes with the options.
+        """
+        format = self.mimetype(source_mimetype).split('/')[1]
+        if not self.options:
+            return format
+        return '%s.%s' % (format, hashlib.md5(repr(sorted(self.options.items()))).hexdigest()[:6])
+
+    @property
+    def available(self):
+        Image.init()
+        return self.is_original or PIL_FORMATS.get(FORMAT_MIMETYPES.get(self.format)) in Image.SAVE
+
+    def encode(self, image, source_mimetype):
+        mimetype = self.mimetype(source_mimetype)
+        pil_format = PIL_FORMATS.get(mimetype, mimetype.split('/')[1].upper())
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+            image = flatten(image)
+        elif pil_format == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+
+        with instrumentation.stage('encode'):
+            output = StringIO()
+            image.save(output, pil_format, **self.options)
+            return output.getvalue()
+
+
+def flatten(image):
+    """
+    Composites an image with transparency onto white, for formats without an alpha channel.
+    """
+    image = image.convert('RGBA')
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.split()[3])
+    return background
+
+
+class NamedRendition(object):
+    """
+    A rendition size clients can ask for by name: its max_size, whether it is
+    fitted within or cropped to that square, and optionally a fixed format
+    (with save options) instead of one negotiated from the Accept header.
+    """
+    MODES = ('fit', 'crop')
+
+    def __init__(self, name, size, mode='fit', format=None, **options):
+        if mode not in self.MODES:
+            raise ImproperlyConfigured("Rendition %r has unknown mode %r" % (name, mode))
+        self.name = name
+        self.size = int(size)
+        self.crop = mode == 'crop'
+        self.profile = Profile(format, **options) if format else None
+
+
+def get_named_renditions():
+    """
+    The built in thumbnail and preview renditions plus ATTACHMENTS_RENDITIONS,
+    a dict of names to NamedRendition arguments, e.g.
+    {'square': {'size': 200, 'mode': 'crop', 'format': 'jpeg', 'quality': 70}}.
+    """
+    named = dict(DEFAULT_RENDITIONS, **getattr(settings, 'ATTACHMENTS_RENDITIONS', {}))
+    return dict((name, NamedRendition(name, **options)) for name, options in named.items())
+
+
+def get_named_rendition(name):
+    return get_named_renditions().get(name)
+
+
+def get_profiles():
+    return [Profile(**options) for options in getattr(settings, 'ATTACHMENTS_RENDITION_PROFILES', DEFAULT_PROFILES)]
+
+
+def parse_accept(accept):
+    """
+    Returns a dict of each media range in an Accept header to its quality.
+    """
+    accepted = {}
+    for item in accept.split(','):
+        parameters = item.split(';')
+        media_range = parameters[0].strip().lower()
+        quality = 1.0
+        for parameter in parameters[1:]:
+            name, _, value = parameter.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_range:
+            accepted[media_range] = quality
+    return accepted
+
+
+def accepts(accepted, mimetype):
+    if mimetype in accepted:
+        return accepted[mimetype] > 0
+    if mimetype not in WILDCARD_MIMETYPES:
+        return False
+
+    wildcard = mimetype.split('/')[0] + '/*'
+    if wildcard in accepted:
+        return accepted[wildcard] > 0
+    return accepted.get('*/*', 0) > 0
+
+
+def negotiate(attachment, accept):
+    """
+    The first configured profile whose format the client accepts, going by its
+    Accept header, or the original format when it accepts none of them.
+    """
+    accepted = parse_accept(accept or '*/*')
+    for profile in get_profiles():
+        if profile.available and accepts(accepted, profile.mimetype(attachment.mimetype)):
+            return profile
+    return Profile(ORIGINAL)
+
+
+@contextmanager
+def no_lock():
+    yield
+
+
+class BaseStore(object):
+    """
+    A rendition store keeps generated thumbnails/previews keyed by
+    (attachment pk, size, format) and can drop every rendition of an attachment.
+    Stores shared between processes can also lock a key while one process
+    generates its rendition.
+    """
+
+    def lock(self, pk, size, format):
+        return no_lock()
+
+    def get(self, pk, size, format):
+        raise NotImplementedError
+
+    def set(self, pk, size, format, data):
+        raise NotImplementedError
+
+    def invalidate(self, pk):
+        raise NotImplementedError
+
+
+class CacheStore(BaseStore):
+    """
+    Stores renditions in a django cache. Each attachment has a generation token
+    that is part of every key, so invalidating only has to replace the token.
+    """
+
+    def __init__(self):
+        self.cache = get_cache(getattr(settings, 'ATTACHMENTS_RENDITION_CACHE', 'default'))
+        self.timeout = getattr(settings, 'ATTACHMENTS_RENDITION_CACHE_TIMEOUT', None)
+
+    def _generation_key(self, pk):
+        return 'attachments:rendition:%s:generation' % pk
+
+    def _generation(self, pk):
+        key = self._generation_key(pk)
+        generation = self.cache.get(key)
+        if generation is None:
+            self.cache.add(key, uuid.uuid4().hex, self.timeout)
+            generation = self.cache.get(key)
+        return generation
+
+    def _key(self, pk, size, format):
+        return 'attachments:rendition:%s:%s:%s:%s' % (pk, self._generation(pk), size, format)
+
+    def get(self, pk, size, format):
+        return self.cache.get(self._key(pk, size, format))
+
+    def set(self, pk, size, format, data):
+        self.cache.set(self._key(pk, size, format), data, self.timeout)
+
+    def invalidate(self, pk):
+        self.cache.set(self._generation_key(pk), uuid.uuid4().hex, self.timeout)
+
+    @contextmanager
+    def lock(self, pk, size, format):
+        # cache.add() only succeeds for one process; the others poll until the
+        # rendition shows up, or give up waiting and generate it themselves
+        key = self._key(pk, size, format)
+        timeout = getattr(settings, 'ATTACHMENTS_RENDITION_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT)
+        deadline = time.time() + timeout
+        acquired = self.cache.add(key + ':lock', 1, timeout)
+        while not acquired and time.time() < deadline and self.cache.get(key) is None:
+            time.sleep(LOCK_POLL_INTERVAL)
+            acquired = self.cache.add(key + ':lock', 1, timeout)
+        try:
+            yield
+        finally:
+            if acquired:
+                self.cache.delete(key + ':lock')
+
+
+class FileSystemStore(BaseStore):
+    """
+    Stores renditions on local disk as <root>/<pk>/<size>.<format>.
+    """
+
+    def __init__(self):
+        self.root = getattr(settings, 'ATTACHMENTS_RENDITION_ROOT', None) or \
+            os.path.join(settings.MEDIA_ROOT, 'attachments', 'renditions')
+
+    def _directory(self, pk):
+        return os.path.join(self.root, str(pk))
+
+    def path(self, pk, size, format):
+        return os.path.join(self._directory(pk), '%s.%s' % (size, format))
+
+    def get(self, pk, size, format):
+        try:
+            with open(self.path(pk, size, format), 'rb') as rendition:
+                return rendition.read()
+        except IOError:
+            return None
+
+    def set(self, pk, size, format, data):
+        directory = self._directory(pk)
+        ensure_directory(directory)
+
+        # write to a temporary file first so readers never see a partial rendition
+        handle, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, 'wb') as temp_file:
+            temp_file.write(data)
+        os.rename(temp_path, self.path(pk, size, format))
+
+    def invalidate(self, pk):
+        shutil.rmtree(self._directory(pk), ignore_errors=True)
+
+    @contextmanager
+    def lock(self, pk, size, format):
+        if fcntl is None:
+            yield
+            return
+
+        # like CacheStore.lock(), waiters poll rather than block, so a stuck
+        # generator holds them up for ATTACHMENTS_RENDITION_LOCK_TIMEOUT at most
+        ensure_directory(self._directory(pk))
+        path = self.path(pk, size, format)
+        deadline = time.time() + getattr(settings, 'ATTACHMENTS_RENDITION_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT)
+        with open(path + '.lock', 'a') as lock_file:
+            acquired = self._try_lock(lock_file)
+            while not acquired and time.time() < deadline and not os.path.exists(path):
+                time.sleep(LOCK_POLL_INTERVAL)
+                acquired = self._try_lock(lock_file)
+            try:
+                yield
+            finally:
+                if acquired:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _try_lock(self, lock_file):
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+
+
+class DatabaseStore(BaseStore):
+    """
+    Stores renditions in the attachments_rendition table.
+    """
+
+    @property
+    def model(self):
+        from attachments.models import Rendition
+        return Rendition
+
+    def get(self, pk, size, format):
+        data = self.model.objects.filter(attachment_id=pk, size=str(size), format=format).values_list('data', flat=True)
+        return self.model._meta.get_field('data').to_python(data[0]) if data else None
+
+    def set(self, pk, size, format, data):
+        try:
+            self.model.objects.create(attachment_id=pk, size=str(size), format=format, data=data)
+        except IntegrityError:
+            # another request stored the same rendition first
+            pass
+
+    def invalidate(self, pk):
+        self.model.objects.filter(attachment_id=pk).delete()
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Returns the store configured by ATTACHMENTS_RENDITION_STORE, or None when
+    rendition caching has been turned off.
+    """
+    path = getattr(settings, 'ATTACHMENTS_RENDITION_STORE', DEFAULT_STORE)
+    if not path:
+        return None
+
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = get_class(path)()
+        return _stores[path]
+
+
+def _key(attachment, max_size, profile, crop):
+    # the (size, format) a rendition is stored under
+    size = '%sc' % max_size if crop else max_size
+    return size, (profile or Profile(ORIGINAL)).key(attachment.mimetype)
+
+
+def get_rendition(attachment, max_size, profile=None, crop=False):
+    profile = profile or Profile(ORIGINAL)
+    size, format = _key(attachment, max_size, profile, crop)
+    store = get_store()
+    if store is None:
+        data = render(attachment, max_size, profile, crop)
+        instrumentation.record('rendition_bytes', len(data))
+        return data
+
+    with instrumentation.stage('store'):
+        data = store.get(attachment.pk, size, format)
+    if data is None:
+        stats.miss()
+        instrumentation.record('cache', 'miss')
+        # concurrent requests for the same rendition wait for one to generate it
+        data = flights.do((attachment.pk, size, format),
+                          lambda: _generate(store, attachment, max_size, profile, crop, size, format))
+    else:
+        stats.hit()
+        instrumentation.record('cache', 'hit')
+    instrumentation.record('rendition_bytes', len(data))
+    return data
+
+
+def _generate(store, attachment, max_size, profile, crop, size, format):
+    locking = getattr(settings, 'ATTACHMENTS_RENDITION_LOCKING', False)
+    with store.lock(attachment.pk, size, format) if locking else no_lock():
+        # another process may have stored it while this one waited for the lock
+        data = store.get(attachment.pk, size, format) if locking else None
+        if data is None:
+            data = render(attachment, max_size, profile, crop)
+            with instrumentation.stage('store_write'):
+                store.set(attachment.pk, size, format, data)
+        else:
+            stats.coalesce()
+            instrumentation.record('cache', 'coalesced')
+    return data
+
+
+def get_rendition_path(attachment, max_size, profile=None, crop=False):
+    """
+    The local file of an already generated rendition, when the store keeps
+    renditions on disk, or None.
+    """
+    store = get_store()
+    if not hasattr(store, 'path'):
+        return None
+    path = store.path(attachment.pk, *_key(attachment, max_size, profile, crop))
+    return path if os.path.isfile(path) else None
+
+
+def invalidate(pk):
+    store = get_store()
+    if pk is not None and store is not None:
+        store.invalidate(pk)
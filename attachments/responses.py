@@ -0,0 +1,224 @@
+import calendar
+import hashlib
+import re
+import time
+from StringIO import StringIO
+
+from django import http
+from django.conf import settings
+from django.utils import timezone
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+
+from attachments import instrumentation
+from attachments import offload
+from attachments import renditions
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_AGE = 60 * 60
+# what browsers treat as forever
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+VERSION_LENGTH = 12
+BUSY_RETRY_AFTER = 1
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def get_etag(attachment):
+    if attachment.content_hash:
+        return attachment.content_hash
+    # rows stored before content hashes existed
+    return '%s-%s' % (attachment.pk, get_last_modified(attachment))
+
+
+def get_version(attachment):
+    """
+    A short token that changes whenever the payload does, for ?v= in URLs.
+    """
+    if attachment.content_hash:
+        return attachment.content_hash[:VERSION_LENGTH]
+    return get_etag(attachment)
+
+
+def get_rendition_version(attachment, named):
+    """
+    Like get_version(), but also changes with the rendition's size and mode and
+    with the options of every profile it may be encoded with, so changing
+    ATTACHMENTS_RENDITIONS or ATTACHMENTS_RENDITION_PROFILES changes its URL.
+    """
+    profiles = [named.profile] if named.profile else renditions.get_profiles() + [renditions.Profile()]
+    keys = [get_rendition_etag(attachment, named, profile) for profile in profiles]
+    return hashlib.md5(' '.join(keys)).hexdigest()[:VERSION_LENGTH]
+
+
+def get_rendition_etag(attachment, named, profile):
+    return '%s-%s%s-%s' % (get_etag(attachment), named.size, 'c' if named.crop else '',
+                           profile.key(attachment.mimetype))
+
+
+def get_last_modified(attachment):
+    if timezone.is_aware(attachment.attached_at):
+        return calendar.timegm(attachment.attached_at.utctimetuple())
+    return int(time.mktime(attachment.attached_at.timetuple()))
+
+
+def is_not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etag in etags or '*' in etags
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and last_modified <= if_modified_since
+
+
+def set_cache_control(request, response, attachment, version=None):
+    """
+    URLs carrying the current version (of the attachment, or the one given)
+    never change what they serve, so they are cached for good; other URLs are
+    cached for ATTACHMENTS_CACHE_MAX_AGE seconds and then revalidated against
+    the ETag.
+    """
+    visibility = 'private' if getattr(settings, 'ATTACHMENTS_CACHE_PRIVATE', False) else 'public'
+    if request.GET.get('v') == (version or get_version(attachment)):
+        response['Cache-Control'] = '%s, max-age=%s, immutable' % (visibility, IMMUTABLE_MAX_AGE)
+    else:
+        max_age = getattr(settings, 'ATTACHMENTS_CACHE_MAX_AGE', DEFAULT_MAX_AGE)
+        response['Cache-Control'] = '%s, max-age=%s' % (visibility, max_age)
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = quote_etag(etag)
+    response['Last-Modified'] = http_date(last_modified)
+
+
+def parse_range(request, etag, size):
+    """
+    Returns the (start, end) byte positions requested by a single-range Range
+    header, None when the whole payload should be sent, or raises ValueError
+    when the range can't be satisfied. Multiple ranges are answered with the
+    whole payload, which HTTP allows.
+    """
+    header = request.META.get('HTTP_RANGE', '')
+    match = RANGE_RE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and etag not in parse_etags(if_range):
+        return None
+
+    first, last = match.groups()
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+
+    if start > end or start >= size:
+        raise ValueError("Unsatisfiable range %r for %s bytes" % (header, size))
+    return start, end
+
+
+def iter_payload(stream, start, length, chunk_size):
+    try:
+        stream.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = stream.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        stream.close()
+
+
+def get_size(stream):
+    if hasattr(stream, 'size'):
+        return stream.size
+    stream.seek(0, 2)
+    return stream.tell()
+
+
+def busy():
+    """
+    503 for a rendition that couldn't be generated because rendering is saturated.
+    """
+    response = http.HttpResponse("Too many renditions are being generated; try again shortly.", status=503)
+    response['Retry-After'] = str(BUSY_RETRY_AFTER)
+    return response
+
+
+def unrenderable(reason):
+    """
+    422 for a rendition of an image that is too big to decode; asking again won't help.
+    """
+    return http.HttpResponse(reason, status=422)
+
+
+def stream_payload(request, attachment, etag, get_payload):
+    instrumentation.record('payload_bytes', attachment.size)
+    with instrumentation.stage('fetch'):
+        payload = get_payload()
+    stream = StringIO(payload) if isinstance(payload, basestring) else payload
+    size = get_size(stream)
+
+    try:
+        byte_range = parse_range(request, etag, size)
+    except ValueError:
+        stream.close()
+        response = http.HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%s' % size
+        return response
+
+    start, end = byte_range or (0, size - 1)
+    chunk_size = getattr(settings, 'ATTACHMENTS_DOWNLOAD_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    response = http.HttpResponse(iter_payload(stream, start, end - start + 1, chunk_size),
+                                 mimetype=attachment.mimetype)
+    response['Content-Length'] = str(end - start + 1)
+    if byte_range:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
+    return response
+
+
+def download(request, attachment, get_payload, path=None):
+    """
+    Streams an attachment's payload in ATTACHMENTS_DOWNLOAD_CHUNK_SIZE pieces,
+    answering conditional requests with 304 and Range requests with 206.
+    get_payload is only called once the payload actually has to be sent.
+    A payload at a local path is handed to the front-end server instead
+    when ATTACHMENTS_OFFLOAD is on.
+    """
+    etag, last_modified = get_etag(attachment), get_last_modified(attachment)
+    if is_not_modified(request, etag, last_modified):
+        response = http.HttpResponseNotModified()
+    else:
+        response = offload.offload(path, attachment.mimetype)
+        if response is None:
+            response = stream_payload(request, attachment, etag, get_payload)
+            if response.status_code == 416:
+                return response
+
+    response['Accept-Ranges'] = 'bytes'
+    set_validators(response, etag, last_modified)
+    set_cache_control(request, response, attachment)
+    return response
+
+
+def rendition(request, attachment, named, profile, get_rendition, path=None):
+    """
+    Serves a rendition with the same validators and caching as downloads.
+    get_rendition is only called when the client's copy is out of date and
+    there is no generated rendition at path to offload.
+    """
+    etag, last_modified = get_rendition_etag(attachment, named, profile), get_last_modified(attachment)
+    mimetype = profile.mimetype(attachment.mimetype)
+    if is_not_modified(request, etag, last_modified):
+        response = http.HttpResponseNotModified()
+    else:
+        response = offload.offload(path, mimetype) or http.HttpResponse(get_rendition(), mimetype=mimetype)
+
+    set_validators(response, etag, last_modified)
+    set_cache_control(request, response, attachment, get_rendition_version(attachment, named))
+    return response
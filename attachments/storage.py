@@ -0,0 +1,323 @@
+import os
+import tempfile
+import threading
+import uuid
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError
+from django.db.models import F
+
+from attachments import ingest
+from attachments.utils import ensure_directory, get_class
+
+try:
+    import boto
+except ImportError:
+    boto = None
+
+DATABASE = 'database'
+
+DEFAULT_STORAGES = {
+    DATABASE: 'attachments.storage.DatabaseStorage',
+    'filesystem': 'attachments.storage.FileSystemStorage',
+    'shared': 'attachments.storage.SharedBlobStorage',
+    's3': 'attachments.storage.S3Storage',
+}
+
+
+class BaseStorage(object):
+    """
+    A storage backend holds attachment payloads. save() writes a payload and
+    records where it went on the attachment (storage_key, and the attachment
+    column itself for the database backend); open() returns a readable,
+    seekable file-like object for it.
+    """
+    name = None
+    # whether payloads are written in the database transaction, and so rolled back with it
+    transactional = False
+
+    def new_key(self):
+        return uuid.uuid4().hex
+
+    def save(self, attachment, source):
+        raise NotImplementedError
+
+    def open(self, attachment):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def path(self, attachment):
+        """
+        The local file system path of the payload, when there is one.
+        """
+        return None
+
+
+class DatabaseStorage(BaseStorage):
+    """
+    Keeps payloads in the attachment column of attachments_attachment.
+    """
+    name = DATABASE
+    transactional = True
+
+    def save(self, attachment, source):
+        # spool the upload while hashing it so only one full copy is ever held in memory
+        spool = tempfile.SpooledTemporaryFile(max_size=ingest.get_chunk_size())
+        digest = ingest.ingest(source, spool)
+        spool.seek(0)
+        attachment.attachment = spool.read()
+        attachment.storage_key = ''
+        spool.close()
+        return digest
+
+    def open(self, attachment):
+        if attachment.payload_loaded:
+            return StringIO(attachment.attachment)
+
+        # read the column without caching it on the instance for as long as the instance lives
+        from attachments.models import Attachment
+        data = Attachment.objects.with_payload().filter(pk=attachment.pk).values_list('attachment', flat=True)
+        if not data:
+            raise IOError("Attachment %s is missing" % attachment.pk)
+        return StringIO(Attachment._meta.get_field('attachment').to_python(data[0]) or '')
+
+    def delete(self, key):
+        # the payload goes away with its row
+        pass
+
+
+class SharedBlobStorage(BaseStorage):
+    """
+    Keeps payloads in attachments_blob, addressed by their content hash, so
+    attachments with identical payloads share one reference counted row.
+    """
+    name = 'shared'
+    transactional = True
+
+    @property
+    def model(self):
+        from attachments.models import Blob
+        return Blob
+
+    def _add_reference(self, content_hash):
+        return self.model.objects.filter(content_hash=content_hash).update(reference_count=F('reference_count') + 1)
+
+    def save(self, attachment, source):
+        spool = tempfile.SpooledTemporaryFile(max_size=ingest.get_chunk_size())
+        try:
+            digest = ingest.ingest(source, spool)
+            if not self._add_reference(digest.content_hash):
+                spool.seek(0)
+                try:
+                    self.model.objects.create(content_hash=digest.content_hash, size=digest.size,
+                                              data=spool.read(), reference_count=1)
+                except IntegrityError:
+                    # somebody stored the same payload first
+                    self._add_reference(digest.content_hash)
+        finally:
+            spool.close()
+
+        attachment.attachment = None
+        attachment.storage_key = digest.content_hash
+        return digest
+
+    def open(self, attachment):
+        data = self.model.objects.filter(content_hash=attachment.storage_key).values_list('data', flat=True)
+        if not data:
+            raise IOError("Shared payload %s is missing" % attachment.storage_key)
+        return StringIO(self.model._meta.get_field('data').to_python(data[0]))
+
+    def delete(self, key):
+        self.model.objects.filter(content_hash=key).update(reference_count=F('reference_count') - 1)
+        self.model.objects.filter(content_hash=key, reference_count__lte=0).delete()
+
+
+class FileSystemStorage(BaseStorage):
+    """
+    Keeps payloads on local disk under ATTACHMENTS_STORAGE_ROOT.
+    """
+    name = 'filesystem'
+
+    def __init__(self):
+        self.root = getattr(settings, 'ATTACHMENTS_STORAGE_ROOT', None) or \
+            os.path.join(settings.MEDIA_ROOT, 'attachments', 'files')
+
+    def key_path(self, key):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def path(self, attachment):
+        return self.key_path(attachment.storage_key)
+
+    def save(self, attachment, source):
+        key = self.new_key()
+        path = self.key_path(key)
+        ensure_directory(os.path.dirname(path))
+
+        # write to a temporary file first so readers never see a partial payload
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(handle, 'wb') as destination:
+                digest = ingest.ingest(source, destination)
+            os.rename(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        attachment.attachment = None
+        attachment.storage_key = key
+        return digest
+
+    def open(self, attachment):
+        return open(self.path(attachment), 'rb')
+
+    def delete(self, key):
+        try:
+            os.remove(self.key_path(key))
+        except OSError:
+            pass
+
+
+class S3File(object):
+    """
+    A read-only file over an S3 key. Reads stream from S3; seeking reopens the
+    key with a Range header rather than downloading what was skipped.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.size = key.size
+        self.position = 0
+        self.closed = False
+
+    def read(self, size=-1):
+        if self.position >= self.size:
+            return ''
+
+        if self.key.resp is None and self.position:
+            self.key.open_read(headers={'Range': 'bytes=%s-' % self.position})
+        # boto reads everything when asked for 0 bytes
+        data = self.key.read(size) if size > 0 else self.key.read()
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        position = {0: offset, 1: self.position + offset, 2: self.size + offset}[whence]
+        if position != self.position:
+            self.key.close()
+            self.position = position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.key.close()
+        self.closed = True
+
+
+class S3Storage(BaseStorage):
+    """
+    Keeps payloads in an S3 compatible object store (requires boto). Point
+    ATTACHMENTS_S3_CONNECTION_OPTIONS at a local stand-in such as fakes3 with
+    host, port, is_secure and calling_format.
+    """
+    name = 's3'
+
+    def __init__(self):
+        if boto is None:
+            raise ImproperlyConfigured("The s3 attachment storage requires boto.")
+
+        self.bucket_name = getattr(settings, 'ATTACHMENTS_S3_BUCKET', None)
+        if not self.bucket_name:
+            raise ImproperlyConfigured("The s3 attachment storage requires ATTACHMENTS_S3_BUCKET.")
+        self.prefix = getattr(settings, 'ATTACHMENTS_S3_PREFIX', 'attachments/')
+        self._bucket = None
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            connection = boto.connect_s3(
+                getattr(settings, 'ATTACHMENTS_S3_ACCESS_KEY', None),
+                getattr(settings, 'ATTACHMENTS_S3_SECRET_KEY', None),
+                **getattr(settings, 'ATTACHMENTS_S3_CONNECTION_OPTIONS', {})
+            )
+            self._bucket = connection.get_bucket(self.bucket_name, validate=False)
+        return self._bucket
+
+    def save(self, attachment, source):
+        spool = tempfile.SpooledTemporaryFile(max_size=ingest.get_chunk_size())
+        try:
+            digest = ingest.ingest(source, spool)
+            spool.seek(0)
+            key = self.new_key()
+            self.bucket.new_key(self.prefix + key).set_contents_from_file(
+                spool, headers={'Content-Type': attachment.mimetype or 'application/octet-stream'})
+        finally:
+            spool.close()
+
+        attachment.attachment = None
+        attachment.storage_key = key
+        return digest
+
+    def open(self, attachment):
+        key = self.bucket.get_key(self.prefix + attachment.storage_key)
+        if key is None:
+            raise IOError("Attachment payload %s is missing from S3" % attachment.storage_key)
+        return S3File(key)
+
+    def delete(self, key):
+        self.bucket.delete_key(self.prefix + key)
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage(name):
+    """
+    Returns the storage backend registered under name in ATTACHMENTS_STORAGES
+    (or the built in database, filesystem and s3 backends).
+    """
+    with _storages_lock:
+        if name not in _storages:
+            paths = dict(DEFAULT_STORAGES, **getattr(settings, 'ATTACHMENTS_STORAGES', {}))
+            if name not in paths:
+                raise ImproperlyConfigured("Unknown attachment storage %r" % name)
+            _storages[name] = get_class(paths[name])()
+        return _storages[name]
+
+
+def get_default_storage_name():
+    return getattr(settings, 'ATTACHMENTS_STORAGE', DATABASE)
+
+
+def move_payload(attachment, target):
+    """
+    Copies an attachment's payload into the target storage and then repoints
+    its row, but only if nobody replaced the payload in the meantime, so it is
+    safe to run against a live site. Returns True when the row was moved.
+    """
+    from attachments.models import Attachment
+
+    source = attachment.get_storage()
+    previous_storage, previous_key = attachment.storage, attachment.storage_key
+    previous_hash = attachment.content_hash
+
+    digest = target.save(attachment, source.open(attachment))
+    moved = Attachment.objects.filter(
+        pk=attachment.pk, storage=previous_storage, storage_key=previous_key, content_hash=previous_hash
+    ).update(
+        storage=target.name, storage_key=attachment.storage_key, attachment=attachment.attachment,
+        size=digest.size, content_hash=digest.content_hash
+    )
+
+    if moved:
+        attachment.storage = target.name
+        attachment.size, attachment.content_hash = digest.size, digest.content_hash
+        if previous_key:
+            source.delete(previous_key)
+    elif attachment.storage_key:
+        target.delete(attachment.storage_key)
+    return bool(moved)
@@ -1,17 +1,56 @@
-from django import test
-from django.core.exceptions import ValidationError
+import datetime
+import gc
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from StringIO import StringIO
+from contextlib import contextmanager
+
+from django import http, test
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test.client import RequestFactory
+from django.utils.datastructures import MultiValueDict
+from django.http import QueryDict
+from django.utils.http import http_date
+from django.test.utils import override_settings
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.db.models.sql import DeleteQuery
 from django.core.urlresolvers import reverse
-from mock import Mock, patch
+from mock import ANY, Mock, patch
 import mock
 
-from attachments.models import Attachment
+from attachments.models import Attachment, AttachmentSummary, Blob, LongBlob, UploadSession
 from sample_app.models import First, Second
 from attachments import forms
+from attachments import mime
+from attachments import offload
+from attachments import instrumentation
 from attachments import views
+from attachments import ingest
+from attachments import storage
+from attachments import responses
+from attachments import renditions
+from attachments import uploads
+from attachments import workers
 
 class AttachmentTests(test.TestCase):
 
+    def thumb_url(self, attachment):
+        version = responses.get_rendition_version(attachment, renditions.get_named_rendition('thumbnail'))
+        return "%s?v=%s" % (reverse("attachments:thumbnail", args=[attachment.pk]), version)
+
     def test_be_able_to_add_attachment_to_a_model_instance(self):
         model = First.objects.create(first_field="asdf", second_field="xyz")
         Attachment.objects.create(file_name="x.doc", attach_to=model, attachment_type=Attachment.DOCUMENT,
@@ -48,24 +87,69 @@ class AttachmentTests(test.TestCase):
 
         self.assertEqual(Attachment.get_attachments_for(second).count(), 2)
 
+    def test_filter_attachments_by_object_and_tag_in_for_object(self):
+        second = Second.objects.create(third_field="xyz")
+        other = Second.objects.create(third_field="abc")
+        scan = Attachment.objects.create(file_name="x.doc", attach_to=second, attachment="a", tag="scan")
+        Attachment.objects.create(file_name="x.doc", attach_to=second, attachment="b", tag="photo")
+        Attachment.objects.create(file_name="x.doc", attach_to=other, attachment="c", tag="scan")
+
+        self.assertEqual(2, Attachment.objects.for_object(second).count())
+        self.assertEqual([scan.pk], [a.pk for a in Attachment.objects.for_object(second, tag="scan")])
+
+    def test_return_newest_tagged_attachments_first_in_latest_for(self):
+        second = Second.objects.create(third_field="xyz")
+        scans = [Attachment.objects.create(file_name="x.doc", attach_to=second, attachment="a", tag="scan")
+                 for _ in range(3)]
+        Attachment.objects.create(file_name="x.doc", attach_to=second, attachment="b", tag="photo")
+        Attachment.objects.filter(pk=scans[0].pk).update(attached_at=datetime.datetime(2030, 1, 1))
+
+        latest = Attachment.objects.latest_for(second, "scan", count=2)
+        self.assertEqual([scans[0].pk, scans[2].pk], [a.pk for a in latest])
+        self.assertEqual(3, Attachment.objects.latest_for(second, "scan").count())
+
     def test_store_attachment_description(self):
         second = Second.objects.create(third_field="xyz")
         Attachment.objects.create(file_name="x.doc", attach_to=second, attachment="xxx",
                                   attachment_type=Attachment.DOCUMENT, description="Three x's")
         self.assertEqual(Attachment.get_attachments_for(second).count(), 1)
 
-    @patch('attachments.models.Attachment.get_attachments_for', Mock())
-    def test_get_attachment_for_model_for_each_model_in_list_in_get_attachments_for_list(self):
-        first_model, second_model = Mock(), Mock()
-        attachment = Mock()
-        Attachment.get_attachments_for.return_value = [attachment]
-        result = list(Attachment.get_attachments_for_list([first_model, second_model]))
-        self.assertEqual([
-            ((first_model,), {}),
-            ((second_model,), {}),
-        ], Attachment.get_attachments_for.call_args_list)
+    def test_yield_attachments_of_each_model_in_order_in_get_attachments_for_list(self):
+        first = First.objects.create(first_field="asdf", second_field="xyz")
+        second = Second.objects.create(third_field="xyz")
+        second_attachment = Attachment.objects.create(file_name="x.doc", attach_to=second, attachment="b")
+        first_attachment = Attachment.objects.create(file_name="x.doc", attach_to=first, attachment="a")
 
-        self.assertEqual([attachment] * 2, result)
+        result = list(Attachment.get_attachments_for_list([first, second]))
+        self.assertEqual([first_attachment.pk, second_attachment.pk], [attachment.pk for attachment in result])
+
+    def test_get_attachments_map_issues_one_query_per_content_type(self):
+        firsts = [First.objects.create(first_field="asdf", second_field="xyz") for _ in range(3)]
+        seconds = [Second.objects.create(third_field="xyz") for _ in range(3)]
+        for model in firsts + seconds:
+            Attachment.objects.create(file_name="x.doc", attach_to=model, attachment="xxx")
+        Attachment.objects.create(file_name="y.doc", attach_to=firsts[0], attachment="yyy")
+        empty = Second.objects.create(third_field="none")
+
+        with self.assertNumQueries(2):
+            attachments = Attachment.get_attachments_map(firsts + seconds + [empty])
+
+        self.assertEqual(["x.doc", "y.doc"], sorted(a.file_name for a in attachments[firsts[0]]))
+        for model in firsts[1:] + seconds:
+            self.assertEqual([model], [a.attach_to for a in attachments[model]])
+        self.assertEqual([], attachments[empty])
+
+    def test_prefetch_related_loads_attachments_without_payloads(self):
+        for _ in range(3):
+            first = First.objects.create(first_field="asdf", second_field="xyz")
+            Attachment.objects.create(file_name="x.doc", attach_to=first, attachment="xxx")
+
+        with self.assertNumQueries(2):
+            firsts = list(First.objects.prefetch_related('attachments'))
+            attachments = [attachment for owner in firsts for attachment in owner.attachments.all()]
+
+        self.assertEqual(3, len(attachments))
+        self.assertTrue(all('attachment' not in attachment.__dict__ for attachment in attachments))
 
     def test_save_timestamp_when_attachment_is_added(self):
         second = Second.objects.create(third_field="xyz")
@@ -127,13 +211,13 @@ class AttachmentTests(test.TestCase):
                                       attach_to=second, attachment="here is a dummy image blob....")
         self.assertEqual(a.mimetype, Attachment.JPG)
         self.assertEqual(a.attachment_type, Attachment.IMAGE)
-        self.assertEqual(a.thumb(), reverse("attachments:thumbnail", args=[a.pk]))
+        self.assertEqual(a.thumb(), self.thumb_url(a))
 
         a = Attachment.objects.create(file_name="something.jpeg",
                                       attach_to=second, attachment="here is a dummy image blob....")
         self.assertEqual(a.mimetype, Attachment.JPG)
         self.assertEqual(a.attachment_type, Attachment.IMAGE)
-        self.assertEqual(a.thumb(), reverse("attachments:thumbnail", args=[a.pk]))
+        self.assertEqual(a.thumb(), self.thumb_url(a))
 
     @patch('attachments.models.Attachment.create_thumbnail', Mock(return_value=None))
     def test_derive_mime_type_and_attachment_type_for_png(self):
@@ -142,7 +226,7 @@ class AttachmentTests(test.TestCase):
                                       attachment="here is a dummy image blob....")
         self.assertEqual(a.mimetype, Attachment.PNG)
         self.assertEqual(a.attachment_type, Attachment.IMAGE)
-        self.assertEqual(a.thumb(), reverse("attachments:thumbnail", args=[a.pk]))
+        self.assertEqual(a.thumb(), self.thumb_url(a))
 
     @patch('attachments.models.Attachment.create_thumbnail', Mock(return_value=None))
     def test_derive_mime_type_and_attachment_type_for_gif(self):
@@ -151,7 +235,7 @@ class AttachmentTests(test.TestCase):
                                       attach_to=second, attachment="here is a dummy image blob....")
         self.assertEqual(a.mimetype, Attachment.GIF)
         self.assertEqual(a.attachment_type, Attachment.IMAGE)
-        self.assertEqual(a.thumb(), reverse("attachments:thumbnail", args=[a.pk]))
+        self.assertEqual(a.thumb(), self.thumb_url(a))
 
     def test_derive_mime_type_and_attachment_type_for_word(self):
         second = Second.objects.create(third_field="xyz")
@@ -208,7 +292,7 @@ class AttachmentTests(test.TestCase):
                                       attach_to=second, attachment="here is a dummy image blob....")
         self.assertEqual(a.mimetype, Attachment.BMP)
         self.assertEqual(a.attachment_type, Attachment.IMAGE)
-        self.assertEqual(a.thumb(), reverse("attachments:thumbnail", args=[a.pk]))
+        self.assertEqual(a.thumb(), self.thumb_url(a))
 
     def test_require_attachment_value_when_description_is_present(self):
         form = forms.OptionalAttachmentForm({'attachment-description':"somefile.doc"}, {'attachment-attachment':''})
@@ -242,38 +326,42 @@ class AttachmentTests(test.TestCase):
         Attachment(attachment=attached_file).save()
         self.assertEqual(0, create_thumbnail.call_count)
 
-    @patch('attachments.models.StringIO')
-    @patch('attachments.models.Image')
-    def test_open_image_with_stringio_of_attachment_in_create_thumbnail(self, image_class, stringio):
+    @patch('attachments.models.Attachment.open_payload')
+    @patch('attachments.renditions.downscale')
+    def test_downscale_payload_stream_in_create_thumbnail(self, downscale, open_payload):
         attachment = Attachment(attachment=Mock())
         attachment.mimetype = "x/y"
-        attachment.create_thumbnail(max_size=100)
-        self.assertEqual(((attachment.attachment,), {}), stringio.call_args_list[0])
-        image_class.open.assert_called_once_with(stringio.return_value)
+        attachment.create_thumbnail(max_size=100, profile=Mock())
+        downscale.assert_called_once_with(open_payload.return_value, 100, False)
+        open_payload.return_value.close.assert_called_once_with()
 
-    @patch('attachments.models.Image')
-    def test_create_thumbnail_with_dimensions_and_image_mode_in_create_thumbnail(self, image):
+    @patch('attachments.models.Attachment.open_payload')
+    @patch('attachments.renditions.downscale', Mock(side_effect=IOError))
+    def test_close_payload_stream_when_image_cannot_be_read_in_create_thumbnail(self, open_payload):
         attachment = Attachment(attachment=Mock())
         attachment.mimetype = "x/y"
-        attachment.create_thumbnail(max_size=100)
-        image.open.return_value.thumbnail.assert_called_once_with((100, 100), image.ANTIALIAS)
+        self.assertRaises(IOError, attachment.create_thumbnail, max_size=100)
+        open_payload.return_value.close.assert_called_once_with()
 
-    @patch('attachments.models.Image')
-    def test_create_thumbnail_with_given_dimensions_and_image_mode_in_create_thumbnail(self, image):
+    @patch('attachments.models.Attachment.open_payload', Mock())
+    @patch('attachments.renditions.downscale')
+    def test_encode_image_with_profile_in_create_thumbnail(self, downscale):
         attachment = Attachment(attachment=Mock())
-        attachment.mimetype = "x/y"
-        attachment.create_thumbnail(max_size=2)
-        image.open.return_value.thumbnail.assert_called_once_with((2, 2), image.ANTIALIAS)
-
-    @patch('attachments.models.StringIO')
-    @patch('attachments.models.Image')
-    def test_save_image_and_return_stream_in_create_thumbnail(self, image, stringio):
-        attachment = Mock()
-        attachment = Attachment(attachment=attachment)
-        attachment.mimetype = "attachment/pdf"
+        attachment.mimetype = "image/png"
+        profile = Mock()
+        thumbnail = attachment.create_thumbnail(max_size=100, profile=profile)
+        profile.encode.assert_called_once_with(downscale.return_value, "image/png")
+        self.assertEqual(profile.encode.return_value, thumbnail)
+
+    @patch('attachments.models.Attachment.open_payload', Mock())
+    @patch('attachments.renditions.Profile.encode')
+    @patch('attachments.renditions.downscale')
+    def test_encode_image_in_original_format_without_profile_in_create_thumbnail(self, downscale, encode):
+        attachment = Attachment(attachment=Mock())
+        attachment.mimetype = "image/png"
         thumbnail = attachment.create_thumbnail(max_size=100)
-        image.open.return_value.save.assert_called_once_with(stringio.return_value, 'pdf')
-        self.assertEqual(stringio.return_value.getvalue.return_value, thumbnail)
+        encode.assert_called_once_with(downscale.return_value, "image/png")
+        self.assertEqual(encode.return_value, thumbnail)
 
     @patch('attachments.models.reverse')
     def test_return_attachments_url_for_images_in_get_sample_url(self, _reverse):
@@ -282,7 +370,28 @@ class AttachmentTests(test.TestCase):
         view_name = "some_view_name"
         url = Attachment.get_attachment_url(instance, view_name)
         _reverse.assert_called_once_with("attachments:%s" % view_name, kwargs={'identifier': instance.pk})
-        self.assertEqual(_reverse.return_value, url)
+        instance.versioned.assert_called_once_with(_reverse.return_value, None)
+        self.assertEqual(instance.versioned.return_value, url)
+
+    def test_versions_urls_with_the_content_hash(self):
+        attachment = Attachment(pk=3, content_hash="0123456789abcdef")
+        self.assertEqual("/x/?v=0123456789ab", attachment.versioned("/x/"))
+        self.assertEqual("%s?v=0123456789ab" % reverse("attachments:download", args=[3]), attachment.download_url())
+
+    def test_versions_rendition_urls_with_rendition_settings_too(self):
+        attachment = Attachment(pk=3, content_hash="0123456789abcdef", attachment_type=Attachment.IMAGE,
+                                mimetype=Attachment.PNG)
+        url = attachment.rendition_url('thumbnail')
+        self.assertEqual(url, attachment.rendition_url('thumbnail'))
+        self.assertNotEqual(url, attachment.rendition_url('preview').replace('preview', 'thumbnail'))
+        with override_settings(ATTACHMENTS_RENDITIONS={'thumbnail': {'size': 120}}):
+            self.assertNotEqual(url, attachment.rendition_url('thumbnail'))
+        with override_settings(ATTACHMENTS_RENDITION_PROFILES=({'format': 'webp', 'quality': 60},)):
+            self.assertNotEqual(url, attachment.rendition_url('thumbnail'))
+        with override_settings(ATTACHMENTS_RENDITIONS={'thumbnail': {'size': 100, 'format': 'png'}}):
+            self.assertNotEqual(url, attachment.rendition_url('thumbnail'))
+        attachment.content_hash = "fedcba9876543210"
+        self.assertNotEqual(url, attachment.rendition_url('thumbnail'))
 
     def test_call_get_attachment_url_with_thumbnail_in_thumb(self):
         instance = Mock(spec=Attachment())
@@ -297,60 +406,1305 @@ class AttachmentTests(test.TestCase):
 
 class AttachmentViewTests(test.TestCase):
 
+    @patch('attachments.views.rendition')
+    def test_delegate_renditions_to_rendition_view_in_serve(self, rendition):
+        request, identifier = Mock(), Mock()
+        result = views.serve(request, 'preview', identifier)
+        rendition.assert_called_once_with(request, 'preview', identifier)
+        self.assertEqual(rendition.return_value, result)
+
+    @patch('attachments.responses.rendition', mock.MagicMock())
+    @patch('attachments.renditions.negotiate', Mock())
     @patch('attachments.views.ImageServer', Mock())
     @patch('attachments.models.Attachment.objects')
-    def test_get_attachment_object_in_serve(self, attachment_manager):
+    def test_get_attachment_object_in_rendition(self, attachment_manager):
         identifier = Mock()
-        views.serve(Mock(), str(Mock()), identifier)
+        views.rendition(Mock(), 'thumbnail', identifier)
         attachment_manager.get.assert_called_once_with(pk=identifier)
 
+    @patch('attachments.models.Attachment.objects')
+    def test_raise_404_for_unknown_rendition_name_in_rendition(self, attachment_manager):
+        self.assertRaises(http.Http404, views.rendition, Mock(), 'original', Mock())
+        self.assertFalse(attachment_manager.get.called)
+
+    @patch('attachments.responses.rendition', mock.MagicMock())
+    @patch('attachments.renditions.negotiate')
     @patch('attachments.views.ImageServer')
     @patch('attachments.models.Attachment.objects')
-    def test_create_image_server_with_attachment_in_serve(self, attachment_manager, image_server):
+    def test_create_image_server_with_attachment_and_negotiated_profile_in_rendition(self, attachment_manager,
+                                                                                     image_server, negotiate):
         attachment = Mock()
         attachment_manager.get.return_value = attachment
-        views.serve(Mock(), str(Mock()), Mock())
-        image_server.assert_called_once_with(attachment)
-
-    @patch('attachments.models.Attachment.objects', Mock())
-    @patch('attachments.views.ImageServer')
-    def test_call_action_on_image_server(self, image_server):
-        views.serve(Mock(), 'test', Mock())
-        self.assertEqual(True, image_server.return_value.test.called)
+        request = RequestFactory().get('/', HTTP_ACCEPT='image/webp,*/*')
+        views.rendition(request, 'preview', Mock())
+        negotiate.assert_called_once_with(attachment, 'image/webp,*/*')
+        image_server.assert_called_once_with(attachment, negotiate.return_value)
 
-    @patch('django.http.HttpResponse')
+    @patch('attachments.responses.rendition')
+    @patch('attachments.renditions.negotiate')
     @patch('attachments.models.Attachment.objects.get')
     @patch('attachments.views.ImageServer')
-    def test_return_http_response_with_action_response_and_mimetype(self, image_server, get_attachment, response):
-        identifier = Mock()
-        result = views.serve(Mock(), 'test', identifier)
+    def test_delegate_response_to_rendition_response_with_negotiated_profile(self, image_server, get_attachment,
+                                                                              negotiate, response):
+        request = Mock()
+        result = views.rendition(request, 'thumbnail', Mock())
 
         attachment = get_attachment.return_value
-        file_to_serve = image_server.return_value.test.return_value
-        response.assert_called_once_with(file_to_serve, mimetype=attachment.mimetype)
+        self.assertEqual(((request, attachment, ANY, negotiate.return_value, ANY,
+                           image_server.return_value.rendition_path.return_value), {}), response.call_args)
+        self.assertEqual('thumbnail', response.call_args[0][2].name)
+        self.assertEqual(image_server.return_value.rendition.return_value, response.call_args[0][4]())
+        self.assertEqual('thumbnail', image_server.return_value.rendition.call_args[0][0].name)
+        response.return_value.__setitem__.assert_called_once_with('Vary', 'Accept')
         self.assertEqual(response.return_value, result)
 
+    @override_settings(ATTACHMENTS_RENDITIONS={'square': {'size': 64, 'mode': 'crop', 'format': 'jpeg'}})
+    @patch('attachments.renditions.negotiate')
+    @patch('attachments.models.Attachment.objects.get')
+    @patch('attachments.views.ImageServer')
+    def test_use_fixed_format_of_named_rendition_without_negotiating(self, image_server, get_attachment, negotiate):
+        image_server.return_value.rendition.return_value = 'jpeg bytes'
+        get_attachment.return_value = Attachment(pk=1, mimetype='image/png', content_hash='abc',
+                                                 attached_at=datetime.datetime(2012, 1, 1))
+        response = views.rendition(RequestFactory().get('/'), 'square', Mock())
+        self.assertFalse(negotiate.called)
+        self.assertEqual('jpeg', image_server.call_args[0][1].format)
+        self.assertEqual('image/jpeg', response['Content-Type'])
+        self.assertFalse(response.has_header('Vary'))
+
+    @patch('attachments.responses.download')
+    @patch('attachments.models.Attachment.objects.get')
+    def test_delegate_download_to_streaming_response_in_serve(self, get_attachment, download):
+        request = Mock()
+        result = views.serve(request, 'download', Mock())
+        attachment = get_attachment.return_value
+        self.assertEqual(((request, attachment, ANY, attachment.payload_path.return_value), {}), download.call_args)
+        self.assertEqual(attachment.open_payload.return_value, download.call_args[0][2]())
+        self.assertEqual(download.return_value, result)
+
+class PayloadLoadingTests(test.TestCase):
+
+    def setUp(self):
+        second = Second.objects.create(third_field="xyz")
+        self.attachment = Attachment.objects.create(file_name="x.pdf", attach_to=second,
+                                                    attachment="the payload", description="old")
+
+    def payload_queries(self, func, *args):
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            result = func(*args)
+        finally:
+            connection.use_debug_cursor = None
+        queries = [query['sql'] for query in connection.queries[start:]
+                   if '"attachments_attachment"."attachment"' in query['sql']]
+        return result, queries
+
+    def test_with_payload_reads_payload_along_with_row(self):
+        self.assertFalse(Attachment.objects.get(pk=self.attachment.pk).payload_loaded)
+        attachment = Attachment.objects.with_payload().get(pk=self.attachment.pk)
+        self.assertTrue(attachment.payload_loaded)
+        self.assertEqual("the payload", attachment.attachment)
+
+    def test_open_payload_reads_payload_without_keeping_it_on_instance(self):
+        attachment = Attachment.objects.get(pk=self.attachment.pk)
+        self.assertEqual("the payload", attachment.open_payload().read())
+        self.assertFalse(attachment.payload_loaded)
+
+    def test_saving_metadata_does_not_read_payload(self):
+        attachment = Attachment.objects.get(pk=self.attachment.pk)
+        attachment.description = "new"
+        _, queries = self.payload_queries(attachment.save)
+        self.assertEqual([], queries)
+
+        attachment = Attachment.objects.with_payload().get(pk=self.attachment.pk)
+        self.assertEqual(("new", "the payload"), (attachment.description, attachment.attachment))
+
+    def test_edit_description_updates_row_in_one_query(self):
+        request = RequestFactory().post('/', {'id': self.attachment.pk, 'description': "new"})
+        with self.assertNumQueries(1):
+            views.edit_description(request)
+        self.assertEqual("new", Attachment.objects.get(pk=self.attachment.pk).description)
+
+    def test_delete_attachment_does_not_read_payload(self):
+        request = RequestFactory().post('/', {'id': self.attachment.pk})
+        _, queries = self.payload_queries(views.delete_attachment, request)
+        self.assertEqual([], queries)
+        self.assertFalse(Attachment.objects.filter(pk=self.attachment.pk).exists())
+
+    def test_serve_answers_conditional_request_without_reading_payload(self):
+        request = RequestFactory().get('/', HTTP_IF_NONE_MATCH='"%s"' % self.attachment.content_hash)
+        response, queries = self.payload_queries(views.serve, request, 'download', self.attachment.pk)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual([], queries)
+
+class BulkAttachTests(test.TestCase):
+
+    def uploads(self, *names):
+        return [SimpleUploadedFile(name, "payload of %s" % name) for name in names]
+
+    def count_inserts(self, func, *args, **kwargs):
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            connection.use_debug_cursor = None
+        inserts = [query for query in connection.queries[start:]
+                   if query['sql'].startswith('INSERT INTO "attachments_attachment"')]
+        return result, len(inserts)
+
+    def test_attaches_files_in_batched_inserts(self):
+        second = Second.objects.create(third_field="xyz")
+        uploads = self.uploads("a.pdf", "b.doc", "c.pdf", "a.pdf", "e.pdf")
+        results, inserts = self.count_inserts(Attachment.objects.bulk_attach, second, uploads,
+                                              tag="scan", batch_size=2)
+
+        self.assertEqual(3, inserts)
+        self.assertTrue(all(result.ok for result in results))
+        self.assertEqual(["a.pdf", "b.doc", "c.pdf", "a.pdf", "e.pdf"], [r.attachment.file_name for r in results])
+        self.assertEqual(5, len(set(result.attachment.pk for result in results)))
+        for result in results:
+            attachment = Attachment.objects.get(pk=result.attachment.pk)
+            self.assertEqual(("scan", "payload of " + result.file_name),
+                             (attachment.tag, attachment.open_payload().read()))
+        self.assertEqual(5, AttachmentSummary.objects.for_object(second).count)
+
+    def test_reports_unsupported_files_and_attaches_the_rest(self):
+        second = Second.objects.create(third_field="xyz")
+        results = Attachment.objects.bulk_attach(second, self.uploads("a.pdf", "b.exe"))
+
+        self.assertEqual([True, False], [result.ok for result in results])
+        self.assertEqual("b.exe has an unsupported file type", results[1].error)
+        self.assertEqual([results[0].attachment.pk], [a.pk for a in Attachment.objects.for_object(second)])
+
+    def test_removes_stored_payloads_when_insert_fails(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        second = Second.objects.create(third_field="xyz")
+
+        with self.settings(ATTACHMENTS_STORAGE='filesystem', ATTACHMENTS_STORAGE_ROOT=root):
+            with patch.dict('attachments.storage._storages', clear=True):
+                with patch('attachments.models.AttachmentManager.bulk_create', Mock(side_effect=IOError)):
+                    self.assertRaises(IOError, Attachment.objects.bulk_attach, second, self.uploads("a.pdf"))
+
+        self.assertEqual([], [files for _, _, files in os.walk(root) if files])
+
+    def test_lets_go_of_payloads_of_inserted_batches(self):
+        second = Second.objects.create(third_field="xyz")
+        batches = []
+
+        def bulk_create(objs):
+            # by the time the next batch is inserted the previous one's payloads are only in the database
+            gc.collect()
+            self.assertEqual([], [ref() for refs in batches for ref in refs if ref() is not None])
+            batches.append([weakref.ref(obj) for obj in objs])
+            return bulk_create.original(objs)
+
+        bulk_create.original = Attachment.objects.bulk_create
+        with patch.object(Attachment.objects, 'bulk_create', bulk_create):
+            results = Attachment.objects.bulk_attach(second, self.uploads("a.pdf", "b.pdf", "c.pdf"), batch_size=1)
+        self.assertEqual(3, len(batches))
+        self.assertTrue(all(result.ok for result in results))
+
+    def test_multiple_attachment_form_rejects_all_files_when_one_is_unsupported(self):
+        files = MultiValueDict({'attachment-attachments': self.uploads("a.pdf", "b.exe", "c.zip")})
+        form = forms.MultipleAttachmentForm(data={}, files=files)
+        self.assertFalse(form.is_valid())
+        self.assertEqual(["b.exe has an unsupported file type", "c.zip has an unsupported file type"],
+                         form.errors['attachments'])
+
+    def test_multiple_attachment_form_attaches_every_file(self):
+        second = Second.objects.create(third_field="xyz")
+        files = MultiValueDict({'attachment-attachments': self.uploads("a.pdf", "b.pdf")})
+        form = forms.MultipleAttachmentForm(data={'attachment-tag': "scan"}, files=files)
+        self.assertTrue(form.is_valid())
+
+        results = form.save(second)
+        self.assertEqual(["a.pdf", "b.pdf"], [result.attachment.file_name for result in results])
+        self.assertEqual(2, Attachment.objects.for_object(second, tag="scan").count())
+
+    def test_multiple_attachment_form_requires_a_file(self):
+        form = forms.MultipleAttachmentForm(data={}, files=MultiValueDict())
+        self.assertFalse(form.is_valid())
+        self.assertIn('attachments', form.errors)
+
+class BulkChangeTests(test.TestCase):
+
+    def setUp(self):
+        self.second = Second.objects.create(third_field="xyz")
+        self.other = Second.objects.create(third_field="abc")
+        self.attachments = [Attachment.objects.create(file_name="x.pdf", attach_to=self.second,
+                                                      attachment="payload %s" % i, tag="scan")
+                            for i in range(5)]
+        self.kept = Attachment.objects.create(file_name="y.pdf", attach_to=self.other, attachment="kept", tag="scan")
+
+    def pks(self, queryset):
+        return sorted(queryset.values_list('pk', flat=True))
+
+    @override_settings(ATTACHMENTS_BULK_BATCH_SIZE=2)
+    @patch('attachments.renditions.invalidate')
+    def test_bulk_delete_removes_listed_attachments_in_batches(self, invalidate):
+        pks = [attachment.pk for attachment in self.attachments[:3]] + [self.kept.pk]
+        with patch('attachments.models.DeleteQuery.delete_batch', autospec=True,
+                   side_effect=DeleteQuery.delete_batch) as delete_batch:
+            self.assertEqual(4, Attachment.objects.bulk_delete(pks))
+
+        self.assertEqual(2, len([args for args, kwargs in delete_batch.call_args_list if args[0].model is Attachment]))
+        self.assertEqual(self.pks(Attachment.objects.filter(pk__in=[a.pk for a in self.attachments[3:]])),
+                         self.pks(Attachment.objects.all()))
+        self.assertEqual(sorted(pks), sorted(args[0] for args, kwargs in invalidate.call_args_list))
+        self.assertEqual(2, AttachmentSummary.objects.for_object(self.second).count)
+        self.assertEqual(0, AttachmentSummary.objects.for_object(self.other).count)
+
+    def test_bulk_delete_releases_stored_payloads(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        with self.settings(ATTACHMENTS_STORAGE='filesystem', ATTACHMENTS_STORAGE_ROOT=root):
+            with patch.dict('attachments.storage._storages', clear=True):
+                attachment = Attachment.objects.create(file_name="z.pdf", attach_to=self.other, attachment="on disk")
+                path = attachment.get_storage().path(attachment)
+                Attachment.objects.bulk_delete([attachment.pk])
+        self.assertFalse(os.path.exists(path))
+
+    def test_delete_for_object_only_deletes_that_objects_attachments(self):
+        Attachment.objects.filter(pk=self.attachments[0].pk).update(tag="photo")
+        self.assertEqual(4, Attachment.objects.delete_for_object(self.second, tag="scan"))
+        self.assertEqual([self.attachments[0].pk, self.kept.pk], self.pks(Attachment.objects.all()))
+
+        self.assertEqual(1, Attachment.objects.delete_for_object(self.second))
+        self.assertEqual([self.kept.pk], self.pks(Attachment.objects.all()))
+
+    @override_settings(ATTACHMENTS_BULK_BATCH_SIZE=2)
+    def test_retag_updates_matching_attachments(self):
+        content_type = ContentType.objects.get_for_model(self.second)
+        retagged = Attachment.objects.retag("merged", content_type__pk=content_type.pk, object_id=self.second.pk)
+        self.assertEqual(5, retagged)
+        self.assertEqual(5, Attachment.objects.for_object(self.second, tag="merged").count())
+        self.assertEqual("scan", Attachment.objects.get(pk=self.kept.pk).tag)
+
+    def test_refuses_to_select_every_attachment(self):
+        self.assertRaises(ValueError, Attachment.objects.bulk_delete)
+        self.assertRaises(ValueError, Attachment.objects.retag, "merged")
+        self.assertEqual(6, Attachment.objects.count())
+
+    def test_bulk_delete_view_deletes_listed_ids(self):
+        request = RequestFactory().post('/', {'id': [self.attachments[0].pk, self.kept.pk]})
+        response = views.bulk_delete(request)
+        self.assertEqual('{"deleted": 2}', response.content)
+        self.assertEqual(4, Attachment.objects.count())
+
+    def test_retag_view_retags_one_objects_tagged_attachments(self):
+        content_type = ContentType.objects.get_for_model(self.second)
+        request = RequestFactory().post('/', {'content_type': content_type.pk, 'object_id': self.second.pk,
+                                              'from_tag': "scan", 'tag': "merged"})
+        response = views.retag(request)
+        self.assertEqual('{"retagged": 5}', response.content)
+        self.assertEqual(5, Attachment.objects.filter(tag="merged").count())
+
+    def test_bulk_views_reject_requests_without_a_selection(self):
+        self.assertEqual(400, views.bulk_delete(RequestFactory().post('/', {})).status_code)
+        self.assertEqual(400, views.retag(RequestFactory().post('/', {'id': self.kept.pk})).status_code)
+        self.assertEqual(405, views.bulk_delete(RequestFactory().get('/', {'id': self.kept.pk})).status_code)
+
+    def test_bulk_views_reject_non_numeric_selections(self):
+        self.assertEqual(400, views.bulk_delete(RequestFactory().post('/', {'id': 'abc'})).status_code)
+        self.assertEqual(400, views.retag(RequestFactory().post('/', {'tag': 'x', 'content_type': 'x',
+                                                                      'object_id': 1})).status_code)
+        self.assertEqual(400, views.bulk_delete(RequestFactory().post('/', {'content_type': 1,
+                                                                            'object_id': 'x'})).status_code)
+        self.assertEqual(6, Attachment.objects.count())
+
+class DownloadResponseTests(test.TestCase):
+
+    def setUp(self):
+        second = Second.objects.create(third_field="xyz")
+        self.attachment = Attachment.objects.create(file_name="x.pdf", attach_to=second, attachment="0123456789")
+        self.factory = RequestFactory()
+
+    def download(self, **headers):
+        return responses.download(self.factory.get('/', **headers), self.attachment, lambda: self.attachment.attachment)
+
+    def test_streams_whole_payload_in_chunks(self):
+        with self.settings(ATTACHMENTS_DOWNLOAD_CHUNK_SIZE=4):
+            response = self.download()
+            self.assertEqual(['0123', '4567', '89'], list(response._container))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('10', response['Content-Length'])
+        self.assertEqual('application/pdf', response['Content-Type'])
+        self.assertEqual('bytes', response['Accept-Ranges'])
+
+    def test_uses_content_hash_as_etag_and_attached_at_as_last_modified(self):
+        response = self.download()
+        self.assertEqual('"%s"' % self.attachment.content_hash, response['ETag'])
+        self.assertEqual(http_date(responses.get_last_modified(self.attachment)), response['Last-Modified'])
+
+    def test_returns_not_modified_for_matching_if_none_match(self):
+        get_payload = Mock()
+        request = self.factory.get('/', HTTP_IF_NONE_MATCH='"%s"' % self.attachment.content_hash)
+        response = responses.download(request, self.attachment, get_payload)
+        self.assertEqual(304, response.status_code)
+        self.assertFalse(get_payload.called)
+
+    def test_returns_full_payload_for_stale_if_none_match(self):
+        response = self.download(HTTP_IF_NONE_MATCH='"something-else"')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('0123456789', response.content)
+
+    def test_returns_not_modified_when_not_modified_since(self):
+        since = http_date(responses.get_last_modified(self.attachment) + 60)
+        self.assertEqual(304, self.download(HTTP_IF_MODIFIED_SINCE=since).status_code)
+
+    def test_returns_payload_when_modified_since(self):
+        since = http_date(responses.get_last_modified(self.attachment) - 60)
+        self.assertEqual(200, self.download(HTTP_IF_MODIFIED_SINCE=since).status_code)
+
+    def test_returns_partial_content_for_range(self):
+        response = self.download(HTTP_RANGE='bytes=2-5')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual('2345', response.content)
+        self.assertEqual('4', response['Content-Length'])
+        self.assertEqual('bytes 2-5/10', response['Content-Range'])
+
+    def test_returns_rest_of_payload_for_open_ended_range(self):
+        response = self.download(HTTP_RANGE='bytes=7-')
+        self.assertEqual('789', response.content)
+        self.assertEqual('bytes 7-9/10', response['Content-Range'])
+
+    def test_returns_end_of_payload_for_suffix_range(self):
+        response = self.download(HTTP_RANGE='bytes=-4')
+        self.assertEqual('6789', response.content)
+        self.assertEqual('bytes 6-9/10', response['Content-Range'])
+
+    def test_returns_unsatisfiable_for_range_past_end(self):
+        response = self.download(HTTP_RANGE='bytes=20-30')
+        self.assertEqual(416, response.status_code)
+        self.assertEqual('bytes */10', response['Content-Range'])
+
+    def test_ignores_range_when_if_range_does_not_match(self):
+        response = self.download(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"old"')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('0123456789', response.content)
+
+    def test_falls_back_to_pk_and_timestamp_etag_without_content_hash(self):
+        self.attachment.content_hash = ''
+        etag = responses.get_etag(self.attachment)
+        self.assertEqual('%s-%s' % (self.attachment.pk, responses.get_last_modified(self.attachment)), etag)
+
+class CacheHeaderTests(test.TestCase):
+
+    def setUp(self):
+        second = Second.objects.create(third_field="xyz")
+        self.attachment = Attachment.objects.create(file_name="x.png", attach_to=second, attachment="0123456789")
+        self.named = renditions.get_named_rendition('thumbnail')
+        self.factory = RequestFactory()
+
+    def download(self, query='', **headers):
+        return responses.download(self.factory.get('/' + query, **headers), self.attachment, lambda: "payload")
+
+    def rendition(self, query='', profile=None, get_rendition=None, **headers):
+        return responses.rendition(self.factory.get('/' + query, **headers), self.attachment, self.named,
+                                   profile or renditions.Profile('jpeg'), get_rendition or (lambda: "thumbnail"))
+
+    def test_caches_versioned_urls_for_good(self):
+        immutable = 'public, max-age=%s, immutable' % responses.IMMUTABLE_MAX_AGE
+        query = '?v=%s' % responses.get_version(self.attachment)
+        self.assertEqual(immutable, self.download(query)['Cache-Control'])
+        query = '?v=%s' % responses.get_rendition_version(self.attachment, self.named)
+        self.assertEqual(immutable, self.rendition(query)['Cache-Control'])
+
+    def test_caches_rendition_briefly_under_the_payload_version(self):
+        query = '?v=%s' % responses.get_version(self.attachment)
+        self.assertEqual('public, max-age=3600', self.rendition(query)['Cache-Control'])
+
+    def test_caches_unversioned_and_stale_urls_briefly(self):
+        self.assertEqual('public, max-age=3600', self.download()['Cache-Control'])
+        self.assertEqual('public, max-age=3600', self.rendition('?v=stale')['Cache-Control'])
+
+    @override_settings(ATTACHMENTS_CACHE_MAX_AGE=60, ATTACHMENTS_CACHE_PRIVATE=True)
+    def test_reads_cache_control_settings(self):
+        self.assertEqual('private, max-age=60', self.download()['Cache-Control'])
+
+    def test_keeps_cache_control_on_not_modified_responses(self):
+        response = self.download(HTTP_IF_NONE_MATCH='"%s"' % self.attachment.content_hash)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('public, max-age=3600', response['Cache-Control'])
+
+    def test_gives_each_rendition_format_and_size_its_own_etag(self):
+        etags = set([self.rendition()['ETag'], self.rendition(profile=renditions.Profile('webp'))['ETag']])
+        self.named = renditions.NamedRendition('square', 100, mode='crop')
+        etags.add(self.rendition()['ETag'])
+        self.assertEqual(3, len(etags))
+        self.assertTrue(all(etag.startswith('"%s-' % self.attachment.content_hash) for etag in etags))
+
+    def test_answers_matching_rendition_request_without_rendering(self):
+        get_rendition = Mock()
+        etag = self.rendition()['ETag']
+        response = self.rendition(get_rendition=get_rendition, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertFalse(get_rendition.called)
+
+    def test_serves_rendition_in_profile_mimetype(self):
+        response = self.rendition(profile=renditions.Profile('webp'))
+        self.assertEqual(('image/webp', 'thumbnail'), (response['Content-Type'], response.content))
+
+    def test_changes_version_with_the_payload(self):
+        url = self.attachment.thumb()
+        self.attachment.attachment = ContentFile("something else", name="x.png")
+        self.attachment.save()
+        self.assertNotEqual(url, self.attachment.thumb())
+
+class OffloadTests(test.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        self.path = os.path.join(self.root, 'ab', 'cd', 'abcd')
+        self.attachment = Attachment(pk=1, mimetype='image/png', content_hash='abc',
+                                     attached_at=datetime.datetime(2012, 1, 1))
+        self.factory = RequestFactory()
+        self.addCleanup(offload._offloaders.clear)
+
+    def test_streams_files_when_offloading_is_off(self):
+        self.assertEqual(None, offload.get_offloader())
+        response = responses.download(self.factory.get('/'), self.attachment, lambda: "payload", self.path)
+        self.assertEqual("payload", response.content)
+
+    @override_settings(ATTACHMENTS_OFFLOAD='x-sendfile')
+    def test_hands_download_path_to_front_end_server_with_x_sendfile(self):
+        get_payload = Mock()
+        response = responses.download(self.factory.get('/'), self.attachment, get_payload, self.path)
+        self.assertEqual(self.path, response['X-Sendfile'])
+        self.assertEqual(('', 'image/png', '"abc"'), (response.content, response['Content-Type'], response['ETag']))
+        self.assertTrue(response.has_header('Cache-Control'))
+        self.assertFalse(get_payload.called)
+
+    @override_settings(ATTACHMENTS_OFFLOAD='x-sendfile')
+    def test_streams_payloads_without_a_local_path(self):
+        response = responses.download(self.factory.get('/'), self.attachment, lambda: "payload", None)
+        self.assertEqual("payload", response.content)
+        self.assertFalse(response.has_header('X-Sendfile'))
+
+    def test_maps_paths_to_internal_locations_for_x_accel_redirect(self):
+        with self.settings(ATTACHMENTS_OFFLOAD='x-accel-redirect',
+                           ATTACHMENTS_OFFLOAD_LOCATIONS={self.root: '/protected/files'}):
+            response = offload.offload(self.path, 'image/png')
+            self.assertEqual('/protected/files/ab/cd/abcd', response['X-Accel-Redirect'])
+            self.assertEqual(None, offload.offload('/elsewhere/abcd', 'image/png'))
+
+    @override_settings(ATTACHMENTS_OFFLOAD='x-accel-redirect')
+    def test_requires_locations_for_x_accel_redirect(self):
+        self.assertRaises(ImproperlyConfigured, offload.get_offloader)
+
+    def test_offloads_generated_renditions_from_file_system_store(self):
+        named = renditions.get_named_rendition('thumbnail')
+        with self.settings(ATTACHMENTS_OFFLOAD='x-sendfile', ATTACHMENTS_RENDITION_ROOT=self.root,
+                           ATTACHMENTS_RENDITION_STORE='attachments.renditions.FileSystemStore'):
+            with patch.dict('attachments.renditions._stores', clear=True):
+                server = views.ImageServer(self.attachment, renditions.Profile('webp'))
+                self.assertEqual(None, server.rendition_path(named))
+
+                renditions.get_store().set(1, 100, 'webp', 'webp bytes')
+                path = server.rendition_path(named)
+                response = responses.rendition(self.factory.get('/'), self.attachment, named,
+                                               renditions.Profile('webp'), Mock(), path)
+
+        self.assertEqual(os.path.join(self.root, '1', '100.webp'), path)
+        self.assertEqual((path, 'image/webp'), (response['X-Sendfile'], response['Content-Type']))
+
+    def test_looks_up_payload_path_in_storage(self):
+        self.attachment.storage, self.attachment.storage_key = 'filesystem', 'abcd'
+        with self.settings(ATTACHMENTS_STORAGE_ROOT=self.root):
+            with patch.dict('attachments.storage._storages', clear=True):
+                self.assertEqual(self.path, self.attachment.payload_path())
+
 class ImageServerTests(test.TestCase):
 
     def setUp(self):
         self.attachment = Mock()
-        self.image_server = views.ImageServer(self.attachment)
+        self.profile = Mock()
+        self.image_server = views.ImageServer(self.attachment, self.profile)
 
     def test_set_attachment_on_init(self):
         self.assertEqual(self.image_server.attachment, self.attachment)
 
-    def test_return_attached_file_in_download(self):
-        self.assertEqual(self.image_server.download(), self.attachment.attachment)
+    def test_return_payload_stream_in_download(self):
+        self.assertEqual(self.image_server.download(), self.attachment.open_payload.return_value)
 
-    def test_return_thumbnail_from_preview(self):
+    @patch('attachments.renditions.get_rendition')
+    def test_return_thumbnail_from_preview(self, get_rendition):
         result = self.image_server.preview()
-        self.attachment.create_thumbnail.assert_called_once_with(max_size=550)
-        self.assertEqual(result, self.attachment.create_thumbnail.return_value)
+        get_rendition.assert_called_once_with(self.attachment, max_size=550, profile=self.profile, crop=False)
+        self.assertEqual(result, get_rendition.return_value)
 
-    def test_return_thumbnail_from_thumbnail(self):
+    @patch('attachments.renditions.get_rendition')
+    def test_return_thumbnail_from_thumbnail(self, get_rendition):
         result = self.image_server.thumbnail()
-        self.attachment.create_thumbnail.assert_called_once_with(max_size=100)
-        self.assertEqual(result, self.attachment.create_thumbnail.return_value)
+        get_rendition.assert_called_once_with(self.attachment, max_size=100, profile=self.profile, crop=False)
+        self.assertEqual(result, get_rendition.return_value)
+
+class RenditionTests(test.TestCase):
+
+    def setUp(self):
+        renditions.stats.reset()
+        self.attachment = Mock(pk=1, mimetype='image/png')
+        self.attachment.create_thumbnail.return_value = 'thumbnail bytes'
+        renditions.invalidate(self.attachment.pk)
+
+    def test_generates_and_stores_rendition_on_miss(self):
+        result = renditions.get_rendition(self.attachment, max_size=100)
+        self.attachment.create_thumbnail.assert_called_once_with(100, ANY, False)
+        self.assertTrue(self.attachment.create_thumbnail.call_args[0][1].is_original)
+        self.assertEqual('thumbnail bytes', result)
+        self.assertEqual({'hits': 0, 'misses': 1, 'coalesced': 0, 'rejected': 0}, renditions.stats.as_dict())
+
+    def test_reuses_stored_rendition_on_hit(self):
+        renditions.get_rendition(self.attachment, max_size=100)
+        result = renditions.get_rendition(self.attachment, max_size=100)
+        self.assertEqual(1, self.attachment.create_thumbnail.call_count)
+        self.assertEqual('thumbnail bytes', result)
+        self.assertEqual({'hits': 1, 'misses': 1, 'coalesced': 0, 'rejected': 0}, renditions.stats.as_dict())
+
+    def test_keys_renditions_by_size(self):
+        renditions.get_rendition(self.attachment, max_size=100)
+        renditions.get_rendition(self.attachment, max_size=550)
+        self.assertEqual([100, 550], [args[0] for args, kwargs in self.attachment.create_thumbnail.call_args_list])
+
+    def test_regenerates_rendition_after_invalidate(self):
+        renditions.get_rendition(self.attachment, max_size=100)
+        renditions.invalidate(self.attachment.pk)
+        renditions.get_rendition(self.attachment, max_size=100)
+        self.assertEqual(2, self.attachment.create_thumbnail.call_count)
+
+    @override_settings(ATTACHMENTS_RENDITION_STORE=None)
+    def test_always_generates_rendition_when_store_is_disabled(self):
+        renditions.get_rendition(self.attachment, max_size=100)
+        renditions.get_rendition(self.attachment, max_size=100)
+        self.assertEqual(2, self.attachment.create_thumbnail.call_count)
+        self.assertEqual({'hits': 0, 'misses': 0, 'coalesced': 0, 'rejected': 0}, renditions.stats.as_dict())
+
+    @patch('attachments.renditions.invalidate')
+    def test_invalidates_renditions_when_attachment_is_saved(self, invalidate):
+        second = Second.objects.create(third_field="xyz")
+        attachment = Attachment.objects.create(file_name="x.doc", attach_to=second, attachment="xxx")
+        invalidate.assert_called_once_with(attachment.pk)
+
+    @patch('attachments.renditions.invalidate')
+    def test_invalidates_renditions_when_attachment_is_deleted(self, invalidate):
+        second = Second.objects.create(third_field="xyz")
+        attachment = Attachment.objects.create(file_name="x.doc", attach_to=second, attachment="xxx")
+        pk = attachment.pk
+        attachment.delete()
+        self.assertEqual(((pk,), {}), invalidate.call_args_list[-1])
+
+class RenditionProfileTests(test.TestCase):
+
+    def image(self, mode='RGB', format='PNG'):
+        from PIL import Image
+        output = StringIO()
+        Image.new(mode, (40, 20), (200, 10, 10, 128)[:len(mode)]).save(output, format)
+        return output.getvalue()
+
+    def open(self, data):
+        from PIL import Image
+        return Image.open(StringIO(data))
+
+    def test_negotiates_webp_only_when_client_lists_it(self):
+        attachment = Mock(mimetype='image/png')
+        self.assertEqual('webp', renditions.negotiate(attachment, 'image/webp,image/*;q=0.8').format)
+        self.assertEqual('jpeg', renditions.negotiate(attachment, 'image/png,image/*;q=0.8,*/*;q=0.5').format)
+        self.assertEqual('jpeg', renditions.negotiate(attachment, None).format)
+
+    def test_negotiates_original_format_when_no_profile_is_acceptable(self):
+        attachment = Mock(mimetype='image/png')
+        profile = renditions.negotiate(attachment, 'image/png, image/webp;q=0, image/jpeg;q=0')
+        self.assertTrue(profile.is_original)
+        self.assertEqual('image/png', profile.mimetype(attachment.mimetype))
+
+    def test_key_includes_format_and_options(self):
+        plain = renditions.Profile('jpeg')
+        tuned = renditions.Profile('jpeg', quality=85, progressive=True)
+        self.assertEqual('jpeg', plain.key('image/png'))
+        self.assertEqual('png', renditions.Profile().key('image/png'))
+        self.assertNotEqual(tuned.key('image/png'), renditions.Profile('jpeg', quality=60).key('image/png'))
+        self.assertTrue(tuned.key('image/png').startswith('jpeg.'))
+        self.assertTrue(len(tuned.key('image/x-ms-bmp')) <= 20)
+
+    def test_encodes_transparent_image_as_progressive_jpeg(self):
+        profile = renditions.Profile('jpeg', quality=85, progressive=True, optimize=True)
+        data = profile.encode(self.open(self.image('RGBA')), 'image/png')
+        image = self.open(data)
+        self.assertEqual(('JPEG', 'RGB'), (image.format, image.mode))
+        self.assertTrue(image.info.get('progressive') or image.info.get('progression'))
+
+    def test_encodes_webp(self):
+        data = renditions.Profile('webp', quality=80).encode(self.open(self.image('P', 'GIF')), 'image/gif')
+        self.assertEqual('WEBP', self.open(data).format)
+
+    def test_encodes_bitmap_in_original_format(self):
+        data = renditions.Profile().encode(self.open(self.image(format='BMP')), 'image/x-ms-bmp')
+        self.assertEqual('BMP', self.open(data).format)
+
+    def test_keys_stored_renditions_by_profile(self):
+        attachment = Mock(pk=1, mimetype='image/png')
+        attachment.create_thumbnail.side_effect = lambda size, profile, crop: profile.format
+        renditions.invalidate(attachment.pk)
+        webp, jpeg = renditions.Profile('webp'), renditions.Profile('jpeg')
+
+        self.assertEqual('webp', renditions.get_rendition(attachment, 100, webp))
+        self.assertEqual('jpeg', renditions.get_rendition(attachment, 100, jpeg))
+        self.assertEqual('webp', renditions.get_rendition(attachment, 100, webp))
+        self.assertEqual(2, attachment.create_thumbnail.call_count)
+
+    def test_serves_preview_in_negotiated_format(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        second = Second.objects.create(third_field="xyz")
+        with self.settings(ATTACHMENTS_STORAGE='filesystem', ATTACHMENTS_STORAGE_ROOT=root):
+            with patch.dict('attachments.storage._storages', clear=True):
+                attachment = Attachment.objects.create(file_name="x.bmp", attach_to=second,
+                                                       attachment=self.image(format='BMP'))
+                self.assert_serves_negotiated_formats(attachment)
+
+    def assert_serves_negotiated_formats(self, attachment):
+
+        response = views.serve(RequestFactory().get('/', HTTP_ACCEPT='image/webp,*/*'), 'preview', attachment.pk)
+        self.assertEqual(('image/webp', 'Accept'), (response['Content-Type'], response['Vary']))
+        self.assertEqual('WEBP', self.open(response.content).format)
+
+        response = views.serve(RequestFactory().get('/', HTTP_ACCEPT='*/*'), 'thumbnail', attachment.pk)
+        self.assertEqual('image/jpeg', response['Content-Type'])
+        self.assertEqual('JPEG', self.open(response.content).format)
+
+class DownscaleTests(test.TestCase):
+
+    def jpeg(self, size, **options):
+        from PIL import Image
+        output = StringIO()
+        Image.new('RGB', size, (10, 120, 200)).save(output, 'JPEG', **options)
+        output.seek(0)
+        return output
+
+    def test_fits_image_within_max_size(self):
+        image = renditions.downscale(self.jpeg((1600, 800)), 100)
+        self.assertEqual((100, 50), image.size)
+
+    def test_leaves_smaller_images_alone(self):
+        image = renditions.downscale(self.jpeg((60, 30)), 100)
+        self.assertEqual((60, 30), image.size)
+
+    @patch('attachments.renditions.Image.open')
+    def test_drafts_jpeg_at_fitted_size_before_decoding(self, open_image):
+        image = open_image.return_value
+        image.size = (6000, 4000)
+        image.mode = 'RGB'
+        renditions.downscale(Mock(), 550)
+        image.draft.assert_called_once_with('RGB', (550, 366))
+
+    @override_settings(ATTACHMENTS_MAX_IMAGE_PIXELS=1000 * 1000)
+    def test_refuses_to_decode_more_than_the_pixel_budget(self):
+        from PIL import Image
+        output = StringIO()
+        Image.new('L', (2000, 1000)).save(output, 'PNG')
+        output.seek(0)
+        self.assertRaises(renditions.ImageTooLarge, renditions.downscale, output, 100)
+
+    @override_settings(ATTACHMENTS_MAX_IMAGE_PIXELS=1000 * 1000)
+    def test_counts_jpeg_pixels_at_draft_scale(self):
+        image = renditions.downscale(self.jpeg((2000, 1000)), 100)
+        self.assertEqual((100, 50), image.size)
+
+    def test_reduces_by_whole_factor_except_palette_and_bilevel_images(self):
+        from PIL import Image
+        reduced = []
+
+        def reduce(image, factor):
+            reduced.append((image.mode, factor))
+            return image.resize((image.size[0] // factor, image.size[1] // factor))
+
+        with patch.object(Image.Image, 'reduce', reduce, create=True):
+            for mode in ('RGB', 'L', 'P', '1'):
+                output = StringIO()
+                Image.new(mode, (800, 800)).save(output, 'PNG')
+                output.seek(0)
+                self.assertEqual((100, 100), renditions.downscale(output, 100).size)
+        self.assertEqual([('RGB', 4), ('L', 4)], reduced)
+
+    def test_rendition_of_image_over_the_pixel_budget_is_refused(self):
+        from PIL import Image
+        output = StringIO()
+        Image.new('L', (2000, 1000)).save(output, 'PNG')
+        attachment = Attachment.objects.create(file_name="x.png", attach_to=Second.objects.create(third_field="x"),
+                                               attachment=output.getvalue())
+
+        with override_settings(ATTACHMENTS_MAX_IMAGE_PIXELS=1000 * 1000):
+            response = views.rendition(RequestFactory().get('/'), 'preview', attachment.pk)
+        self.assertEqual(422, response.status_code)
+
+    def test_applies_exif_orientation(self):
+        from PIL import Image
+        if not hasattr(Image, 'Exif'):
+            return
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        image = renditions.downscale(self.jpeg((80, 40), exif=exif.tobytes()), 100)
+        self.assertEqual((40, 80), image.size)
+
+class BatchThumbnailTests(test.TestCase):
+
+    def setUp(self):
+        self.second = Second.objects.create(third_field="xyz")
+        self.image = Attachment.objects.create(file_name="x.png", attach_to=self.second, attachment="xxx")
+        self.document = Attachment.objects.create(file_name="x.pdf", attach_to=self.second, attachment="xxx")
+        self.url = reverse('attachments:thumbnails')
+
+    def get(self, data, **extra):
+        return json.loads(self.client.get(self.url, data, **extra).content)
+
+    @patch('attachments.renditions.get_rendition', Mock(return_value='png'))
+    def test_returns_data_uris_for_images_and_icons_for_documents(self):
+        content_type = ContentType.objects.get_for_model(Second)
+        thumbnails = self.get({'content_type': content_type.pk, 'object_id': self.second.pk})
+        self.assertEqual({str(self.image.pk): 'data:image/jpeg;base64,cG5n',
+                          str(self.document.pk): self.document.thumb()}, thumbnails)
+
+    @patch('attachments.renditions.get_rendition')
+    def test_fetches_selected_attachments_in_one_query(self, get_rendition):
+        get_rendition.return_value = 'png'
+        other = Attachment.objects.create(file_name="y.png", attach_to=self.second, attachment="xxx")
+        with self.assertNumQueries(1):
+            thumbnails = self.get({'id': [self.image.pk, other.pk]})
+        self.assertEqual(sorted([str(self.image.pk), str(other.pk)]), sorted(thumbnails))
+        self.assertEqual([100, 100], [kwargs['max_size'] for args, kwargs in get_rendition.call_args_list])
+
+    @patch('attachments.renditions.get_rendition', Mock(return_value='png'))
+    def test_negotiates_the_format_from_the_accept_header(self):
+        response = self.client.get(self.url, {'id': self.image.pk}, HTTP_ACCEPT='image/webp,*/*')
+        self.assertTrue(json.loads(response.content)[str(self.image.pk)].startswith('data:image/webp;'))
+        self.assertEqual('Accept', response['Vary'])
+
+    @override_settings(ATTACHMENTS_BATCH_LIMIT=1)
+    @patch('attachments.renditions.get_rendition', Mock(return_value='png'))
+    def test_returns_at_most_the_batch_limit(self):
+        self.assertEqual([str(self.image.pk)], list(self.get({'id': [self.image.pk, self.document.pk]})))
+
+    @patch('attachments.renditions.get_rendition')
+    def test_falls_back_to_rendition_urls_for_images_that_fail_to_render(self, get_rendition):
+        other = Attachment.objects.create(file_name="y.png", attach_to=self.second, attachment="xxx")
+        for error in (IOError("cannot identify image file"), renditions.ImageTooLarge("too big")):
+            get_rendition.side_effect = [error, 'png']
+            thumbnails = self.get({'id': [self.image.pk, other.pk]})
+            self.assertEqual({str(self.image.pk): self.image.rendition_url('thumbnail'),
+                              str(other.pk): 'data:image/jpeg;base64,cG5n'}, thumbnails)
+
+    def test_rejects_requests_without_a_selection(self):
+        self.assertEqual(400, self.client.get(self.url).status_code)
+        self.assertEqual(400, self.client.get(self.url, {'id': 'abc'}).status_code)
+
+    def test_raises_404_for_unknown_rendition_name(self):
+        self.assertRaises(http.Http404, views.thumbnails, RequestFactory().get(self.url, {'name': 'huge', 'id': 1}))
+
+class AttachmentPageTests(test.TestCase):
+
+    def setUp(self):
+        self.second = Second.objects.create(third_field="xyz")
+        self.content_type = ContentType.objects.get_for_model(Second)
+        self.attachments = [Attachment.objects.create(file_name="%s.pdf" % i, attach_to=self.second, attachment="x")
+                            for i in range(5)]
+
+    def get(self, **data):
+        data = dict({'content_type': self.content_type.pk, 'object_id': self.second.pk}, **data)
+        return json.loads(self.client.get(reverse('attachments:page'), data).content)
+
+    def ids(self, page):
+        return [attachment['id'] for attachment in page['attachments']]
+
+    def test_pages_through_attachments_oldest_first_with_a_cursor(self):
+        # attached in the same second, so the pk breaks the ties
+        Attachment.objects.filter(pk__in=[a.pk for a in self.attachments]).update(attached_at=self.attachments[0].attached_at)
+        first = self.get(count=2)
+        second = self.get(count=2, after=first['next'])
+        last = self.get(count=2, after=second['next'])
+        self.assertEqual([a.pk for a in self.attachments],
+                         self.ids(first) + self.ids(second) + self.ids(last))
+        self.assertEqual(None, last['next'])
+
+    def test_orders_by_attached_at_before_pk(self):
+        newest = self.attachments[0]
+        Attachment.objects.filter(pk=newest.pk).update(attached_at=newest.attached_at + datetime.timedelta(days=1))
+        self.assertEqual([a.pk for a in self.attachments[1:]] + [newest.pk], self.ids(self.get()))
+
+    def test_describes_each_attachment(self):
+        attachment = self.get(count=1)['attachments'][0]
+        expected = self.attachments[0]
+        self.assertEqual((expected.pk, "0.pdf", expected.thumb(), expected.preview(),
+                          expected.download_url()),
+                         (attachment['id'], attachment['file_name'], attachment['thumb'], attachment['preview'],
+                          attachment['download']))
+
+    def test_filters_by_tag(self):
+        Attachment.objects.filter(pk=self.attachments[3].pk).update(tag="tagged")
+        self.assertEqual([self.attachments[3].pk], self.ids(self.get(tag="tagged")))
+
+    @override_settings(ATTACHMENTS_PAGE_SIZE=3, ATTACHMENTS_BATCH_LIMIT=4)
+    def test_limits_page_size(self):
+        self.assertEqual(3, len(self.get()['attachments']))
+        self.assertEqual(4, len(self.get(count=50)['attachments']))
+
+    def test_reads_each_page_in_one_query(self):
+        with self.assertNumQueries(1):
+            self.get(count=2)
+
+    def test_rejects_bad_requests(self):
+        url = reverse('attachments:page')
+        self.assertEqual(400, self.client.get(url).status_code)
+        self.assertEqual(400, self.client.get(url, {'content_type': self.content_type.pk, 'object_id': 1,
+                                                    'after': 'yesterday,1'}).status_code)
+        self.assertEqual(400, self.client.get(url, {'content_type': 'x', 'object_id': 1}).status_code)
+        self.assertEqual(400, self.client.get(url, {'content_type': self.content_type.pk, 'object_id': 'x'}).status_code)
+
+    def test_builds_page_url_for_a_model(self):
+        url = Attachment.get_page_url(self.second, tag="x")
+        self.assertTrue(url.startswith(reverse('attachments:page') + '?'))
+        self.assertEqual({'content_type': str(self.content_type.pk), 'object_id': str(self.second.pk), 'tag': 'x'},
+                         QueryDict(url.split('?')[1]).dict())
+
+    def test_renders_lazy_slider_without_attachment_markup(self):
+        from django.template.loader import render_to_string
+        html = render_to_string('attachments/slider.html', {'attachments_page_url': '/page/?x=1',
+                                                            'attachments': self.attachments})
+        self.assertIn('data-page-url="/page/?x=1"', html)
+        self.assertNotIn('<li', html)
+
+class RenderSlotTests(test.TestCase):
+
+    def setUp(self):
+        renditions.stats.reset()
+        self.attachment = Mock(pk=1, mimetype='image/png')
+        self.attachment.create_thumbnail.return_value = 'thumbnail bytes'
+        renditions.invalidate(self.attachment.pk)
+
+    def test_bounds_how_many_renditions_are_generated_at_once(self):
+        slots = renditions.RenderSlots(2)
+        self.assertTrue(slots.acquire(0))
+        self.assertTrue(slots.acquire(0))
+        self.assertFalse(slots.acquire(0.01))
+        slots.release()
+        self.assertTrue(slots.acquire(0))
+
+    def test_waits_for_a_slot_to_free_up(self):
+        slots = renditions.RenderSlots(1)
+        slots.acquire(0)
+        releaser = threading.Timer(0.05, slots.release)
+        releaser.start()
+        self.assertTrue(slots.acquire(5))
+        releaser.join()
+
+    @override_settings(ATTACHMENTS_RENDER_CONCURRENCY=3)
+    def test_sizes_slots_from_settings(self):
+        self.assertEqual(3, renditions.get_render_slots().size)
+
+    def test_generates_one_rendition_per_process_by_default(self):
+        # a CPU count's worth would never bind a prefork worker, or a threaded one with few threads
+        self.assertEqual(1, renditions.get_render_slots().size)
+
+    @override_settings(ATTACHMENTS_RENDER_TIMEOUT=0)
+    @patch('attachments.renditions.get_render_slots')
+    def test_rejects_rendition_when_every_slot_stays_busy(self, get_render_slots):
+        get_render_slots.return_value = renditions.RenderSlots(0)
+        self.assertRaises(renditions.RenderingBusy, renditions.get_rendition, self.attachment, 100)
+        self.assertFalse(self.attachment.create_thumbnail.called)
+        self.assertEqual(1, renditions.stats.as_dict()['rejected'])
+
+    @patch('attachments.renditions.get_render_slots')
+    def test_serves_stored_renditions_without_a_slot(self, get_render_slots):
+        renditions.get_rendition(self.attachment, 100)
+        get_render_slots.return_value = renditions.RenderSlots(0)
+        self.assertEqual('thumbnail bytes', renditions.get_rendition(self.attachment, 100))
+
+    def test_releases_slot_when_rendering_fails(self):
+        self.attachment.create_thumbnail.side_effect = IOError
+        self.assertRaises(IOError, renditions.get_rendition, self.attachment, 100)
+        self.assertEqual(0, renditions.get_render_slots().busy)
+
+    @patch('attachments.responses.rendition', Mock(side_effect=renditions.RenderingBusy))
+    @patch('attachments.renditions.negotiate', Mock())
+    @patch('attachments.models.Attachment.objects', Mock())
+    def test_answers_busy_rendition_request_with_503(self):
+        response = views.rendition(Mock(), 'thumbnail', Mock())
+        self.assertEqual((503, '1'), (response.status_code, response['Retry-After']))
+
+    @patch('attachments.renditions.get_rendition', Mock(side_effect=renditions.RenderingBusy))
+    def test_falls_back_to_rendition_url_in_busy_batch(self):
+        second = Second.objects.create(third_field="xyz")
+        attachment = Attachment.objects.create(file_name="x.png", attach_to=second, attachment="xxx")
+        response = self.client.get(reverse('attachments:thumbnails'), {'id': attachment.pk})
+        self.assertEqual({str(attachment.pk): attachment.rendition_url('thumbnail')}, json.loads(response.content))
+
+class NamedRenditionTests(test.TestCase):
+
+    def test_includes_thumbnail_and_preview_by_default(self):
+        named = renditions.get_named_renditions()
+        self.assertEqual((100, 550), (named['thumbnail'].size, named['preview'].size))
+        self.assertFalse(named['preview'].crop)
+        self.assertEqual(None, named['preview'].profile)
+
+    @override_settings(ATTACHMENTS_RENDITIONS={'square': {'size': 64, 'mode': 'crop', 'format': 'jpeg', 'quality': 60},
+                                               'preview': {'size': 800}})
+    def test_reads_named_renditions_from_settings(self):
+        named = renditions.get_named_renditions()
+        self.assertEqual(800, named['preview'].size)
+        self.assertEqual((64, True, 'jpeg', {'quality': 60}),
+                         (named['square'].size, named['square'].crop, named['square'].profile.format,
+                          named['square'].profile.options))
+
+    @override_settings(ATTACHMENTS_RENDITIONS={'square': {'size': 64, 'mode': 'stretch'}})
+    def test_raises_improperly_configured_for_unknown_mode(self):
+        self.assertRaises(ImproperlyConfigured, renditions.get_named_renditions)
+
+    def test_crops_to_square_from_the_center(self):
+        from PIL import Image
+        source = Image.new('RGB', (300, 100), (255, 0, 0))
+        source.paste((0, 0, 255), (100, 0, 200, 100))
+        output = StringIO()
+        source.save(output, 'PNG')
+        output.seek(0)
+
+        image = renditions.downscale(output, 50, crop=True)
+        self.assertEqual((50, 50), image.size)
+        self.assertEqual((0, 0, 255), image.getpixel((1, 1)))
+
+    def test_keys_cropped_renditions_apart_from_fitted_ones(self):
+        attachment = Mock(pk=1, mimetype='image/png')
+        attachment.create_thumbnail.side_effect = lambda size, profile, crop: 'crop' if crop else 'fit'
+        renditions.invalidate(attachment.pk)
+        self.assertEqual('fit', renditions.get_rendition(attachment, 100))
+        self.assertEqual('crop', renditions.get_rendition(attachment, 100, crop=True))
+
+    @override_settings(ATTACHMENTS_RENDITIONS={'square': {'size': 64, 'mode': 'crop'}, 'large': {'size': 1100},
+                                               'retina_thumbnail': {'size': 200}})
+    def test_srcset_lists_fitted_renditions_by_width(self):
+        attachment = Attachment(pk=3, attachment_type=Attachment.IMAGE, content_hash='abc', mimetype=Attachment.PNG)
+        named = renditions.get_named_renditions()
+        url = lambda name: '%s?v=%s' % (reverse('attachments:rendition', kwargs={'name': name, 'identifier': 3}),
+                                        responses.get_rendition_version(attachment, named[name]))
+        self.assertEqual("%s 100w, %s 200w, %s 550w, %s 1100w" % (
+            url('thumbnail'), url('retina_thumbnail'), url('preview'), url('large')), attachment.srcset())
+        self.assertEqual("%s 100w, %s 550w" % (url('thumbnail'), url('preview')),
+                         attachment.srcset(['preview', 'thumbnail']))
+        self.assertEqual("%s 100w" % url('thumbnail'), attachment.srcset(['thumbnail', 'poster']))
+
+    def test_srcset_is_empty_for_documents(self):
+        self.assertEqual('', Attachment(pk=3, attachment_type=Attachment.DOCUMENT, mimetype=Attachment.PDF).srcset())
+
+    @override_settings(ATTACHMENTS_RENDITIONS={'square': {'size': 64, 'mode': 'crop', 'format': 'jpeg'}},
+                       ATTACHMENTS_RENDITION_PROFILES=[{'format': 'webp'}])
+    @patch('attachments.renditions.get_rendition')
+    def test_generate_renditions_creates_every_named_rendition(self, get_rendition):
+        second = Second.objects.create(third_field="xyz")
+        attachment = Attachment.objects.create(file_name="x.png", attach_to=second, attachment="xxx")
+        workers.generate_renditions(attachment.pk)
+        self.assertEqual([(550, 'webp', False), (64, 'jpeg', True), (100, 'webp', False)],
+                         [(args[1], args[2].format, args[3]) for args, kwargs in get_rendition.call_args_list])
+
+    def test_serves_named_rendition_url(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        from PIL import Image
+        output = StringIO()
+        Image.new('RGB', (300, 200)).save(output, 'PNG')
+        second = Second.objects.create(third_field="xyz")
+
+        with self.settings(ATTACHMENTS_STORAGE='filesystem', ATTACHMENTS_STORAGE_ROOT=root,
+                           ATTACHMENTS_RENDITIONS={'square': {'size': 64, 'mode': 'crop', 'format': 'png'}}):
+            with patch.dict('attachments.storage._storages', clear=True):
+                attachment = Attachment.objects.create(file_name="x.png", attach_to=second,
+                                                       attachment=output.getvalue())
+                response = self.client.get(attachment.rendition_url('square'))
+
+        self.assertEqual('image/png', response['Content-Type'])
+        self.assertEqual((64, 64), Image.open(StringIO(response.content)).size)
+
+class RenditionStoreTests(test.TestCase):
+
+    def assert_store_round_trip(self, store):
+        self.assertEqual(None, store.get(5, 100, 'png'))
+        store.set(5, 100, 'png', '\x89small\x00')
+        store.set(5, 550, 'png', '\x89large\xff')
+        self.assertEqual('\x89small\x00', store.get(5, 100, 'png'))
+        self.assertEqual('\x89large\xff', store.get(5, 550, 'png'))
+        self.assertEqual(None, store.get(5, 100, 'jpeg'))
+
+        store.invalidate(5)
+        self.assertEqual(None, store.get(5, 100, 'png'))
+        self.assertEqual(None, store.get(5, 550, 'png'))
+
+    def test_cache_store(self):
+        self.assert_store_round_trip(renditions.CacheStore())
+
+    def test_file_system_store(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        with self.settings(ATTACHMENTS_RENDITION_ROOT=root):
+            self.assert_store_round_trip(renditions.FileSystemStore())
+
+    def test_database_store(self):
+        self.assert_store_round_trip(renditions.DatabaseStore())
+
+class SingleFlightTests(test.TestCase):
+
+    def setUp(self):
+        renditions.stats.reset()
+        self.flights = renditions.SingleFlight()
+
+    def start(self, function, results):
+        thread = threading.Thread(target=lambda: results.append(self.flights.do('key', function)))
+        thread.start()
+        return thread
+
+    def test_runs_function_once_for_concurrent_callers(self):
+        started, release, calls, results = threading.Event(), threading.Event(), [], []
+        waiting, all_waiting = [], threading.Event()
+
+        def generate():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'rendition'
+
+        @contextmanager
+        def stage(name):
+            # followers enter the coalesce stage once they have joined the leader's flight
+            waiting.append(name)
+            if waiting.count('coalesce') == 3:
+                all_waiting.set()
+            yield
+
+        with patch('attachments.renditions.instrumentation.stage', stage):
+            leader = self.start(generate, results)
+            started.wait(5)
+            followers = [self.start(generate, results) for i in range(3)]
+            self.assertTrue(all_waiting.wait(5))
+            release.set()
+            for thread in [leader] + followers:
+                thread.join(5)
+
+        self.assertEqual(['rendition'] * 4, results)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(3, renditions.stats.as_dict()['coalesced'])
+
+    def test_shares_the_leaders_exception(self):
+        started, release, errors = threading.Event(), threading.Event(), []
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise IOError("broken image")
+
+        def call():
+            try:
+                self.flights.do('key', fail)
+            except IOError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call)]
+        threads[0].start()
+        started.wait(5)
+        threads.append(threading.Thread(target=call))
+        threads[1].start()
+        release.wait(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(2, len(errors))
+
+    def test_forgets_key_once_done(self):
+        self.assertEqual(1, self.flights.do('key', lambda: 1))
+        self.assertEqual(2, self.flights.do('key', lambda: 2))
+        self.assertEqual({}, self.flights._flights)
+
+    def test_generates_concurrently_requested_rendition_once(self):
+        release = threading.Event()
+        attachment = Mock(pk=1, mimetype='image/png')
+        attachment.create_thumbnail.side_effect = lambda *args: release.wait(5) and 'thumbnail bytes'
+        renditions.invalidate(attachment.pk)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(renditions.get_rendition(attachment, 100)))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        release.wait(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(['thumbnail bytes'] * 5, results)
+        self.assertEqual(1, attachment.create_thumbnail.call_count)
+        counts = renditions.stats.as_dict()
+        self.assertEqual(4, counts['hits'] + counts['coalesced'])
+
+
+class RenditionLockTests(test.TestCase):
+
+    def setUp(self):
+        renditions.stats.reset()
+        self.attachment = Mock(pk=1, mimetype='image/png')
+        self.attachment.create_thumbnail.return_value = 'thumbnail bytes'
+
+    @override_settings(ATTACHMENTS_RENDITION_LOCKING=True)
+    def test_reuses_rendition_stored_by_another_process_while_waiting(self):
+        store = mock.MagicMock()
+        store.get.side_effect = [None, 'from another process']
+        with patch('attachments.renditions.get_store', Mock(return_value=store)):
+            self.assertEqual('from another process', renditions.get_rendition(self.attachment, 100))
+        store.lock.assert_called_once_with(1, 100, 'png')
+        self.assertFalse(self.attachment.create_thumbnail.called)
+        self.assertEqual(1, renditions.stats.as_dict()['coalesced'])
+
+    def test_skips_store_locks_by_default(self):
+        store = Mock()
+        store.get.return_value = None
+        with patch('attachments.renditions.get_store', Mock(return_value=store)):
+            renditions.get_rendition(self.attachment, 100)
+        self.assertFalse(store.lock.called)
+        store.set.assert_called_once_with(1, 100, 'png', 'thumbnail bytes')
+
+    @override_settings(ATTACHMENTS_RENDITION_LOCK_TIMEOUT=0.2)
+    def test_cache_lock_waits_for_rendition_or_timeout(self):
+        store = renditions.CacheStore()
+        store.invalidate(6)
+        self.addCleanup(store.invalidate, 6)
+        with store.lock(6, 100, 'png'):
+            started = time.time()
+            with store.lock(6, 100, 'png'):
+                self.assertTrue(time.time() - started >= 0.2)
+
+            store.set(6, 100, 'png', 'small')
+            started = time.time()
+            with store.lock(6, 100, 'png'):
+                self.assertTrue(time.time() - started < 0.2)
+
+        with store.lock(6, 100, 'jpeg'):
+            self.assertTrue(store.cache.get(store._key(6, 100, 'jpeg') + ':lock'))
+        self.assertEqual(None, store.cache.get(store._key(6, 100, 'jpeg') + ':lock'))
+
+    def test_file_system_lock_excludes_other_holders(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        with self.settings(ATTACHMENTS_RENDITION_ROOT=root):
+            store = renditions.FileSystemStore()
+            acquired = threading.Event()
+
+            def wait_for_lock():
+                with store.lock(5, 100, 'png'):
+                    acquired.set()
+
+            with store.lock(5, 100, 'png'):
+                waiter = threading.Thread(target=wait_for_lock)
+                waiter.start()
+                self.assertFalse(acquired.wait(0.1))
+            self.assertTrue(acquired.wait(5))
+            waiter.join(5)
+
+    def test_file_system_lock_waits_for_rendition_or_timeout(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        with self.settings(ATTACHMENTS_RENDITION_ROOT=root, ATTACHMENTS_RENDITION_LOCK_TIMEOUT=0.2):
+            store = renditions.FileSystemStore()
+            with store.lock(5, 100, 'png'):
+                started = time.time()
+                with store.lock(5, 100, 'png'):
+                    self.assertTrue(0.2 <= time.time() - started < 5)
+
+                store.set(5, 100, 'png', 'small')
+                started = time.time()
+                with store.lock(5, 100, 'png'):
+                    self.assertTrue(time.time() - started < 0.2)
+
+class InstrumentationTests(test.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        from PIL import Image
+        output = StringIO()
+        Image.new('RGB', (300, 200)).save(output, 'PNG')
+        self.png = output.getvalue()
+
+    def traced_requests(self, *urls, **extra):
+        second = Second.objects.create(third_field="xyz")
+        with self.settings(ATTACHMENTS_STORAGE='filesystem', ATTACHMENTS_STORAGE_ROOT=self.root,
+                           ATTACHMENTS_INSTRUMENTATION_SINKS=['memory'], ATTACHMENTS_SERVER_TIMING=True):
+            with patch.dict('attachments.storage._storages', clear=True):
+                with patch.dict('attachments.instrumentation._sinks', clear=True):
+                    attachment = Attachment.objects.create(file_name="x.png", attach_to=second, attachment=self.png)
+                    responses = [self.client.get(url(attachment), **extra) for url in urls]
+                    return attachment, responses, instrumentation.get_sinks()[0].traces
+
+    def stages(self, trace):
+        return [stage for stage, duration in trace.stages]
+
+    def test_does_nothing_outside_a_traced_request(self):
+        with instrumentation.stage('decode'):
+            instrumentation.record('cache', 'hit')
+        self.assertEqual(None, instrumentation.current())
+
+    def test_traces_each_stage_of_a_rendition(self):
+        thumbnail = lambda attachment: attachment.thumb()
+        attachment, (miss, hit), traces = self.traced_requests(thumbnail, thumbnail, HTTP_ACCEPT='image/png')
+
+        self.assertEqual(['select', 'store', 'queue', 'fetch', 'decode', 'resize', 'encode', 'store_write'],
+                         self.stages(traces[0]))
+        self.assertEqual(['select', 'store'], self.stages(traces[1]))
+        self.assertEqual(('rendition', 'miss', len(self.png), len(miss.content)),
+                         (traces[0].name, traces[0].values['cache'], traces[0].values['payload_bytes'],
+                          traces[0].values['rendition_bytes']))
+        self.assertEqual('hit', traces[1].values['cache'])
+
+    def test_returns_stage_timings_as_server_timing_header(self):
+        attachment, (response,), traces = self.traced_requests(lambda attachment: attachment.download_url())
+        self.assertEqual(['select', 'fetch'], self.stages(traces[0]))
+        self.assertEqual(traces[0].server_timing(), response['Server-Timing'])
+        self.assertTrue(response['Server-Timing'].startswith('select;dur='))
+        self.assertIn(', total;dur=', response['Server-Timing'])
+
+    def test_leaves_responses_alone_when_off(self):
+        second = Second.objects.create(third_field="xyz")
+        attachment = Attachment.objects.create(file_name="x.pdf", attach_to=second, attachment="xxx")
+        self.assertFalse(self.client.get(attachment.download_url()).has_header('Server-Timing'))
+
+    def trace(self):
+        trace = instrumentation.Trace('rendition')
+        trace.add_stage('decode', 12.5)
+        trace.values.update(cache='miss', rendition_bytes=2048)
+        trace.duration = 20.0
+        return trace
+
+    def test_sends_statsd_metrics_over_udp(self):
+        import socket
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        with self.settings(ATTACHMENTS_STATSD_ADDRESS=listener.getsockname(), ATTACHMENTS_STATSD_PREFIX='app.'):
+            instrumentation.StatsdSink().emit(self.trace())
+        self.assertEqual(['app.rendition.total:20|ms', 'app.rendition.decode:12|ms', 'app.rendition.cache.miss:1|c',
+                          'app.rendition.rendition_bytes:2048|g'], listener.recv(1024).split('\n'))
+
+    def test_sends_gauges_for_numbers_only_and_skips_missing_values(self):
+        trace = self.trace()
+        trace.values.update(payload_bytes=None, ratio=0.5, cached=True)
+        with self.settings(ATTACHMENTS_STATSD_PREFIX='app.'):
+            metrics = list(instrumentation.StatsdSink().metrics(trace))
+        self.assertEqual(['app.rendition.cache.miss:1|c', 'app.rendition.cached.True:1|c',
+                          'app.rendition.ratio:0.5|g', 'app.rendition.rendition_bytes:2048|g'], metrics[2:])
+
+    @patch('attachments.instrumentation.logger')
+    def test_logs_one_line_per_trace(self, logger):
+        instrumentation.LoggingSink().emit(self.trace())
+        logger.info.assert_called_once_with("%s %.1fms %s %s", 'rendition', 20.0, 'decode=12.5ms',
+                                            'cache=miss rendition_bytes=2048')
 
 class AttachmentFormTests(test.TestCase):
 
@@ -378,3 +1732,658 @@ class AttachmentFormTests(test.TestCase):
 
     def test_tagged_attachment_form_contains_attachment_field(self):
         self.assertIn('attachment', forms.TaggedAttachmentForm._meta.fields)
+
+
+class MimeRegistryTests(test.TestCase):
+
+    def test_looks_up_mime_type_by_extension_ignoring_case(self):
+        registry = mime.get_registry()
+        self.assertEqual(Attachment.JPG, registry.for_file_name('holiday.JPEG'))
+        self.assertEqual(Attachment.WORDX, registry.for_file_name('report.final.docx'))
+        self.assertEqual(Attachment.IMAGE, registry.attachment_type(Attachment.BMP))
+        self.assertEqual(None, registry.for_file_name('archive.zip'))
+        self.assertEqual(None, registry.for_file_name('jpg'))
+
+    @patch.object(Attachment, 'MIME_TYPE_EXTENSIONS', ((re.compile(r'.+\.tiff?$', re.I), 'image/tiff'),))
+    @patch.object(Attachment, 'MIME_TYPE_ATTACHMENT_TYPES', {'image/tiff': Attachment.IMAGE})
+    def test_honours_mime_types_added_through_the_deprecated_class_attributes(self):
+        second = Second.objects.create(third_field="xyz")
+        scan = Attachment.objects.create(file_name="scan.TIF", attach_to=second, attachment="II*\x00")
+        self.assertEqual(('image/tiff', Attachment.IMAGE), (scan.mimetype, scan.attachment_type))
+        self.assertEqual(Attachment.PDF, Attachment().get_mime_type('report.pdf'))
+
+        results = Attachment.objects.bulk_attach(second, [SimpleUploadedFile("page.tiff", "II*\x00")])
+        self.assertEqual(('image/tiff', Attachment.IMAGE),
+                         (results[0].attachment.mimetype, results[0].attachment.attachment_type))
+
+    def test_extension_must_end_the_file_name(self):
+        registry = mime.get_registry()
+        self.assertEqual(None, registry.for_file_name('invoice.rtf.exe'))
+        self.assertEqual(None, registry.for_file_name('photo.bmp.bat'))
+
+    def test_form_rejects_file_with_supported_extension_in_the_middle(self):
+        files = {'attachment-attachment': SimpleUploadedFile('invoice.rtf.exe', 'MZ...')}
+        form = forms.RequiredAttachmentForm(data={}, files=files)
+        self.assertFalse(form.is_valid())
+
+    def test_registers_extra_mime_types_from_settings(self):
+        with self.settings(ATTACHMENTS_MIME_TYPES=(('text/plain', ('txt',), 'document'),)):
+            registry = mime.get_registry()
+            self.assertEqual('text/plain', registry.for_file_name('notes.txt'))
+            self.assertEqual(Attachment.DOCUMENT, registry.attachment_type('text/plain'))
+        self.assertEqual(None, mime.get_registry().for_file_name('notes.txt'))
+
+    def test_raises_improperly_configured_for_unknown_attachment_type(self):
+        with self.assertRaises(ImproperlyConfigured):
+            mime.MimeRegistry([('text/plain', ('txt',), 'spreadsheet')])
+
+    def test_does_not_sniff_payload_by_default(self):
+        self.assertEqual(Attachment.PNG, mime.get_registry().detect('x.png', ContentFile('not a png')))
+
+    def test_sniffing_rejects_payload_that_does_not_match_its_extension(self):
+        registry = mime.get_registry()
+        with self.settings(ATTACHMENTS_SNIFF_MIME_TYPES=True):
+            self.assertEqual(None, registry.detect('x.png', ContentFile('MZ\x90\x00 not a png')))
+            self.assertEqual(Attachment.PDF, registry.detect('x.pdf', ContentFile('%PDF-1.4 ...')))
+            self.assertEqual(Attachment.EXCELX, registry.detect('x.xlsx', ContentFile('PK\x03\x04...')))
+
+    def test_sniffing_leaves_upload_at_its_start(self):
+        upload = SimpleUploadedFile('x.gif', 'GIF89a rest of the image')
+        with self.settings(ATTACHMENTS_SNIFF_MIME_TYPES=True):
+            self.assertEqual(Attachment.GIF, mime.get_registry().detect(upload.name, upload))
+        self.assertEqual('GIF89a rest of the image', upload.read())
+
+    def test_save_does_not_store_type_when_sniffed_payload_does_not_match(self):
+        second = Second.objects.create(third_field="xyz")
+        with self.settings(ATTACHMENTS_SNIFF_MIME_TYPES=True):
+            self.assertRaises(Exception, Attachment.objects.create, file_name="something.jpg",
+                              attach_to=second, attachment="not really a jpeg")
+
+class EagerRenditionTests(test.TestCase):
+
+    @patch('attachments.workers.get_backend')
+    def test_does_not_queue_renditions_by_default(self, get_backend):
+        second = Second.objects.create(third_field="xyz")
+        Attachment.objects.create(file_name="x.png", attach_to=second, attachment="xxx")
+        self.assertFalse(get_backend.called)
+
+    @override_settings(ATTACHMENTS_EAGER_RENDITIONS=True)
+    @patch('attachments.workers.get_backend')
+    def test_queues_renditions_for_saved_images_when_eager(self, get_backend):
+        second = Second.objects.create(third_field="xyz")
+        attachment = Attachment.objects.create(file_name="x.png", attach_to=second, attachment="xxx")
+        get_backend.return_value.submit.assert_called_once_with(attachment.pk)
+
+    @override_settings(ATTACHMENTS_EAGER_RENDITIONS=True)
+    @patch('attachments.workers.get_backend')
+    def test_does_not_queue_renditions_for_documents(self, get_backend):
+        second = Second.objects.create(third_field="xyz")
+        Attachment.objects.create(file_name="x.pdf", attach_to=second, attachment="xxx")
+        self.assertFalse(get_backend.called)
+
+    @override_settings(ATTACHMENTS_RENDITION_PROFILES=[{'format': 'webp'}, {'format': 'jpeg', 'quality': 70}])
+    @patch('attachments.renditions.get_rendition')
+    def test_generate_renditions_creates_thumbnail_and_preview_for_each_profile(self, get_rendition):
+        second = Second.objects.create(third_field="xyz")
+        attachment = Attachment.objects.create(file_name="x.png", attach_to=second, attachment="xxx")
+        workers.generate_renditions(attachment.pk)
+        self.assertEqual([
+            (attachment.pk, renditions.PREVIEW_SIZE, 'webp'),
+            (attachment.pk, renditions.PREVIEW_SIZE, 'jpeg'),
+            (attachment.pk, renditions.THUMBNAIL_SIZE, 'webp'),
+            (attachment.pk, renditions.THUMBNAIL_SIZE, 'jpeg'),
+        ], [(args[0].pk, args[1], args[2].format) for args, kwargs in get_rendition.call_args_list])
+
+    @override_settings(ATTACHMENTS_EAGER_RENDITIONS=True)
+    @patch('attachments.workers.get_backend')
+    @patch('attachments.renditions.invalidate')
+    def test_keeps_renditions_when_only_metadata_changes(self, invalidate, get_backend):
+        second = Second.objects.create(third_field="xyz")
+        attachment = Attachment.objects.create(file_name="x.png", attach_to=second, attachment="xxx")
+        for saved in (Attachment.objects.get(pk=attachment.pk), Attachment.objects.with_payload().get(pk=attachment.pk)):
+            saved.description = "new description"
+            saved.save()
+        self.assertEqual(1, get_backend.return_value.submit.call_count)
+        self.assertEqual(1, invalidate.call_count)
+
+        saved.attachment = "yyy"
+        saved.save()
+        self.assertEqual(2, get_backend.return_value.submit.call_count)
+        invalidate.assert_called_with(attachment.pk)
+
+    @patch('attachments.workers.LOOKUP_RETRY_DELAY', 0)
+    @patch('attachments.renditions.get_rendition')
+    def test_generate_renditions_ignores_missing_attachments(self, get_rendition):
+        workers.generate_renditions(12345)
+        self.assertFalse(get_rendition.called)
+
+    @patch('attachments.workers.LOOKUP_RETRY_DELAY', 0)
+    @patch('attachments.renditions.get_rendition')
+    def test_generate_renditions_waits_for_attachment_to_be_committed(self, get_rendition):
+        second = Second.objects.create(third_field="xyz")
+        attachment = Attachment.objects.create(file_name="x.png", attach_to=second, attachment="xxx")
+        lookups = [Attachment.DoesNotExist, Attachment.DoesNotExist, attachment]
+        with patch.object(Attachment.objects, 'get', Mock(side_effect=lookups)) as get:
+            workers.generate_renditions(attachment.pk)
+        self.assertEqual(3, get.call_count)
+        self.assertTrue(get_rendition.called)
+
+    @patch('attachments.workers.generate_renditions')
+    def test_local_queue_backend_generates_renditions_on_worker_threads(self, generate_renditions):
+        backend = workers.LocalQueueBackend(workers=3)
+        for pk in range(10):
+            backend.submit(pk)
+        backend.join()
+        self.assertEqual(sorted(range(10)), sorted(args[0] for args, kwargs in generate_renditions.call_args_list))
+        self.assertEqual(3, len(backend._threads))
+
+    @patch('attachments.workers.generate_renditions')
+    def test_generate_renditions_command_submits_every_image(self, generate_renditions):
+        second = Second.objects.create(third_field="xyz")
+        images = [Attachment.objects.create(file_name="x.png", attach_to=second, attachment="xxx") for _ in range(3)]
+        Attachment.objects.create(file_name="x.pdf", attach_to=second, attachment="xxx")
+
+        call_command('generate_renditions', batch_size=2, workers=2)
+        self.assertEqual(sorted(image.pk for image in images),
+                         sorted(args[0] for args, kwargs in generate_renditions.call_args_list))
+
+
+class IngestTests(test.TestCase):
+
+    def test_ingest_copies_file_into_destination_in_chunks(self):
+        uploaded = ContentFile("abcdefghij", name="x.pdf")
+        destination = Mock()
+        digest = ingest.ingest(uploaded, destination, chunk_size=4)
+        self.assertEqual([(('abcd',), {}), (('efgh',), {}), (('ij',), {})], destination.write.call_args_list)
+        self.assertEqual(10, digest.size)
+        self.assertEqual(hashlib.sha256("abcdefghij").hexdigest(), digest.content_hash)
+
+    @override_settings(ATTACHMENTS_INGEST_CHUNK_SIZE=3)
+    def test_ingest_uses_configured_chunk_size(self):
+        uploaded = Mock()
+        uploaded.chunks.return_value = []
+        ingest.ingest(uploaded, Mock())
+        uploaded.chunks.assert_called_once_with(3)
+
+    def test_save_stores_uploaded_file_with_size_and_content_hash(self):
+        second = Second.objects.create(third_field="xyz")
+        uploaded = SimpleUploadedFile("scan.pdf", "%PDF-1.4 lots of bytes")
+        attachment = Attachment.objects.create(attach_to=second, attachment=uploaded)
+
+        attachment = Attachment.objects.get(pk=attachment.pk)
+        self.assertEqual("scan.pdf", attachment.file_name)
+        self.assertEqual("%PDF-1.4 lots of bytes", attachment.attachment)
+        self.assertEqual(22, attachment.size)
+        self.assertEqual(hashlib.sha256("%PDF-1.4 lots of bytes").hexdigest(), attachment.content_hash)
+
+    def test_save_computes_size_and_content_hash_of_raw_payload(self):
+        second = Second.objects.create(third_field="xyz")
+        attachment = Attachment.objects.create(file_name="x.doc", attach_to=second, attachment="xxx")
+        self.assertEqual(3, attachment.size)
+        self.assertEqual(hashlib.sha256("xxx").hexdigest(), attachment.content_hash)
+
+
+class StorageTests(test.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        storages = patch.dict('attachments.storage._storages', clear=True)
+        storages.start()
+        self.addCleanup(storages.stop)
+        self.second = Second.objects.create(third_field="xyz")
+
+    def create(self, payload="file bytes", **kwargs):
+        return Attachment.objects.create(file_name="x.pdf", attach_to=self.second, attachment=payload, **kwargs)
+
+    def test_keeps_payload_in_database_by_default(self):
+        attachment = self.create()
+        self.assertEqual('database', attachment.storage)
+        self.assertEqual('file bytes', Attachment.objects.get(pk=attachment.pk).open_payload().read())
+
+    def test_round_trips_binary_payloads_through_database_tables(self):
+        payload = '\x89PNG\r\n\x1a\n\x00\xff\xfe' + ''.join(chr(i) for i in range(256))
+        for name in ('database', 'shared'):
+            with self.settings(ATTACHMENTS_STORAGE=name):
+                attachment = self.create(SimpleUploadedFile("x.png", payload))
+                self.assertEqual(payload, Attachment.objects.get(pk=attachment.pk).open_payload().read())
+                self.assertEqual(payload, Attachment.objects.with_payload().get(pk=attachment.pk).open_payload().read())
+
+    def test_keeps_payload_on_file_system_when_configured(self):
+        with self.settings(ATTACHMENTS_STORAGE='filesystem', ATTACHMENTS_STORAGE_ROOT=self.root):
+            attachment = self.create(SimpleUploadedFile("x.pdf", "file bytes"))
+            path = attachment.get_storage().path(attachment)
+
+            attachment = Attachment.objects.get(pk=attachment.pk)
+            self.assertEqual('filesystem', attachment.storage)
+            self.assertEqual(None, attachment.attachment)
+            self.assertTrue(path.startswith(self.root))
+            self.assertEqual('file bytes', attachment.open_payload().read())
+            self.assertEqual(10, attachment.size)
+
+    def test_removes_file_when_attachment_is_deleted(self):
+        with self.settings(ATTACHMENTS_STORAGE='filesystem', ATTACHMENTS_STORAGE_ROOT=self.root):
+            attachment = self.create()
+            path = attachment.get_storage().path(attachment)
+            attachment.delete()
+            self.assertFalse(os.path.exists(path))
+
+    def test_removes_previous_file_when_payload_is_replaced(self):
+        with self.settings(ATTACHMENTS_STORAGE='filesystem', ATTACHMENTS_STORAGE_ROOT=self.root):
+            attachment = self.create()
+            previous_path = attachment.get_storage().path(attachment)
+            attachment.attachment = SimpleUploadedFile("y.pdf", "new bytes")
+            attachment.save()
+            self.assertFalse(os.path.exists(previous_path))
+            self.assertEqual('new bytes', attachment.open_payload().read())
+
+    def test_replaces_payload_assigned_as_a_string(self):
+        for name in ('database', 'filesystem'):
+            with self.settings(ATTACHMENTS_STORAGE=name, ATTACHMENTS_STORAGE_ROOT=self.root):
+                attachment = self.create()
+                previous_key = attachment.storage_key
+                attachment = Attachment.objects.with_payload().get(pk=attachment.pk)
+                attachment.attachment = "new bytes"
+                attachment.save()
+
+                saved = Attachment.objects.get(pk=attachment.pk)
+                self.assertEqual('new bytes', saved.open_payload().read())
+                self.assertEqual((9, hashlib.sha256("new bytes").hexdigest()), (saved.size, saved.content_hash))
+                if previous_key:
+                    self.assertFalse(os.path.exists(saved.get_storage().key_path(previous_key)))
+
+    def test_doesnt_store_unchanged_payload_again(self):
+        attachment = Attachment.objects.with_payload().get(pk=self.create().pk)
+        with patch.object(Attachment, 'store_payload') as store_payload:
+            attachment.description = "new description"
+            attachment.save()
+        self.assertFalse(store_payload.called)
+
+    def test_raises_improperly_configured_for_unknown_storage(self):
+        self.assertRaises(ImproperlyConfigured, storage.get_storage, 'floppy')
+
+    def test_move_payload_between_storages(self):
+        attachment = self.create()
+        with self.settings(ATTACHMENTS_STORAGE_ROOT=self.root):
+            filesystem = storage.get_storage('filesystem')
+            self.assertTrue(storage.move_payload(Attachment.objects.defer('attachment').get(pk=attachment.pk), filesystem))
+
+            moved = Attachment.objects.get(pk=attachment.pk)
+            self.assertEqual('filesystem', moved.storage)
+            self.assertEqual(None, moved.attachment)
+            self.assertEqual('file bytes', moved.open_payload().read())
+            self.assertEqual(attachment.content_hash, moved.content_hash)
+
+            path = filesystem.path(moved)
+            self.assertTrue(storage.move_payload(moved, storage.get_storage('database')))
+            self.assertFalse(os.path.exists(path))
+            back = Attachment.objects.get(pk=attachment.pk)
+            self.assertEqual(('database', ''), (back.storage, back.storage_key))
+            self.assertEqual('file bytes', back.attachment)
+
+    def test_move_payload_leaves_rows_that_changed_while_moving(self):
+        attachment = self.create()
+        stale = Attachment.objects.get(pk=attachment.pk)
+        attachment.attachment = SimpleUploadedFile("y.pdf", "new bytes")
+        attachment.save()
+
+        with self.settings(ATTACHMENTS_STORAGE_ROOT=self.root):
+            self.assertFalse(storage.move_payload(stale, storage.get_storage('filesystem')))
+            self.assertEqual([], [name for _, _, names in os.walk(self.root) for name in names])
+        self.assertEqual('database', Attachment.objects.get(pk=attachment.pk).storage)
+
+    def test_migrate_attachment_storage_command_moves_every_row(self):
+        attachments = [self.create("payload %s" % i) for i in range(3)]
+        with self.settings(ATTACHMENTS_STORAGE_ROOT=self.root):
+            call_command('migrate_attachment_storage', 'filesystem', batch_size=2)
+        for attachment in attachments:
+            moved = Attachment.objects.get(pk=attachment.pk)
+            self.assertEqual('filesystem', moved.storage)
+            self.assertEqual(attachment.attachment, moved.open_payload().read())
+
+    def test_long_blob_column_type_depends_on_database(self):
+        field = LongBlob()
+        self.assertEqual('longblob', field.db_type(Mock(vendor='mysql')))
+        self.assertEqual('bytea', field.db_type(Mock(vendor='postgresql')))
+        self.assertEqual('blob', field.db_type(Mock(vendor='sqlite')))
+
+class SharedBlobStorageTests(test.TestCase):
+
+    def setUp(self):
+        self.second = Second.objects.create(third_field="xyz")
+
+    def create(self, payload):
+        with self.settings(ATTACHMENTS_STORAGE='shared'):
+            return Attachment.objects.create(file_name="x.pdf", attach_to=self.second, attachment=payload)
+
+    def test_identical_payloads_share_one_blob(self):
+        first = self.create("signed contract")
+        second = self.create("signed contract")
+
+        blob = Blob.objects.get()
+        self.assertEqual(2, blob.reference_count)
+        self.assertEqual(first.content_hash, blob.content_hash)
+        self.assertEqual((blob.content_hash, blob.content_hash), (first.storage_key, second.storage_key))
+        self.assertEqual("signed contract", Attachment.objects.get(pk=second.pk).open_payload().read())
+
+    def test_different_payloads_get_their_own_blob(self):
+        self.create("one")
+        self.create("two")
+        self.assertEqual(2, Blob.objects.count())
+
+    def test_blob_is_deleted_with_its_last_reference(self):
+        first = self.create("signed contract")
+        second = self.create("signed contract")
+
+        first.delete()
+        self.assertEqual(1, Blob.objects.get().reference_count)
+        second.delete()
+        self.assertEqual(0, Blob.objects.count())
+
+    def test_reuploading_same_payload_keeps_reference_count(self):
+        attachment = self.create("signed contract")
+        attachment.attachment = SimpleUploadedFile("x.pdf", "signed contract")
+        attachment.save()
+        self.assertEqual(1, Blob.objects.get().reference_count)
+
+    def test_replacing_payload_releases_previous_blob(self):
+        attachment = self.create("signed contract")
+        attachment.attachment = SimpleUploadedFile("x.pdf", "amended contract")
+        attachment.save()
+        self.assertEqual(["amended contract"], [blob.data for blob in Blob.objects.all()])
+
+    def test_dedupe_command_moves_rows_into_shared_blobs(self):
+        for payload in ("logo", "logo", "logo", "letter"):
+            Attachment.objects.create(file_name="x.pdf", attach_to=self.second, attachment=payload)
+
+        out = StringIO()
+        call_command('dedupe_attachments', batch_size=3, stdout=out)
+
+        self.assertEqual(set(['shared']), set(Attachment.objects.values_list('storage', flat=True)))
+        self.assertEqual({'logo': 3, 'letter': 1}, dict((blob.data, blob.reference_count) for blob in Blob.objects.all()))
+        self.assertIn("reclaimed 8 bytes", out.getvalue())
+
+class S3StorageTests(test.TestCase):
+
+    def setUp(self):
+        boto = patch('attachments.storage.boto')
+        self.boto = boto.start()
+        self.addCleanup(boto.stop)
+        self.bucket = self.boto.connect_s3.return_value.get_bucket.return_value
+
+    @override_settings(ATTACHMENTS_S3_BUCKET='attachments', ATTACHMENTS_S3_CONNECTION_OPTIONS={'host': 'localhost'})
+    def test_connects_to_configured_bucket(self):
+        storage.S3Storage().bucket
+        self.boto.connect_s3.assert_called_once_with(None, None, host='localhost')
+        self.boto.connect_s3.return_value.get_bucket.assert_called_once_with('attachments', validate=False)
+
+    @override_settings(ATTACHMENTS_S3_BUCKET='attachments')
+    def test_uploads_payload_under_new_key(self):
+        attachment = Attachment(mimetype='application/pdf')
+        digest = storage.S3Storage().save(attachment, ContentFile("file bytes"))
+
+        self.bucket.new_key.assert_called_once_with('attachments/' + attachment.storage_key)
+        set_contents = self.bucket.new_key.return_value.set_contents_from_file
+        self.assertEqual({'Content-Type': 'application/pdf'}, set_contents.call_args[1]['headers'])
+        self.assertEqual(None, attachment.attachment)
+        self.assertEqual(10, digest.size)
+
+    @override_settings(ATTACHMENTS_S3_BUCKET='attachments')
+    def test_opens_and_deletes_payload_by_key(self):
+        s3 = storage.S3Storage()
+        self.bucket.get_key.return_value.size = 10
+        stream = s3.open(Attachment(storage_key='abc'))
+        self.bucket.get_key.assert_called_once_with('attachments/abc')
+        self.assertEqual(10, stream.size)
+
+        s3.delete('abc')
+        self.bucket.delete_key.assert_called_once_with('attachments/abc')
+
+    @override_settings(ATTACHMENTS_S3_BUCKET='attachments')
+    def test_raises_io_error_for_missing_payload(self):
+        self.bucket.get_key.return_value = None
+        self.assertRaises(IOError, storage.S3Storage().open, Attachment(storage_key='abc'))
+
+    def test_requires_bucket(self):
+        self.assertRaises(ImproperlyConfigured, storage.S3Storage)
+
+    def test_s3_file_reopens_key_with_range_after_seek(self):
+        key = Mock(size=10, resp=None)
+        key.read.return_value = '6789'
+        s3_file = storage.S3File(key)
+        s3_file.seek(6)
+        self.assertEqual('6789', s3_file.read(4))
+        key.open_read.assert_called_once_with(headers={'Range': 'bytes=6-'})
+        self.assertEqual(10, s3_file.tell())
+        self.assertEqual('', s3_file.read(4))
+
+
+class AttachmentSummaryTests(test.TestCase):
+
+    def setUp(self):
+        self.second = Second.objects.create(third_field="xyz")
+
+    def test_counts_attachments_by_type_on_save(self):
+        Attachment.objects.create(file_name="x.png", attach_to=self.second, attachment="123")
+        Attachment.objects.create(file_name="x.pdf", attach_to=self.second, attachment="4567")
+        latest = Attachment.objects.create(file_name="x.doc", attach_to=self.second, attachment="89")
+
+        summary = AttachmentSummary.objects.for_object(self.second)
+        self.assertEqual((3, 1, 2, 9), (summary.count, summary.image_count, summary.document_count, summary.total_bytes))
+        self.assertEqual(latest.attached_at, summary.latest_attached_at)
+
+    def test_updates_summary_on_delete(self):
+        image = Attachment.objects.create(file_name="x.png", attach_to=self.second, attachment="123")
+        Attachment.objects.create(file_name="x.pdf", attach_to=self.second, attachment="4567")
+        Attachment.objects.get(pk=image.pk).delete()
+
+        summary = AttachmentSummary.objects.for_object(self.second)
+        self.assertEqual((1, 0, 1, 4), (summary.count, summary.image_count, summary.document_count, summary.total_bytes))
+
+    def test_removes_summary_with_last_attachment(self):
+        attachment = Attachment.objects.create(file_name="x.png", attach_to=self.second, attachment="123")
+        attachment.delete()
+        self.assertEqual(0, AttachmentSummary.objects.count())
+        self.assertEqual(0, AttachmentSummary.objects.for_object(self.second).count)
+
+    def test_reads_summaries_for_many_objects_in_one_query(self):
+        first = First.objects.create(first_field="asdf", second_field="xyz")
+        empty = Second.objects.create(third_field="abc")
+        Attachment.objects.create(file_name="x.png", attach_to=self.second, attachment="123")
+        Attachment.objects.create(file_name="x.pdf", attach_to=first, attachment="4567")
+        Attachment.objects.create(file_name="x.pdf", attach_to=first, attachment="4567")
+
+        with self.assertNumQueries(1):
+            summaries = AttachmentSummary.objects.for_objects([self.second, first, empty])
+        self.assertEqual([1, 2, 0], [summaries[model].count for model in (self.second, first, empty)])
+
+    def test_refresh_updates_summary_inserted_concurrently(self):
+        attachment = Attachment.objects.create(file_name="x.png", attach_to=self.second, attachment="123")
+        Attachment.objects.filter(pk=attachment.pk).update(size=5)
+        update, updates = QuerySet.update, []
+
+        def racing_update(queryset, **values):
+            # the first update runs before the other save inserts the row, so matches nothing
+            updates.append(values)
+            return update(queryset, **values) if len(updates) > 1 else 0
+
+        with patch.object(QuerySet, 'update', racing_update):
+            AttachmentSummary.objects.refresh(attachment.content_type_id, attachment.object_id)
+        self.assertEqual(2, len(updates))
+        self.assertEqual((1, 5), (AttachmentSummary.objects.get().count, AttachmentSummary.objects.get().total_bytes))
+
+    def test_rebuild_command_groups_content_types_sharing_a_name(self):
+        second_type = ContentType.objects.get_for_model(Second)
+        twin = ContentType.objects.create(app_label='other_app', model='second', name=second_type.name)
+        for content_type, object_id in ((second_type, 1), (twin, 1), (second_type, 2), (twin, 2)):
+            Attachment.objects.create(file_name="x.pdf", content_type=content_type, object_id=object_id,
+                                      attachment="123")
+
+        connection.use_debug_cursor = True
+        try:
+            del connection.queries[:]
+            call_command('rebuild_attachment_summaries', batch_size=10, stdout=StringIO())
+        finally:
+            connection.use_debug_cursor = None
+        # ordered by ContentType's name, rows of the two types could interleave and be summarised twice
+        totals = [query['sql'] for query in connection.queries if 'GROUP BY' in query['sql']]
+        self.assertIn('ORDER BY "attachments_attachment"."content_type_id" ASC', totals[0])
+        self.assertEqual([(second_type.pk, 1), (second_type.pk, 2), (twin.pk, 1), (twin.pk, 2)],
+                         sorted(AttachmentSummary.objects.values_list('content_type', 'object_id')))
+
+    def test_rebuild_command_recreates_summaries(self):
+        first = First.objects.create(first_field="asdf", second_field="xyz")
+        Attachment.objects.create(file_name="x.png", attach_to=self.second, attachment="123")
+        Attachment.objects.create(file_name="x.pdf", attach_to=first, attachment="4567")
+        Attachment.objects.create(file_name="x.png", attach_to=first, attachment="89")
+        expected = [(s.content_type_id, s.object_id, s.count, s.image_count, s.document_count, s.total_bytes)
+                    for s in AttachmentSummary.objects.order_by('pk')]
+        AttachmentSummary.objects.update(count=0)
+
+        call_command('rebuild_attachment_summaries', batch_size=1, stdout=StringIO())
+        rebuilt = [(s.content_type_id, s.object_id, s.count, s.image_count, s.document_count, s.total_bytes)
+                   for s in AttachmentSummary.objects.all()]
+        self.assertEqual(sorted(expected), sorted(rebuilt))
+
+class UploadSessionTests(test.TestCase):
+
+    def setUp(self):
+        self.second = Second.objects.create(third_field="xyz")
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(ATTACHMENTS_UPLOAD_ROOT=self.root)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.root)
+
+    def start(self, data="0123456789", **extra):
+        params = dict(content_type=ContentType.objects.get_for_model(self.second).pk, object_id=self.second.pk,
+                      file_name="scan.pdf", size=len(data), content_hash=hashlib.sha256(data).hexdigest(),
+                      tag="scans")
+        params.update(extra)
+        response = self.client.post(reverse("attachments:start_upload"), params)
+        return response, json.loads(response.content) if response.status_code == 201 else None
+
+    def put(self, state, offset, chunk):
+        return self.client.put("%s?offset=%d" % (state['url'], offset), chunk,
+                               content_type='application/octet-stream')
+
+    def test_attaches_file_uploaded_in_chunks(self):
+        response, state = self.start()
+        self.assertEqual((201, 0, 10), (response.status_code, state['offset'], state['size']))
+
+        self.assertEqual(4, json.loads(self.put(state, 0, "0123").content)['offset'])
+        self.assertEqual(10, json.loads(self.put(state, 4, "456789").content)['offset'])
+        self.assertEqual(10, json.loads(self.client.get(state['url']).content)['offset'])
+
+        response = self.client.post(state['url'])
+        self.assertEqual(201, response.status_code)
+        attachment = Attachment.objects.get(pk=json.loads(response.content)['id'])
+        self.assertEqual(("scan.pdf", "scans", "0123456789", 10),
+                         (attachment.file_name, attachment.tag, attachment.open_payload().read(), attachment.size))
+        self.assertEqual(1, AttachmentSummary.objects.for_object(self.second).count)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual([], os.listdir(self.root))
+
+    def test_chunk_at_wrong_offset_is_answered_with_expected_offset(self):
+        response, state = self.start()
+        self.put(state, 0, "0123")
+
+        response = self.put(state, 0, "0123")
+        self.assertEqual((409, 4), (response.status_code, json.loads(response.content)['offset']))
+        self.assertEqual(409, self.put(state, 6, "6789").status_code)
+        self.assertEqual(4, UploadSession.objects.get().received)
+
+    def test_rejects_chunk_past_end_of_upload(self):
+        response, state = self.start()
+        self.assertEqual(400, self.put(state, 0, "0123456789ab").status_code)
+        self.assertEqual(0, UploadSession.objects.get().received)
+
+    @override_settings(ATTACHMENTS_UPLOAD_MAX_CHUNK_SIZE=4)
+    def test_rejects_oversized_chunk_before_reading_it(self):
+        response, state = self.start()
+        with patch('attachments.uploads.write_chunk') as write_chunk:
+            self.assertEqual(413, self.put(state, 0, "01234").status_code)
+        self.assertFalse(write_chunk.called)
+
+    @override_settings(ATTACHMENTS_INGEST_CHUNK_SIZE=3)
+    def test_copies_chunk_in_bounded_reads(self):
+        session = UploadSession.objects.start(self.second, "scan.pdf", 10)
+        source = Mock(read=Mock(side_effect=StringIO("0123456").read))
+        session.write_chunk(0, source, 7)
+
+        self.assertEqual([3, 3, 1], [args[0] for args, kwargs in source.read.call_args_list])
+        self.assertEqual("0123456", open(uploads.staging_path(session.token)).read())
+
+    def test_start_rejects_unsupported_file_type(self):
+        response, state = self.start(file_name="scan.exe")
+        self.assertEqual(400, response.status_code)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_finish_rejects_incomplete_upload(self):
+        response, state = self.start()
+        self.put(state, 0, "0123")
+
+        self.assertEqual(400, self.client.post(state['url']).status_code)
+        self.assertEqual(4, UploadSession.objects.get().received)
+        self.assertFalse(Attachment.objects.exists())
+
+    def test_finish_turns_away_corrupted_upload(self):
+        response, state = self.start(content_hash=hashlib.sha256("something else").hexdigest())
+        self.put(state, 0, "0123456789")
+
+        self.assertEqual(400, self.client.post(state['url']).status_code)
+        self.assertFalse(Attachment.objects.exists())
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual([], os.listdir(self.root))
+
+    @override_settings(ATTACHMENTS_SNIFF_MIME_TYPES=True)
+    def test_finish_sniffs_staged_file(self):
+        session = UploadSession.objects.start(self.second, "scan.pdf", 9)
+        session.write_chunk(0, StringIO("%PDF-1.4\n"), 9)
+        self.assertEqual("%PDF-1.4\n", session.finish().open_payload().read())
+
+        session = UploadSession.objects.start(self.second, "fake.pdf", 4)
+        session.write_chunk(0, StringIO("0123"), 4)
+        self.assertRaisesRegexp(uploads.UploadError, "unsupported", session.finish)
+        self.assertFalse(UploadSession.objects.filter(pk=session.pk).exists())
+
+    def test_finish_can_be_retried_after_storage_failure(self):
+        session = UploadSession.objects.start(self.second, "scan.pdf", 4)
+        session.write_chunk(0, StringIO("0123"), 4)
+        with patch.object(Attachment, 'store_payload', side_effect=IOError("disk full")):
+            self.assertRaises(IOError, session.finish)
+
+        self.assertEqual("0123", UploadSession.objects.get(pk=session.pk).finish().open_payload().read())
+
+    def test_upload_being_finished_takes_no_more_chunks_and_finishes_once(self):
+        session = UploadSession.objects.start(self.second, "scan.pdf", 8)
+        session.write_chunk(0, StringIO("0123"), 4)
+        os.rename(uploads.staging_path(session.token), uploads.finishing_path(session.token))
+
+        self.assertRaisesRegexp(uploads.UploadError, "being finished", session.write_chunk, 4, StringIO("4567"), 4)
+        session.received = 8
+        self.assertRaisesRegexp(uploads.UploadError, "already being finished", session.finish)
+        self.assertFalse(Attachment.objects.exists())
+
+    def test_delete_abandons_upload(self):
+        response, state = self.start()
+        self.put(state, 0, "0123")
+
+        self.assertEqual(200, self.client.delete(state['url']).status_code)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual([], os.listdir(self.root))
+        self.assertRaises(http.Http404, views.upload, RequestFactory().get(state['url']), state['token'])
+
+    def test_garbage_collection_deletes_stale_sessions_and_orphaned_files(self):
+        stale = UploadSession.objects.start(self.second, "old.pdf", 4)
+        fresh = UploadSession.objects.start(self.second, "new.pdf", 4)
+        UploadSession.objects.filter(pk=stale.pk).update(updated_at=datetime.datetime(2000, 1, 1))
+        orphan = os.path.join(self.root, "0" * 32)
+        open(orphan, 'w').close()
+        os.utime(orphan, (0, 0))
+
+        call_command('clean_upload_sessions', max_age=3600, stdout=StringIO())
+        self.assertEqual([fresh.pk], list(UploadSession.objects.values_list('pk', flat=True)))
+        self.assertEqual([fresh.token], os.listdir(self.root))
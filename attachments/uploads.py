@@ -0,0 +1,97 @@
+import datetime
+import os
+import time
+
+from django.conf import settings
+
+from attachments import ingest
+from attachments.utils import ensure_directory
+
+DEFAULT_MAX_CHUNK_SIZE = 8 * 1024 * 1024
+# seconds an upload session may sit idle before it is garbage collected
+DEFAULT_SESSION_TIMEOUT = 24 * 60 * 60
+
+
+class UploadError(Exception):
+    pass
+
+
+class OffsetMismatch(UploadError):
+    """
+    A chunk didn't start where the upload left off, e.g. it was a retry of one
+    that had arrived after all. offset is where the next chunk has to start.
+    """
+
+    def __init__(self, offset):
+        super(OffsetMismatch, self).__init__("Expected a chunk at offset %d" % offset)
+        self.offset = offset
+
+
+def get_max_chunk_size():
+    return getattr(settings, 'ATTACHMENTS_UPLOAD_MAX_CHUNK_SIZE', DEFAULT_MAX_CHUNK_SIZE)
+
+
+def get_session_timeout():
+    return datetime.timedelta(seconds=getattr(settings, 'ATTACHMENTS_UPLOAD_SESSION_TIMEOUT',
+                                              DEFAULT_SESSION_TIMEOUT))
+
+
+def get_upload_root():
+    return getattr(settings, 'ATTACHMENTS_UPLOAD_ROOT', None) or \
+        os.path.join(settings.MEDIA_ROOT, 'attachments', 'uploads')
+
+
+def staging_path(token):
+    return os.path.join(get_upload_root(), token)
+
+
+def finishing_path(token):
+    return staging_path(token) + '.finishing'
+
+
+def create_staging_file(token):
+    ensure_directory(get_upload_root())
+    open(staging_path(token), 'wb').close()
+
+
+def delete_staging_file(token):
+    for path in (staging_path(token), finishing_path(token)):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def write_chunk(token, offset, source, length):
+    """
+    Copies length bytes of the readable source into the staging file at
+    offset, no more than ATTACHMENTS_INGEST_CHUNK_SIZE bytes at a time.
+    """
+    chunk_size, remaining = ingest.get_chunk_size(), length
+    try:
+        staging = open(staging_path(token), 'r+b')
+    except IOError:
+        raise UploadError("The upload is being finished")
+    with staging:
+        staging.seek(offset)
+        while remaining:
+            chunk = source.read(min(chunk_size, remaining))
+            if not chunk:
+                raise UploadError("Chunk ended after %d of %d bytes" % (length - remaining, length))
+            staging.write(chunk)
+            remaining -= len(chunk)
+
+
+def orphaned_files(tokens, max_age):
+    """
+    Staging files untouched for longer than max_age whose session is gone
+    (not in tokens), e.g. because a process died between the two deletes.
+    """
+    root = get_upload_root()
+    if not os.path.isdir(root):
+        return
+    cutoff = time.time() - max_age.total_seconds()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.split('.')[0] not in tokens and os.path.getmtime(path) < cutoff:
+            yield path
@@ -5,7 +5,14 @@ urlpatterns = patterns('attachments',
     url(r'^thumbnail/(?P<identifier>\d+)/$', views.serve, name='thumbnail', kwargs={'action':'thumbnail'}),
     url(r'^preview/(?P<identifier>\d+)/$', views.serve, name='preview', kwargs={'action':'preview'}),
     url(r'^download/(?P<identifier>\d+)/$', views.serve, name='download', kwargs={'action':'download'}),
+    url(r'^rendition/(?P<name>[\w-]+)/(?P<identifier>\d+)/$', views.rendition, name='rendition'),
+    url(r'^thumbnails/$', views.thumbnails, name='thumbnails'),
+    url(r'^page/$', views.attachment_page, name='page'),
+    url(r'^upload/$', views.start_upload, name='start_upload'),
+    url(r'^upload/(?P<token>[0-9a-f]{32})/$', views.upload, name='upload'),
 
     url(r'^edit/$', views.edit_description, name="edit"),
     url(r'^delete/$', views.delete_attachment, name="delete"),
+    url(r'^delete/bulk/$', views.bulk_delete, name="bulk_delete"),
+    url(r'^retag/$', views.retag, name="retag"),
 )
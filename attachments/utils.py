@@ -0,0 +1,21 @@
+import os
+
+from django.utils.importlib import import_module
+
+
+def get_class(path):
+    """
+    Returns the class named by a dotted path such as 'attachments.renditions.CacheStore'.
+    """
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)
+
+
+def ensure_directory(directory):
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # somebody else may have created it in the meantime
+            if not os.path.isdir(directory):
+                raise
@@ -1,33 +1,179 @@
+import base64
+import json
+
 from django import http
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.urlresolvers import reverse
+from django.utils import dateformat, timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import require_POST
+from attachments import instrumentation
 from attachments import models
+from attachments import offload
+from attachments import renditions
+from attachments import responses
+from attachments import uploads
+
+DEFAULT_BATCH_LIMIT = 100
 
 class ImageServer(object):
 
-    def __init__(self, attachment):
+    def __init__(self, attachment, profile=None):
         self.attachment = attachment
+        self.profile = profile
 
     def download(self):
-        return self.attachment.attachment
+        return self.attachment.open_payload()
+
+    def download_path(self):
+        return self.attachment.payload_path()
+
+    def rendition(self, named):
+        return renditions.get_rendition(self.attachment, max_size=named.size,
+                                        profile=named.profile or self.profile, crop=named.crop)
+
+    def rendition_path(self, named):
+        if offload.get_offloader() is None:
+            return None
+        return renditions.get_rendition_path(self.attachment, max_size=named.size,
+                                             profile=named.profile or self.profile, crop=named.crop)
 
     def preview(self):
-        return self.attachment.create_thumbnail(max_size=550)
+        return self.rendition(renditions.get_named_rendition('preview'))
 
     def thumbnail(self):
-        return self.attachment.create_thumbnail(max_size=100)
+        return self.rendition(renditions.get_named_rendition('thumbnail'))
 
 def serve(request, action, identifier):
-    attachment = models.Attachment.objects.get(pk=identifier)
+    if action == 'download':
+        return download(request, identifier)
+    return rendition(request, action, identifier)
+
+@instrumentation.instrumented('download')
+def download(request, identifier):
+    with instrumentation.stage('select'):
+        attachment = models.Attachment.objects.get(pk=identifier)
+    server = ImageServer(attachment)
+    return responses.download(request, attachment, server.download, server.download_path())
+
+@instrumentation.instrumented('rendition')
+def rendition(request, name, identifier):
+    # only renditions named in settings can be asked for
+    named = renditions.get_named_rendition(name)
+    if named is None:
+        raise http.Http404("No rendition named %r" % name)
+
+    with instrumentation.stage('select'):
+        attachment = models.Attachment.objects.get(pk=identifier)
+    profile = named.profile or renditions.negotiate(attachment, request.META.get('HTTP_ACCEPT'))
+    server = ImageServer(attachment, profile)
+
+    try:
+        response = responses.rendition(request, attachment, named, profile, lambda: server.rendition(named),
+                                       server.rendition_path(named))
+    except renditions.RenderingBusy:
+        return responses.busy()
+    except renditions.ImageTooLarge as e:
+        return responses.unrenderable(str(e))
+    if not named.profile:
+        response['Vary'] = 'Accept'
+    return response
+
+@instrumentation.instrumented('thumbnails')
+def thumbnails(request):
+    """
+    The thumbnails (or another named rendition) of many attachments as one JSON
+    object of attachment id to image src, so a carousel makes one request
+    instead of one per image. Images come back as data: URIs built from the
+    rendition store; documents as their icon URLs.
+    """
+    named = renditions.get_named_rendition(request.GET.get('name', 'thumbnail'))
+    if named is None:
+        raise http.Http404("No rendition named %r" % request.GET['name'])
+    try:
+        pks, filters = _selection(request)
+    except ValueError as e:
+        return http.HttpResponseBadRequest(str(e))
+
+    queryset = models.Attachment.objects.filter(**filters)
+    if pks is not None:
+        queryset = queryset.filter(pk__in=pks)
+    limit = getattr(settings, 'ATTACHMENTS_BATCH_LIMIT', DEFAULT_BATCH_LIMIT)
+
+    sources, accept = {}, request.META.get('HTTP_ACCEPT')
+    with instrumentation.stage('select'):
+        attachments = list(queryset.order_by('pk')[:limit])
+    for attachment in attachments:
+        if attachment.attachment_type == models.Attachment.IMAGE:
+            profile = named.profile or renditions.negotiate(attachment, accept)
+            try:
+                data = ImageServer(attachment, profile).rendition(named)
+            except (renditions.RenderingBusy, renditions.ImageTooLarge, IOError):
+                # let the client fetch this one on its own, so one bad or busy image doesn't fail the batch
+                sources[attachment.pk] = attachment.rendition_url(named.name)
+                continue
+            sources[attachment.pk] = 'data:%s;base64,%s' % (profile.mimetype(attachment.mimetype),
+                                                            base64.b64encode(data))
+        else:
+            sources[attachment.pk] = attachment.rendition_url(named.name)
+
+    response = http.HttpResponse(json.dumps(sources), mimetype='application/json')
+    if not named.profile:
+        response['Vary'] = 'Accept'
+    return response
+
+def _cursor(attachment):
+    return '%s,%s' % (attachment.attached_at.isoformat(), attachment.pk)
 
-    image_server = ImageServer(attachment)
-    file_to_serve = getattr(image_server, action)()
+def _parse_cursor(cursor):
+    attached_at, _, pk = cursor.rpartition(',')
+    attached_at = parse_datetime(attached_at)
+    if attached_at is None or not pk.isdigit():
+        raise ValueError("Invalid cursor %r" % cursor)
+    return attached_at, int(pk)
 
-    return http.HttpResponse(file_to_serve, mimetype=attachment.mimetype)
+def _describe(attachment):
+    attached_at = timezone.localtime(attachment.attached_at)
+    return {
+        'id': attachment.pk,
+        'file_name': attachment.file_name,
+        'description': attachment.description or '',
+        'mimetype': attachment.mimetype,
+        'timestamp': dateformat.format(attached_at, settings.DATETIME_FORMAT),
+        'thumb': attachment.thumb(),
+        'srcset': attachment.srcset(),
+        'preview': attachment.preview(),
+        'download': attachment.download_url(),
+    }
+
+def attachment_page(request):
+    """
+    One page of an object's attachments as JSON, oldest first. Pass the
+    returned next cursor as after to get the following page; it is null on
+    the last one.
+    """
+    if 'content_type' not in request.GET or 'object_id' not in request.GET:
+        return http.HttpResponseBadRequest("No object given")
+    try:
+        content_type_id, object_id = int(request.GET['content_type']), int(request.GET['object_id'])
+        after = _parse_cursor(request.GET['after']) if request.GET.get('after') else None
+        count = int(request.GET.get('count') or getattr(settings, 'ATTACHMENTS_PAGE_SIZE', models.DEFAULT_PAGE_SIZE))
+    except ValueError as e:
+        return http.HttpResponseBadRequest(str(e))
+    count = min(max(count, 1), getattr(settings, 'ATTACHMENTS_BATCH_LIMIT', DEFAULT_BATCH_LIMIT))
+
+    # one extra row says whether there is another page
+    page = list(models.Attachment.objects.page_for(content_type_id, object_id, request.GET.get('tag'),
+                                                   after, count + 1))
+    next_cursor = _cursor(page[count - 1]) if len(page) > count else None
+    content = {'attachments': [_describe(attachment) for attachment in page[:count]], 'next': next_cursor}
+    return http.HttpResponse(json.dumps(content), mimetype='application/json')
 
 def edit_description(request):
     if 'description' in request.REQUEST and 'id' in request.REQUEST:
-        attachment = models.Attachment.objects.get(pk=request.REQUEST['id'])
-        attachment.description = request.REQUEST['description']
-        attachment.save()
+        models.Attachment.objects.filter(pk=request.REQUEST['id']).update(description=request.REQUEST['description'])
 
     return http.HttpResponse("success")
 
@@ -36,3 +182,103 @@ def delete_attachment(request):
         attachment = models.Attachment.objects.get(pk=request.REQUEST['id'])
         attachment.delete()
     return http.HttpResponse("success")
+
+def _selection(request):
+    """
+    The pks and filters picking the attachments a bulk request acts on: either
+    a list of ids, or every attachment of one object (optionally with one tag).
+    """
+    ids = request.REQUEST.getlist('id')
+    if ids:
+        return [int(pk) for pk in ids], {}
+    if 'content_type' in request.REQUEST and 'object_id' in request.REQUEST:
+        filters = dict(content_type__pk=int(request.REQUEST['content_type']),
+                       object_id=int(request.REQUEST['object_id']))
+        if 'from_tag' in request.REQUEST:
+            filters['tag'] = request.REQUEST['from_tag']
+        return None, filters
+    raise ValueError("No attachments selected")
+
+def _count_response(**counts):
+    return http.HttpResponse(json.dumps(counts), mimetype='application/json')
+
+@require_POST
+def bulk_delete(request):
+    try:
+        pks, filters = _selection(request)
+    except ValueError as e:
+        return http.HttpResponseBadRequest(str(e))
+    return _count_response(deleted=models.Attachment.objects.bulk_delete(pks, **filters))
+
+@require_POST
+def retag(request):
+    if 'tag' not in request.REQUEST:
+        return http.HttpResponseBadRequest("No tag given")
+    try:
+        pks, filters = _selection(request)
+    except ValueError as e:
+        return http.HttpResponseBadRequest(str(e))
+    return _count_response(retagged=models.Attachment.objects.retag(request.REQUEST['tag'], pks, **filters))
+
+def _upload_state(session):
+    return {
+        'token': session.token,
+        'url': reverse('attachments:upload', kwargs={'token': session.token}),
+        'offset': session.received,
+        'size': session.size,
+    }
+
+def _json_response(content, status=200):
+    return http.HttpResponse(json.dumps(content), mimetype='application/json', status=status)
+
+@require_POST
+def start_upload(request):
+    """
+    Starts a resumable upload of file_name (size bytes, with the optional
+    SHA-256 content_hash) to the object given by content_type and object_id.
+    The returned url takes the chunks.
+    """
+    try:
+        content_type = ContentType.objects.get_for_id(request.POST['content_type'])
+        model = content_type.get_object_for_this_type(pk=request.POST['object_id'])
+        session = models.UploadSession.objects.start(
+            model, request.POST['file_name'], int(request.POST['size']), request.POST.get('content_hash'),
+            request.POST.get('tag'), request.POST.get('description') or None)
+    except (KeyError, ValueError, ObjectDoesNotExist, uploads.UploadError) as e:
+        return http.HttpResponseBadRequest(str(e))
+    return _json_response(_upload_state(session), status=201)
+
+def upload(request, token):
+    """
+    GET tells where the upload stands, PUT appends the request body at
+    ?offset= (409 with the expected offset when that's not where the upload
+    left off), POST finishes it into an attachment and DELETE abandons it.
+    """
+    try:
+        session = models.UploadSession.objects.get(token=token)
+    except models.UploadSession.DoesNotExist:
+        raise http.Http404("No upload %s" % token)
+
+    if request.method in ('GET', 'HEAD'):
+        return _json_response(_upload_state(session))
+    if request.method == 'DELETE':
+        session.delete()
+        return _count_response(deleted=1)
+    if request.method not in ('PUT', 'POST'):
+        return http.HttpResponseNotAllowed(['GET', 'HEAD', 'PUT', 'POST', 'DELETE'])
+
+    try:
+        if request.method == 'POST':
+            return _json_response(_describe(session.finish()), status=201)
+
+        offset, length = int(request.GET['offset']), int(request.META.get('CONTENT_LENGTH') or 0)
+        if length > uploads.get_max_chunk_size():
+            # turned away before any of it is read
+            return http.HttpResponse("Chunks can't be larger than %d bytes" % uploads.get_max_chunk_size(),
+                                     status=413)
+        session.write_chunk(offset, request, length)
+    except uploads.OffsetMismatch as e:
+        return _json_response(dict(_upload_state(session), offset=e.offset, error=str(e)), status=409)
+    except (KeyError, ValueError, uploads.UploadError) as e:
+        return http.HttpResponseBadRequest(str(e))
+    return _json_response(_upload_state(session))
@@ -0,0 +1,166 @@
+import logging
+import multiprocessing
+import threading
+import time
+from Queue import Queue
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from attachments.utils import get_class
+
+DEFAULT_BACKEND = 'attachments.workers.LocalQueueBackend'
+DEFAULT_WORKERS = 2
+
+# a worker may look an attachment up before the transaction that saved it has committed
+LOOKUP_ATTEMPTS = 5
+LOOKUP_RETRY_DELAY = 1
+
+logger = logging.getLogger('attachments')
+
+
+def get_committed_attachment(pk):
+    """
+    Returns the attachment with pk, retrying for a few seconds while it isn't
+    visible yet, or None when it never shows up (e.g. it was deleted).
+    """
+    from attachments.models import Attachment
+
+    for attempt in range(LOOKUP_ATTEMPTS):
+        if attempt:
+            time.sleep(LOOKUP_RETRY_DELAY)
+            # end this connection's transaction, so rows committed since then are visible
+            transaction.rollback_unless_managed()
+        try:
+            return Attachment.objects.get(pk=pk)
+        except Attachment.DoesNotExist:
+            pass
+    return None
+
+
+def generate_renditions(pk):
+    """
+    Generates the thumbnail and preview renditions of an image attachment so
+    the first viewer doesn't have to.
+    """
+    from attachments import renditions
+
+    attachment = get_committed_attachment(pk)
+    if attachment is None:
+        # deleted, or its transaction rolled back
+        return
+
+    try:
+        profiles = [profile for profile in renditions.get_profiles() if profile.available]
+        named_renditions = renditions.get_named_renditions()
+        for name in sorted(named_renditions):
+            named = named_renditions[name]
+            for profile in [named.profile] if named.profile else profiles:
+                renditions.get_rendition(attachment, named.size, profile, named.crop)
+    except renditions.RenderingBusy:
+        logger.info("Rendering is saturated; attachment %s will be rendered when first viewed", pk)
+    except Exception:
+        logger.exception("Unable to generate renditions for attachment %s", pk)
+
+
+class ImmediateBackend(object):
+    """
+    Generates renditions in the calling thread. Mostly useful for tests.
+    """
+
+    def __init__(self, workers=None):
+        pass
+
+    def submit(self, pk):
+        generate_renditions(pk)
+
+    def join(self):
+        pass
+
+
+class LocalQueueBackend(object):
+    """
+    An in-process queue drained by a small pool of daemon threads.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or getattr(settings, 'ATTACHMENTS_RENDITION_WORKERS', DEFAULT_WORKERS)
+        self.queue = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='attachments-renditions')
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            pk = self.queue.get()
+            try:
+                generate_renditions(pk)
+            finally:
+                # each worker thread has its own connection; don't leave it idling
+                connection.close()
+                self.queue.task_done()
+
+    def submit(self, pk):
+        self._start()
+        self.queue.put(pk)
+
+    def join(self):
+        self.queue.join()
+
+
+def _forget_inherited_connection():
+    # a forked child must not use (or close) the socket it shares with its parent
+    connection.connection = None
+
+
+class ProcessPoolBackend(object):
+    """
+    Generates renditions in a multiprocessing pool, keeping PIL work off the
+    web process entirely. The rendition store must be shared between processes
+    (a shared cache, the file system or the database) for this to be useful.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or getattr(settings, 'ATTACHMENTS_RENDITION_WORKERS', DEFAULT_WORKERS)
+        self.pool = None
+        self._lock = threading.Lock()
+
+    def submit(self, pk):
+        with self._lock:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.workers, initializer=_forget_inherited_connection)
+            self.pool.apply_async(generate_renditions, (pk,))
+
+    def join(self):
+        with self._lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = get_class(getattr(settings, 'ATTACHMENTS_RENDITION_BACKEND', DEFAULT_BACKEND))()
+        return _backend
+
+
+def enqueue_renditions(attachment):
+    """
+    Queues rendition generation for a saved image attachment when
+    ATTACHMENTS_EAGER_RENDITIONS is turned on.
+    """
+    if getattr(settings, 'ATTACHMENTS_EAGER_RENDITIONS', False) and attachment.attachment_type == attachment.IMAGE:
+        get_backend().submit(attachment.pk)
@@ -0,0 +1,86 @@
+"""
+Shared set up for the benchmark scripts. They run against the example
+project (test_settings, i.e. SQLite, unless --settings says otherwise) in a
+throwaway test database, and print their results as JSON.
+"""
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'example'))
+
+
+def setup(settings_module='test_settings'):
+    os.environ['DJANGO_SETTINGS_MODULE'] = settings_module
+
+    from django.db import connection
+    from south.management.commands import patch_for_test_db_setup
+
+    patch_for_test_db_setup()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    return old_name
+
+
+def teardown(old_name):
+    from django.db import connection
+    connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summarize(samples):
+    """
+    Latency percentiles, in milliseconds, of a list of durations in seconds.
+    """
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3),
+    }
+
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+def _run_for_peak_rss(queue, function, args):
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    function(*args)
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start)
+
+
+def peak_rss_kb(function, *args):
+    """
+    How far (in KB on Linux) function(*args) raises the peak resident set size.
+    It runs in a forked child, since a process's peak never comes back down.
+    """
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run_for_peak_rss, args=(queue, function, args))
+    child.start()
+    growth = queue.get()
+    child.join()
+    return growth
+
+
+def report(results, output=None):
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as destination:
+            destination.write(text + '\n')
+    sys.stdout.write(text + '\n')
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Compares two suite.py results and exits non-zero when any latency, peak
+memory or query count got worse (or throughput got lower) by more than the
+threshold, so a release can be checked against the last one:
+
+    python benchmarks/compare.py before.json after.json --threshold 0.2
+"""
+import json
+import sys
+from optparse import OptionParser
+
+# metric name suffixes, and whether a bigger number is better
+METRICS = (
+    ('_ms', False),
+    ('_kb', False),
+    ('queries', False),
+    ('_per_s', True),
+)
+
+# latencies below this are too noisy to call a regression
+DEFAULT_MIN_MS = 1.0
+
+
+def metrics(results, prefix=''):
+    for key, value in sorted(results.items()):
+        name = prefix + key
+        if isinstance(value, dict):
+            for metric in metrics(value, name + '.'):
+                yield metric
+            continue
+        for suffix, higher_is_better in METRICS:
+            if key.endswith(suffix) and isinstance(value, (int, long, float)):
+                yield name, value, higher_is_better
+
+
+def compare(before, after, threshold, min_ms=DEFAULT_MIN_MS):
+    """
+    (name, before, after, change, regressed) for every metric in both
+    results; change is relative to before.
+    """
+    previous = dict((name, value) for name, value, _ in metrics(before))
+    for name, value, higher_is_better in metrics(after):
+        old = previous.get(name)
+        if old is None:
+            continue
+        change = float(value - old) / old if old else 0.0
+        worse = -change if higher_is_better else change
+        noise = name.endswith('_ms') and max(old, value) < min_ms
+        yield name, old, value, change, worse > threshold and not noise
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] before.json after.json")
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='Relative change that counts as a regression (default 0.1, i.e. 10%).')
+    parser.add_option('--min-ms', type='float', default=DEFAULT_MIN_MS,
+                      help='Ignore latencies that stay below this many milliseconds.')
+    parser.add_option('--all', action='store_true', help='List every metric, not only regressions.')
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('expected two result files')
+
+    before, after = [json.load(open(path)) for path in args]
+    regressions = 0
+    for name, old, new, change, regressed in compare(before, after, options.threshold, options.min_ms):
+        regressions += regressed
+        if regressed or options.all:
+            sys.stdout.write('%s %s: %s -> %s (%+.1f%%)\n' % (
+                'REGRESSED' if regressed else '         ', name, old, new, change * 100))
+    sys.stdout.write('%d regression(s)\n' % regressions)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
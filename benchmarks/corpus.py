@@ -0,0 +1,92 @@
+"""
+Synthetic attachments for the benchmarks: images and documents at a few
+sizes, generated from a fixed seed so every run (and every release) is
+measured against the same bytes.
+"""
+import binascii
+import random
+import zipfile
+from StringIO import StringIO
+
+# name: (width, height) of the generated photos
+IMAGE_SIZES = {
+    'small': (640, 480),
+    'medium': (2048, 1536),
+    'large': (4000, 3000),
+}
+
+# name: approximate payload bytes of the generated documents
+DOCUMENT_SIZES = {
+    'small': 50 * 1024,
+    'medium': 1024 * 1024,
+    'large': 10 * 1024 * 1024,
+}
+
+
+class Item(object):
+
+    def __init__(self, file_name, kind, size_name, data):
+        self.file_name = file_name
+        self.kind = kind
+        self.size_name = size_name
+        self.data = data
+
+    @property
+    def label(self):
+        return '%s-%s' % (self.kind, self.size_name)
+
+
+def random_bytes(size, rng):
+    if not size:
+        return ''
+    return binascii.unhexlify('%0*x' % (size * 2, rng.getrandbits(size * 8)))
+
+
+def noise(width, height, rng):
+    from PIL import Image
+
+    # PIL's effect_noise can't be seeded, so tile a block of seeded random bytes instead
+    block = random_bytes(1 << 20, rng)
+    pixels = width * height
+    return Image.frombytes('L', (width, height), (block * (pixels // len(block) + 1))[:pixels])
+
+
+def make_photo(width, height, format, seed):
+    from PIL import Image
+
+    rng = random.Random(seed)
+    # a gradient under noise compresses (and decodes) more like a photo than a flat colour does
+    gradient = Image.linear_gradient('L').resize((width, height))
+    bands = [Image.blend(gradient, noise(width, height, rng), 0.5) for _ in range(3)]
+    output = StringIO()
+    Image.merge('RGB', bands).save(output, format, quality=90)
+    return output.getvalue()
+
+
+def make_pdf(size, seed):
+    body = random_bytes(size, random.Random(seed))
+    return ('%%PDF-1.4\n1 0 obj\n<< /Length %d >>\nstream\n' % len(body)) + body + '\nendstream\nendobj\n%%EOF\n'
+
+
+def make_docx(size, seed):
+    output = StringIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('word/document.xml', random_bytes(size, random.Random(seed)))
+    return output.getvalue()
+
+
+def generate(image_sizes=None, document_sizes=None, copies=1):
+    """
+    copies of each image (JPEG and PNG) and document (PDF and DOCX) size.
+    """
+    items = []
+    for copy in range(copies):
+        for size_name in sorted(image_sizes or IMAGE_SIZES):
+            width, height = IMAGE_SIZES[size_name]
+            items.append(Item('photo.jpg', 'jpeg', size_name, make_photo(width, height, 'JPEG', copy)))
+            items.append(Item('photo.png', 'png', size_name, make_photo(width, height, 'PNG', copy)))
+        for size_name in sorted(document_sizes or DOCUMENT_SIZES):
+            size = DOCUMENT_SIZES[size_name]
+            items.append(Item('report.pdf', 'pdf', size_name, make_pdf(size, copy)))
+            items.append(Item('report.docx', 'docx', size_name, make_docx(size, copy)))
+    return items
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Shows how the (content_type, object_id, tag, attached_at) index added by
+migration 0010 and the (content_type, object_id, attached_at) one added by
+migration 0013 change the query plans and latency of
+Attachment.objects.latest_for() and of untagged Attachment.objects.page_for()
+on a large attachments table.
+
+    python benchmarks/index_plan.py --rows 2000000 --output index_plan.json
+"""
+import datetime
+import random
+from optparse import OptionParser
+
+import common
+
+INSERT_SQL = (
+    "INSERT INTO attachments_attachment (content_type_id, object_id, mimetype, attachment_type, description, "
+    "file_name, tag, size, content_hash, storage, storage_key, attached_at) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+)
+TAGS = ('', 'scan', 'photo', 'contract', 'invoice')
+INDEX_MIGRATIONS = (
+    'attachments.migrations.0010_added_object_tag_attached_at_index',
+    'attachments.migrations.0013_added_object_attached_at_index',
+)
+
+
+def populate(rows, objects, batch_size=10000):
+    from django.contrib.contenttypes.models import ContentType
+    from django.db import connection, transaction
+    from sample_app.models import First
+
+    content_type = ContentType.objects.get_for_model(First)
+    start = datetime.datetime(2010, 1, 1)
+    cursor = connection.cursor()
+    batch = []
+    for i in xrange(rows):
+        batch.append((content_type.pk, random.randint(1, objects), 'application/pdf', 1, None, 'scan.pdf',
+                      random.choice(TAGS), 0, '', 'database', '', start + datetime.timedelta(seconds=i)))
+        if len(batch) == batch_size:
+            cursor.executemany(INSERT_SQL, batch)
+            batch = []
+    if batch:
+        cursor.executemany(INSERT_SQL, batch)
+    transaction.commit_unless_managed()
+
+
+def analyze():
+    from django.db import connection, transaction
+
+    cursor = connection.cursor()
+    if connection.vendor == 'mysql':
+        cursor.execute("ANALYZE TABLE attachments_attachment")
+        cursor.fetchall()
+    else:
+        cursor.execute("ANALYZE")
+    transaction.commit_unless_managed()
+
+
+def explain(queryset):
+    from django.db import connection
+
+    sql, params = queryset.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+
+
+def measure(objects, queries):
+    from django.contrib.contenttypes.models import ContentType
+    from attachments.models import Attachment
+    from sample_app.models import First
+
+    content_type = ContentType.objects.get_for_model(First)
+    latest, pages = [], []
+    for _ in range(queries):
+        model, tag = First(pk=random.randint(1, objects)), random.choice(TAGS)
+        duration, _ = common.timed(list, Attachment.objects.latest_for(model, tag, count=10))
+        latest.append(duration)
+        duration, _ = common.timed(list, Attachment.objects.page_for(content_type.pk, model.pk, count=10))
+        pages.append(duration)
+
+    return {
+        'plan': explain(Attachment.objects.latest_for(First(pk=1), 'scan', count=10)),
+        'latency': common.summarize(latest),
+        'page_plan': explain(Attachment.objects.page_for(content_type.pk, 1, count=10)),
+        'page_latency': common.summarize(pages),
+    }
+
+
+def create_indexes():
+    from django.utils.importlib import import_module
+
+    for path in INDEX_MIGRATIONS:
+        import_module(path).Migration().forwards(None)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--settings', default='test_settings')
+    parser.add_option('--rows', type='int', default=1000000)
+    parser.add_option('--objects', type='int', default=50000, help='Number of distinct objects attached to.')
+    parser.add_option('--queries', type='int', default=500)
+    parser.add_option('--output', help='Also write the JSON results to this file.')
+    options, _ = parser.parse_args()
+
+    old_name = common.setup(options.settings)
+    try:
+        from django.db import transaction
+
+        random.seed(0)
+        populate_time, _ = common.timed(populate, options.rows, options.objects)
+        analyze()
+        before = measure(options.objects, options.queries)
+
+        index_time, _ = common.timed(create_indexes)
+        transaction.commit_unless_managed()
+        analyze()
+        after = measure(options.objects, options.queries)
+
+        common.report({
+            'rows': options.rows,
+            'objects': options.objects,
+            'populate_seconds': round(populate_time, 3),
+            'create_index_seconds': round(index_time, 3),
+            'without_index': before,
+            'with_index': after,
+        }, options.output)
+    finally:
+        common.teardown(old_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Measures the upload, serve and listing paths end to end against the example
+project, on a synthetic corpus (see corpus.py), and reports JSON that
+compare.py can diff against an earlier run:
+
+- ingest: Attachment.save() latency and throughput for each kind and size
+  of file, and the peak memory of saving the largest ones
+- serve: download, thumbnail and preview latency percentiles through the
+  URLs, with renditions generated (cold) and stored (warm), and the peak
+  memory of generating them from the largest images
+- queries: query count and latency of get_attachments_for_list()
+
+    python benchmarks/suite.py --output before.json
+    python benchmarks/suite.py --settings settings --storage filesystem --output mysql.json
+"""
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+from optparse import OptionParser
+
+import common
+import corpus
+
+RENDITIONS = ('thumbnail', 'preview')
+
+
+def versions():
+    import django
+    import PIL
+    from django.db import connection
+
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=common.ROOT,
+                                           stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'revision': revision,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'pillow': getattr(PIL, '__version__', getattr(PIL, 'PILLOW_VERSION', None)),
+        'database': connection.vendor,
+    }
+
+
+def new_object():
+    from sample_app.models import First
+    return First.objects.create(first_field='x', second_field='y')
+
+
+def save(item, attach_to):
+    from django.core.files.base import ContentFile
+    from attachments.models import Attachment
+
+    attachment = Attachment(attach_to=attach_to, attachment=ContentFile(item.data, name=item.file_name))
+    attachment.save()
+    return attachment
+
+
+def _forget_inherited_connection():
+    from django.db import connection
+
+    # only SQLite's in-memory test database can be used through the copy inherited from the parent
+    if connection.vendor != 'sqlite':
+        connection.connection = None
+
+
+def _save_in_child(item):
+    _forget_inherited_connection()
+    save(item, new_object())
+
+
+def measure_ingest(items, iterations):
+    results, attach_to = {}, new_object()
+    for item in items:
+        samples = [common.timed(save, item, attach_to)[0] for _ in range(iterations)]
+        result = results.setdefault(item.label, {'bytes': len(item.data)})
+        result['latency'] = common.summarize(samples)
+        result['mb_per_s'] = round(len(item.data) / (1024.0 * 1024) / common.percentile(samples, 0.5), 3)
+        if item.size_name == 'large':
+            result['peak_rss_growth_kb'] = common.peak_rss_kb(_save_in_child, item)
+    return results
+
+
+def fetch(client, url):
+    response = client.get(url)
+    assert response.status_code == 200, "%s answered %s" % (url, response.status_code)
+    # streamed responses are only read as their content is consumed
+    return len(response.content)
+
+
+def _render_in_child(attachment, url):
+    from django.test.client import Client
+    from attachments import renditions
+
+    _forget_inherited_connection()
+    renditions.invalidate(attachment.pk)
+    fetch(Client(), url)
+
+
+def measure_serve(items, iterations):
+    from django.test.client import Client
+    from attachments import renditions
+
+    client, attach_to, results = Client(), new_object(), {}
+    for item in items:
+        attachment = save(item, attach_to)
+        result = results[item.label] = {}
+
+        samples = [common.timed(fetch, client, attachment.download_url())[0] for _ in range(iterations)]
+        result['download'] = common.summarize(samples)
+        if attachment.attachment_type != attachment.IMAGE:
+            continue
+
+        for name in RENDITIONS:
+            url, cold = attachment.rendition_url(name), []
+            for _ in range(iterations):
+                renditions.invalidate(attachment.pk)
+                cold.append(common.timed(fetch, client, url)[0])
+            warm = [common.timed(fetch, client, url)[0] for _ in range(iterations)]
+            result[name] = {'cold': common.summarize(cold), 'warm': common.summarize(warm)}
+            if item.size_name == 'large':
+                result[name]['peak_rss_growth_kb'] = common.peak_rss_kb(_render_in_child, attachment, url)
+    return results
+
+
+def measure_queries(models, attachments_per_model, iterations):
+    from django.db import connection
+    from attachments.models import Attachment
+
+    objects = [new_object() for _ in range(models)]
+    item = corpus.Item('report.pdf', 'pdf', 'tiny', corpus.make_pdf(1024, 0))
+    for attach_to in objects:
+        for _ in range(attachments_per_model):
+            save(item, attach_to)
+
+    connection.use_debug_cursor = True
+    try:
+        del connection.queries[:]
+        count = len(list(Attachment.get_attachments_for_list(objects)))
+        queries = len(connection.queries)
+    finally:
+        connection.use_debug_cursor = None
+
+    samples = [common.timed(list, Attachment.get_attachments_for_list(objects))[0] for _ in range(iterations)]
+    return {
+        'models': models,
+        'attachments': count,
+        'queries': queries,
+        'latency': common.summarize(samples),
+    }
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--settings', default='test_settings',
+                      help="Settings module; 'settings' runs against the example project's MySQL database.")
+    parser.add_option('--storage', default='database', help='ATTACHMENTS_STORAGE to benchmark.')
+    parser.add_option('--sizes', default='small,medium,large', help='Comma separated corpus sizes to include.')
+    parser.add_option('--iterations', type='int', default=20)
+    parser.add_option('--models', type='int', default=200, help='Objects listed in the query benchmark.')
+    parser.add_option('--attachments-per-model', type='int', default=5)
+    parser.add_option('--output', help='Also write the JSON results to this file.')
+    options, _ = parser.parse_args()
+
+    old_name = common.setup(options.settings)
+    root = tempfile.mkdtemp()
+    try:
+        from django.test.utils import override_settings
+
+        sizes = options.sizes.split(',')
+        items = corpus.generate(image_sizes=sizes, document_sizes=sizes)
+        with override_settings(ATTACHMENTS_STORAGE=options.storage, ATTACHMENTS_STORAGE_ROOT=root,
+                               ATTACHMENTS_RENDITION_ROOT=os.path.join(root, 'renditions'),
+                               ATTACHMENTS_EAGER_RENDITIONS=False):
+            common.report({
+                'versions': versions(),
+                'storage': options.storage,
+                'iterations': options.iterations,
+                'ingest': measure_ingest(items, options.iterations),
+                'serve': measure_serve(items, options.iterations),
+                'queries': measure_queries(options.models, options.attachments_per_model, options.iterations),
+            }, options.output)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+        common.teardown(old_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Compares the latency and peak memory of decoding a large camera image into
+a preview: a full resolution decode, PIL's plain thumbnail() (what
+create_thumbnail used to do), and attachments.renditions.downscale().
+
+    python benchmarks/thumbnail_decode.py --megapixels 24 --output thumbnail_decode.json
+"""
+import os
+from StringIO import StringIO
+from optparse import OptionParser
+
+import common
+
+
+def make_image(megapixels, format):
+    from PIL import Image
+
+    width = int((megapixels * 1000 * 1000 * 3 / 2) ** 0.5)
+    height = width * 2 / 3
+    # noise compresses (and decodes) more like a photo than a flat colour does
+    image = Image.merge('RGB', [Image.effect_noise((width, height), 64) for _ in range(3)])
+    output = StringIO()
+    image.save(output, format, quality=90)
+    return output.getvalue()
+
+
+def full_decode(data, max_size):
+    from PIL import Image
+
+    image = Image.open(StringIO(data))
+    image.load()
+    image.thumbnail((max_size, max_size), Image.ANTIALIAS)
+    return image
+
+
+def thumbnail(data, max_size):
+    from PIL import Image
+
+    image = Image.open(StringIO(data))
+    image.thumbnail((max_size, max_size), Image.ANTIALIAS)
+    return image
+
+
+def downscale(data, max_size):
+    from attachments import renditions
+    return renditions.downscale(StringIO(data), max_size)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--settings', default='test_settings')
+    parser.add_option('--megapixels', type='float', default=24)
+    parser.add_option('--format', default='JPEG', help='PIL format of the source image, e.g. JPEG or PNG.')
+    parser.add_option('--size', type='int', default=550, help='Rendition size; 550 is the preview size.')
+    parser.add_option('--iterations', type='int', default=10)
+    parser.add_option('--output', help='Also write the JSON results to this file.')
+    options, args = parser.parse_args()
+
+    os.environ['DJANGO_SETTINGS_MODULE'] = options.settings
+    data = make_image(options.megapixels, options.format)
+
+    results = {
+        'megapixels': options.megapixels,
+        'format': options.format,
+        'source_bytes': len(data),
+        'size': options.size,
+    }
+    for path in (full_decode, thumbnail, downscale):
+        samples = [common.timed(path, data, options.size)[0] for _ in range(options.iterations)]
+        results[path.__name__] = {
+            'latency': common.summarize(samples),
+            'peak_rss_growth_kb': common.peak_rss_kb(path, data, options.size),
+        }
+    common.report(results, options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 from django.db import models
+from django.contrib.contenttypes import generic
+from attachments.models import Attachment
 
 class Person(models.Model):
     name = models.CharField(max_length=10, default="asdf")
@@ -6,6 +8,7 @@ class Person(models.Model):
 class First(models.Model):
     first_field = models.CharField(max_length=10)
     second_field = models.CharField(max_length=10)
+    attachments = generic.GenericRelation(Attachment)
 
 class Second(models.Model):
     third_field = models.CharField(max_length=10)